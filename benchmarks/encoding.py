@@ -0,0 +1,70 @@
+'''
+Compare the wire encodings of the server's frames.
+
+Encodes and decodes typical frames with the standard library's json, with
+the JSON encoder the server uses, and with the compact MessagePack encoding
+clients can negotiate, and reports the bytes per frame and the microseconds
+to encode and decode each:
+
+    python -m benchmarks.encoding --players 4
+'''
+import argparse
+import json
+import timeit
+
+from benchmarks.engine import STAGES, position
+from server.codec import compact, decode_json, decode_msgpack, encode_json, encode_msgpack, orjson
+
+def frames(num_players: int, seed: int) -> dict:
+    '''
+    The full state at each stage of a game, the patch of a mid-game action,
+    and the glossary of cards and collections.
+    '''
+    result = {}
+    for stage in STAGES:
+        game = position(stage, num_players, seed)
+        result[f"state ({stage})"] = {"type": "game_state_update",
+                                      "gameStateDelta": {"game": game.get_visible_state()}}
+
+    game = position("mid", num_players, seed)
+    player_id = game._get_current_player()
+    action, action_args = game.legal_actions(player_id)[0]
+    game.make_action(action, player_id, **action_args)
+    result["patch (mid)"] = {"type": "game_state_patch", **game.get_delta()}
+    result["glossary"] = {"type": "game_state_update",
+                          "gameStateDelta": {"cards": game.get_cards(), "collections": game.get_collections()}}
+    return result
+
+def measure(encode, decode, frame: dict, number: int) -> tuple[int, float, float]:
+    '''
+    Returns the bytes of the encoded frame, and the microseconds to encode
+    and decode it.
+    '''
+    encoded = encode(frame)
+    size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+    encode_us = min(timeit.repeat(lambda: encode(frame), number=number, repeat=5)) / number * 1e6
+    decode_us = min(timeit.repeat(lambda: decode(encoded), number=number, repeat=5)) / number * 1e6
+    return size, encode_us, decode_us
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Compare the wire encodings of the server's frames.")
+    parser.add_argument("--players", type=int, default=4, help="players in each game")
+    parser.add_argument("--number", type=int, default=2000, help="calls in each timing")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    encodings = {
+        "json": (json.dumps, json.loads),
+        "server json" + (" (orjson)" if orjson is not None else ""): (encode_json, decode_json),
+        # The compact form is built for every frame, so it is timed too
+        "msgpack": (lambda frame: encode_msgpack(compact(frame)), decode_msgpack),
+    }
+
+    for name, frame in frames(args.players, args.seed).items():
+        print(name)
+        for encoding, (encode, decode) in encodings.items():
+            size, encode_us, decode_us = measure(encode, decode, frame, args.number)
+            print(f"  {encoding:>20}: {size:7,} bytes, encode {encode_us:8.2f} us, decode {decode_us:8.2f} us")
+
+if __name__ == "__main__":
+    main()
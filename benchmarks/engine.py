@@ -0,0 +1,230 @@
+'''
+Microbenchmark the hot paths of the game engine in isolation.
+
+Times Game.begin, each action_* method at early, mid and late positions,
+get_visible_state, _assign_collection_if_eligible with full tableaus and
+__repr__. Positions are played out by the greedy policy from fixed seeds, so
+every run measures the same work. Each benchmark is repeated, and reports
+the median time per call across repeats with its spread, and the peak bytes
+allocated per call, as traced by tracemalloc in a separate untimed pass:
+
+    python -m benchmarks.engine --repeats 7 --output engine.json
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from typing import Callable
+
+from core.catalog import Catalog
+from core.game import Game, WinException
+from core.simulate import greedy_policy
+
+from benchmarks.load import git_commit
+
+STAGES = ("early", "mid", "late")
+
+ACTIONS = ("take_different", "take_same", "reserve", "purchase")
+
+def position(stage: str, num_players: int, seed: int) -> Game:
+    '''
+    Play the greedy policy to a stage of the game: "early" just after it
+    has begun, "mid" after 10 rounds, or "late" once a player is within
+    3 points of winning.
+    '''
+    rng = random.Random(seed)
+    game = Game()
+    for seat in range(num_players):
+        game.add_player(f"p{seat}")
+    game.begin(Catalog.default(), seed=seed)
+
+    def reached() -> bool:
+        if stage == "early":
+            return True
+        if stage == "mid":
+            return game.turn >= 10 * num_players
+        return max(game._get_player_score(player_id) for player_id in game.players) >= 12
+
+    while not reached():
+        player_id = game._get_current_player()
+        choice = greedy_policy(game, player_id, rng)
+        if choice is None:
+            record = game.make_action("pass", player_id)
+        else:
+            record = game.make_action(choice[0], player_id, **choice[1])
+        if game.winner is not None:
+            # Step back from the win, so the position can still be played
+            game.undo(record)
+            break
+
+    return game
+
+def timer_overhead(samples: int = 10000) -> float:
+    '''
+    The time taken to read the clock twice, to be taken off every call.
+    '''
+    clock = time.perf_counter_ns
+    return min(-clock() + clock() for _ in range(samples))
+
+class Bench:
+    '''
+    A call to time, with a setup run before each call and a teardown after,
+    neither of which is timed.
+    '''
+    def __init__(self, name: str, call: Callable[[], object],
+                 setup: Callable[[], None] | None = None, teardown: Callable[[], None] | None = None):
+        self.name = name
+        self.call = call
+        self.setup = setup
+        self.teardown = teardown
+
+    def run(self, calls: int, overhead: float) -> float:
+        '''
+        Returns the mean nanoseconds per call.
+        '''
+        clock = time.perf_counter_ns
+        call, setup, teardown = self.call, self.setup, self.teardown
+        total = 0
+        for _ in range(calls):
+            if setup is not None:
+                setup()
+            start = clock()
+            call()
+            total += clock() - start
+            if teardown is not None:
+                teardown()
+
+        return max(0.0, total / calls - overhead)
+
+    def allocated(self, calls: int) -> float:
+        '''
+        Returns the mean peak bytes allocated during a call.
+        '''
+        peaks = 0
+        tracemalloc.start()
+        for _ in range(calls):
+            if self.setup is not None:
+                self.setup()
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            self.call()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks += peak - before
+            if self.teardown is not None:
+                self.teardown()
+        tracemalloc.stop()
+
+        return peaks / calls
+
+def action_benches(stage: str, game: Game) -> list[Bench]:
+    '''
+    Benchmark each action the current player can take, cycling through
+    every legal way of taking it and undoing it after each call.
+    '''
+    benches = []
+    player_id = game._get_current_player()
+    legal = game.legal_actions(player_id)
+
+    for action in ACTIONS:
+        choices = [kwargs for name, kwargs in legal if name == action]
+        if not choices:
+            continue
+
+        method = getattr(game, f"action_{action}")
+        state = {"index": 0, "delta_base": None}
+
+        def setup(choices=choices, state=state):
+            state["kwargs"] = choices[state["index"] % len(choices)]
+            state["index"] += 1
+            state["delta_base"] = game._delta_base
+
+        def call(method=method, state=state):
+            try:
+                method(player_id, **state["kwargs"])
+            except WinException:
+                pass
+
+        def teardown(state=state):
+            game.undo((state["delta_base"], game._delta_base))
+
+        benches.append(Bench(f"action_{action} ({stage})", call, setup, teardown))
+
+    return benches
+
+def collection_bench(game: Game) -> Bench:
+    '''
+    Benchmark checking a collection for the player with the most
+    developments, who is made eligible again before each call.
+    '''
+    player_id = max(game.players, key=lambda player_id: len(game.players[player_id].developments))
+    player = game.players[player_id]
+    attained = player.attained_collection
+
+    def setup():
+        player.attained_collection = None
+
+    def teardown():
+        player.attained_collection = attained
+
+    return Bench("_assign_collection_if_eligible (late)",
+                 lambda: game._assign_collection_if_eligible(player_id), setup, teardown)
+
+def benches(num_players: int, seed: int) -> list[Bench]:
+    catalog = Catalog.default()
+    positions = {stage: position(stage, num_players, seed) for stage in STAGES}
+
+    lobby = {}
+    def new_lobby():
+        lobby["game"] = Game()
+        for seat in range(num_players):
+            lobby["game"].add_player(f"p{seat}")
+
+    result = [Bench("begin", lambda: lobby["game"].begin(catalog, seed=seed), new_lobby)]
+    for stage, game in positions.items():
+        result.extend(action_benches(stage, game))
+    for stage, game in positions.items():
+        result.append(Bench(f"get_visible_state ({stage})", game.get_visible_state))
+    result.append(collection_bench(positions["late"]))
+    for stage, game in positions.items():
+        result.append(Bench(f"__repr__ ({stage})", game.__repr__))
+
+    return result
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Microbenchmark the game engine.")
+    parser.add_argument("--calls", type=int, default=2000, help="calls in each repeat")
+    parser.add_argument("--repeats", type=int, default=7, help="repeats of each benchmark")
+    parser.add_argument("--players", type=int, default=4, help="players in each game")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    args = parser.parse_args(argv)
+
+    overhead = timer_overhead()
+    results = {}
+    for bench in benches(args.players, args.seed):
+        # One repeat to warm up, which is not counted
+        bench.run(args.calls // 10 or 1, overhead)
+        times = [bench.run(args.calls, overhead) for _ in range(args.repeats)]
+        median = statistics.median(times)
+        spread = statistics.median(abs(t - median) for t in times)
+        allocated = bench.allocated(min(args.calls, 200))
+        results[bench.name] = {"median_ns": median, "mad_ns": spread, "min_ns": min(times),
+                               "peak_bytes_per_call": allocated}
+        print(f"{bench.name:>40}: {median / 1000:9.2f} us ± {spread / 1000:6.2f} "
+              f"(min {min(times) / 1000:9.2f}), {allocated:9,.0f} bytes/call")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "benchmark": "engine",
+                "commit": git_commit(),
+                "cores": os.cpu_count(),
+                "config": {key: value for key, value in vars(args).items() if key != "output"},
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+'''
+Generate load against the server, and measure its latency and footprint.
+
+Starts server.main under uvicorn, unless --url points at a running server,
+then opens a websocket per player in many rooms at once. Each room is
+created, joined by 2 to 4 players and begun, then its players take random
+legal moves in turn at the given rate, starting a new room whenever a game
+ends. Reports the latency from sending an action to receiving the state it
+produced, the messages, frames and bytes per second, and the CPU and RSS of
+the server, and saves them as JSON to be compared between commits:
+
+    python -m benchmarks.load --rooms 500 --rate 2 --duration 30 --output after.json
+    python -m benchmarks.load --rooms 500 --rate 2 --duration 30 --compare before.json
+
+Clients can negotiate protocol features, such as --features batch deflate.
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from server.codec import decode_msgpack, encode_msgpack
+from server.shards import wait_for_port
+
+# The messages that carry a new state of the room
+STATE_TYPES = ("game_state_update", "game_state_patch")
+
+class Client:
+    '''
+    A player's websocket, with a reader that counts every frame and message
+    received, and hands the awaited reply to whoever is waiting on it.
+    '''
+    def __init__(self, websocket, msgpack: bool = False):
+        self.websocket = websocket
+        self.msgpack = msgpack
+        self.received = 0
+        self.frames = 0
+        self.bytes = 0
+        self.sent = 0
+        self.waiting = None
+        self.reader = asyncio.create_task(self._read())
+
+    def decode(self, data) -> list[dict]:
+        '''
+        Decode a frame into the messages it holds, inflating it if it was
+        compressed, and unpacking it if it was a batch.
+        '''
+        if isinstance(data, bytes) and data[:1] == b"\x78":
+            data = zlib.decompress(data)
+            if not self.msgpack:
+                data = data.decode()
+        message = decode_msgpack(data) if isinstance(data, bytes) else json.loads(data)
+        if message["type"] == "batch":
+            return message["messages"]
+        return [message]
+
+    async def _read(self) -> None:
+        async for data in self.websocket:
+            self.frames += 1
+            self.bytes += len(data)
+            messages = self.decode(data)
+            self.received += len(messages)
+            for message in messages:
+                if self.waiting is not None:
+                    reply_types, future = self.waiting
+                    if message["type"] in reply_types and not future.done():
+                        future.set_result(message)
+
+    async def command(self, message: dict, *reply_types: str) -> dict:
+        '''
+        Send a command and wait for a reply of one of the types, or an error.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self.waiting = (reply_types + ("error",), future)
+        await self.websocket.send(encode_msgpack(message) if self.msgpack else json.dumps(message))
+        self.sent += 1
+        try:
+            return await future
+        finally:
+            self.waiting = None
+
+async def play_room(url: str, room_name: str, start: float, warmup: float, deadline: float,
+                    rate: float, features: list[str], transport_deflate: bool, seed: int,
+                    connect_limit: asyncio.Semaphore) -> dict:
+    '''
+    Play games in a room until the deadline, starting a new room whenever one
+    ends. Returns the action latencies after the warmup, in seconds, and the
+    messages sent and received, and the frames and bytes received.
+    '''
+    from websockets.asyncio.client import connect
+
+    rng = random.Random(seed)
+    num_players = rng.randint(2, 4)
+    latencies = []
+    clients = []
+
+    try:
+        async with connect_limit:
+            for _ in range(num_players):
+                websocket = await connect(url, max_size=None,
+                                          compression="deflate" if transport_deflate else None)
+                client = Client(websocket)
+                clients.append(client)
+                if features:
+                    await client.command({"command": "hello", "features": features}, "hello")
+                    client.msgpack = "msgpack" in features
+
+        # Stagger the rooms, so that they don't all act at the same moment
+        interval = 1 / rate if rate else 0
+        await asyncio.sleep(rng.random() * interval)
+        next_action = time.monotonic()
+
+        for game in itertools.count():
+            if time.monotonic() >= deadline:
+                break
+
+            room = f"{room_name}-{game}"
+            usernames = [f"p{seat}" for seat in range(num_players)]
+            await clients[0].command({"command": "create_room", "room_name": room,
+                                      "username": usernames[0]}, *STATE_TYPES)
+            for client, username in zip(clients[1:], usernames[1:]):
+                await client.command({"command": "join_room", "room_name": room,
+                                      "username": username}, *STATE_TYPES)
+            await clients[0].command({"command": "begin_game", "room_name": room}, *STATE_TYPES)
+
+            for turn in itertools.count():
+                seat = turn % num_players
+                client, username = clients[seat], usernames[seat]
+                legal = await client.command({"command": "legal_actions", "room_name": room,
+                                              "username": username}, "legal_actions")
+                if legal["type"] == "error" or not legal["actions"]:
+                    break
+
+                if interval:
+                    next_action += interval
+                    await asyncio.sleep(max(0.0, next_action - time.monotonic()))
+                if time.monotonic() >= deadline:
+                    break
+
+                sent = time.monotonic()
+                state = await client.command({"command": "action", "room_name": room, "username": username,
+                                              **rng.choice(legal["actions"])}, *STATE_TYPES)
+                if state["type"] == "error":
+                    break
+                if sent - start >= warmup:
+                    latencies.append(time.monotonic() - sent)
+    finally:
+        for client in clients:
+            await client.websocket.close()
+            client.reader.cancel()
+
+    return {
+        "latencies": latencies,
+        "sent": sum(client.sent for client in clients),
+        "received": sum(client.received for client in clients),
+        "frames": sum(client.frames for client in clients),
+        "bytes": sum(client.bytes for client in clients),
+    }
+
+def _play_rooms(url: str, room_names: list[str], warmup: float, duration: float, rate: float,
+                features: list[str], transport_deflate: bool, connect_concurrency: int, seed: int) -> dict:
+    async def play():
+        start = time.monotonic()
+        deadline = start + warmup + duration
+        connect_limit = asyncio.Semaphore(connect_concurrency)
+        results = await asyncio.gather(*(
+            play_room(url, room_name, start, warmup, deadline, rate, features, transport_deflate,
+                      seed + index, connect_limit)
+            for index, room_name in enumerate(room_names)
+        ), return_exceptions=True)
+
+        failed = [result for result in results if isinstance(result, BaseException)]
+        results = [result for result in results if not isinstance(result, BaseException)]
+        return {
+            "latencies": [latency for result in results for latency in result["latencies"]],
+            "sent": sum(result["sent"] for result in results),
+            "received": sum(result["received"] for result in results),
+            "frames": sum(result["frames"] for result in results),
+            "bytes": sum(result["bytes"] for result in results),
+            "failed_rooms": len(failed),
+        }
+
+    return asyncio.run(play())
+
+class ProcessSampler:
+    '''
+    Samples the CPU time and RSS of a process from /proc, where it exists.
+    '''
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.peak_rss = 0
+
+    def cpu_seconds(self) -> float | None:
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                # The command name may contain spaces, so fields are counted from its end
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def rss_bytes(self) -> int | None:
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+                        self.peak_rss = max(self.peak_rss, rss)
+                        return rss
+        except OSError:
+            pass
+        return None
+
+    async def run(self, interval: float = 0.5) -> None:
+        while True:
+            self.rss_bytes()
+            await asyncio.sleep(interval)
+
+def run(url: str, server_pid: int | None, args) -> dict:
+    '''
+    Play the rooms against a server and gather the results.
+    '''
+    rooms = [f"load-{args.seed}-{index}" for index in range(args.rooms)]
+    chunks = [rooms[index::args.client_processes] for index in range(args.client_processes)]
+    seeds = [args.seed + index * len(rooms) for index in range(len(chunks))]
+    sampler = ProcessSampler(server_pid) if server_pid is not None else None
+
+    async def measure():
+        loop = asyncio.get_running_loop()
+        sampling = asyncio.create_task(sampler.run()) if sampler else None
+        with ProcessPoolExecutor(max_workers=args.client_processes) as pool:
+            # The server's usage is measured over the same window as the
+            # latencies, after the warmup
+            pending = [
+                loop.run_in_executor(pool, _play_rooms, url, chunk, args.warmup, args.duration,
+                                     args.rate, args.features, not args.no_transport_deflate,
+                                     args.connect_concurrency, seed)
+                for chunk, seed in zip(chunks, seeds)
+            ]
+            await asyncio.sleep(args.warmup)
+            cpu_start = sampler.cpu_seconds() if sampler else None
+            window_start = time.perf_counter()
+            done = await asyncio.gather(*pending)
+            elapsed = time.perf_counter() - window_start
+            cpu_end = sampler.cpu_seconds() if sampler else None
+        if sampling:
+            sampling.cancel()
+        return done, elapsed, cpu_start, cpu_end
+
+    results, elapsed, cpu_start, cpu_end = asyncio.run(measure())
+    latencies = np.array([latency for result in results for latency in result["latencies"]]) * 1000
+    messages = sum(result["sent"] + result["received"] for result in results)
+    frames = sum(result["frames"] for result in results)
+    received_bytes = sum(result["bytes"] for result in results)
+
+    report = {
+        "actions": len(latencies),
+        "actions_per_second": len(latencies) / elapsed,
+        # Messages include those of the warmup, and rooms winding down
+        "messages_per_second": messages / (elapsed + args.warmup),
+        "frames_received_per_second": frames / (elapsed + args.warmup),
+        # Payload bytes, before any permessage-deflate on the wire
+        "bytes_received_per_second": received_bytes / (elapsed + args.warmup),
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "max": float(latencies.max()) if len(latencies) else None,
+        },
+        "failed_rooms": sum(result["failed_rooms"] for result in results),
+    }
+    if sampler is not None:
+        report["server"] = {
+            "cpu_percent": (cpu_end - cpu_start) / elapsed * 100
+                           if cpu_start is not None and cpu_end is not None else None,
+            "rss_bytes": sampler.rss_bytes(),
+            "peak_rss_bytes": sampler.peak_rss or None,
+        }
+    return report
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report: dict, baseline: dict) -> None:
+    '''
+    Print how each measurement changed since a baseline report.
+    '''
+    def flatten(results: dict, prefix: str = "") -> dict:
+        flat = {}
+        for key, value in results.items():
+            if isinstance(value, dict):
+                flat.update(flatten(value, f"{prefix}{key}."))
+            elif isinstance(value, (int, float)):
+                flat[prefix + key] = value
+        return flat
+
+    before, after = flatten(baseline["results"]), flatten(report["results"])
+    print(f"compared with {baseline.get('commit') or 'baseline'}:")
+    for key, value in after.items():
+        if before.get(key):
+            print(f"  {key:>28}: {before[key]:>12,.2f} -> {value:>12,.2f} ({value / before[key] - 1:+.1%})")
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate websocket load against the server.")
+    parser.add_argument("--url", help="websocket URL of a running server, instead of starting one")
+    parser.add_argument("--rooms", type=int, default=250, help="rooms played at once")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="actions per second in each room, 0 for as fast as possible")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds to play before measuring")
+    parser.add_argument("--features", nargs="*", default=[],
+                        choices=["patches", "msgpack", "batch", "deflate"], help="features to negotiate")
+    parser.add_argument("--no-transport-deflate", action="store_true",
+                        help="don't offer permessage-deflate when connecting")
+    parser.add_argument("--client-processes", type=int, default=1, help="processes playing the rooms")
+    parser.add_argument("--connect-concurrency", type=int, default=64,
+                        help="websockets each process opens at once")
+    parser.add_argument("--port", type=int, default=8600, help="port of the started server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--compare", help="results saved by an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        # The WAL and hibernation are left to the environment, so that their
+        # cost can be measured too
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server.main:app", "--host", "127.0.0.1",
+             "--port", str(args.port), "--log-level", "warning"],
+            stderr=subprocess.DEVNULL,
+        )
+        url = f"ws://127.0.0.1:{args.port}/ws"
+
+    try:
+        if server is not None:
+            wait_for_port("127.0.0.1", args.port)
+        results = run(url, server.pid if server else None, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "benchmark": "load",
+        "commit": git_commit(),
+        "cores": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+
+    latency = results["latency_ms"]
+    print(f"{results['actions']:,} actions, {results['actions_per_second']:,.0f} actions/s, "
+          f"{results['messages_per_second']:,.0f} messages/s")
+    print(f"received {results['frames_received_per_second']:,.0f} frames/s, "
+          f"{results['bytes_received_per_second'] / 1024:,.0f} KiB/s")
+    if latency["p50"] is not None:
+        print(f"action latency: p50 {latency['p50']:.2f} ms, p95 {latency['p95']:.2f} ms, "
+              f"p99 {latency['p99']:.2f} ms, max {latency['max']:.2f} ms")
+    if "server" in results:
+        usage = results["server"]
+        cpu = f"{usage['cpu_percent']:.0f}%" if usage["cpu_percent"] is not None else "n/a"
+        rss = f"{usage['peak_rss_bytes'] / 1024 / 1024:,.0f} MiB" if usage["peak_rss_bytes"] else "n/a"
+        print(f"server: {cpu} CPU, {rss} peak RSS")
+    if results["failed_rooms"]:
+        print(f"{results['failed_rooms']} rooms failed")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
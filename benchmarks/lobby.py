@@ -0,0 +1,90 @@
+'''
+Measure the lobby directory with many rooms.
+
+Opens rooms with one to three players each, begins some of them, and
+reports the time to list a page of open rooms at the start, middle and end
+of the directory, to page through all of it, and to update a room's listing
+as players join and games begin:
+
+    python -m benchmarks.lobby --rooms 50000 --limit 50
+'''
+import argparse
+import random
+import timeit
+
+from core.game import Game
+from server.lobby import Lobby
+
+def populate(num_rooms: int, seed: int) -> tuple[Lobby, dict[str, Game]]:
+    '''
+    A lobby of rooms with one to three players each, a quarter of which
+    have begun.
+    '''
+    rng = random.Random(seed)
+    lobby = Lobby()
+    games = {}
+    for index in range(num_rooms):
+        game = Game()
+        for seat in range(rng.randint(1, 3)):
+            game.add_player(f"p{seat}")
+        if rng.random() < 0.25:
+            game.begin(seed=index)
+
+        room_name = f"room-{index}"
+        games[room_name] = game
+        lobby.update(room_name, game)
+    return lobby, games
+
+def per_call(function, number: int) -> float:
+    '''
+    The best microseconds per call of a function, over five repeats.
+    '''
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the lobby directory with many rooms.")
+    parser.add_argument("--rooms", type=int, default=50000, help="rooms in the lobby")
+    parser.add_argument("--limit", type=int, default=50, help="rooms in each page")
+    parser.add_argument("--number", type=int, default=1000, help="calls in each timing")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    lobby, games = populate(args.rooms, args.seed)
+    print(f"{len(lobby):,} open rooms of {args.rooms:,}")
+
+    order = lobby.order
+    for name, after in (("first", 0), ("middle", order[len(order) // 2]), ("last", order[-args.limit - 1])):
+        elapsed = per_call(lambda: lobby.page(after, args.limit), args.number)
+        print(f"  {name:>6} page of {args.limit}: {elapsed:8.2f} us")
+
+    def page_through():
+        after = 0
+        while after is not None:
+            after = lobby.page(after, args.limit)["next"]
+
+    elapsed = per_call(page_through, 1) / 1000
+    print(f"  every page of {args.limit}: {elapsed:8.2f} ms")
+
+    # A room's listing changing, with a player joining and leaving again
+    room_name = lobby.rooms[order[len(order) // 2]]
+    game = games[room_name]
+    changed = Game()
+    for player_id in list(game.players) + ["joiner"]:
+        changed.add_player(player_id)
+
+    def join():
+        lobby.update(room_name, changed)
+        lobby.update(room_name, game)
+
+    print(f"  listing updated: {per_call(join, args.number) / 2:8.2f} us")
+
+    # Rooms closing as their game begins, from the middle of the directory
+    closing = [lobby.rooms[sequence] for sequence in order[len(order) // 4:len(order) // 4 + args.number]]
+    begun = Game().add_player("p0").begin(seed=args.seed)
+    # Once only, since a room can only close once
+    elapsed = timeit.timeit(lambda: [lobby.update(name, begun) for name in closing], number=1)
+    elapsed = elapsed / len(closing) * 1e6
+    print(f"  room delisted:   {elapsed:8.2f} us")
+
+if __name__ == "__main__":
+    main()
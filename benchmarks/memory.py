@@ -0,0 +1,79 @@
+'''
+Measure the memory each room's Game takes, at different stages of a game.
+
+Builds many rooms of each kind and reports the bytes allocated per room, as
+traced by tracemalloc, and the size of each room when pickled:
+
+    python -m benchmarks.memory --rooms 10000
+'''
+import argparse
+import gc
+import pickle
+import random
+import tracemalloc
+
+from core.catalog import Catalog
+from core.game import Game
+from core.simulate import random_policy
+
+def build_room(stage: str, num_players: int, seed: int) -> Game:
+    '''
+    Build a room at a stage of its game: "lobby" before it has begun,
+    "begun" just after, or "mid" after 40 random actions.
+    '''
+    game = Game()
+    for seat in range(num_players):
+        game.add_player(f"player{seat}")
+
+    if stage == "lobby":
+        return game
+
+    game.begin(Catalog.default(), seed=seed)
+    if stage == "begun":
+        return game
+
+    rng = random.Random(seed)
+    while game.turn < 40 and game.winner is None:
+        player_id = game._get_current_player()
+        choice = random_policy(game, player_id, rng)
+        if choice is None:
+            game.debug_action_pass(player_id)
+        else:
+            game.make_action(choice[0], player_id, **choice[1])
+
+    return game
+
+def measure(stage: str, num_rooms: int, num_players: int) -> tuple[float, float]:
+    '''
+    Returns the bytes allocated and the bytes pickled per room.
+    '''
+    # The catalog is shared by every room, so it is loaded up front
+    Catalog.default()
+    gc.collect()
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    rooms = {f"room{index}": build_room(stage, num_players, index) for index in range(num_rooms)}
+    gc.collect()
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pickled = sum(len(pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL)) for game in rooms.values())
+    return (end - start) / num_rooms, pickled / num_rooms
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the memory of each room.")
+    parser.add_argument("--rooms", type=int, default=10000, help="rooms of each kind to build")
+    parser.add_argument("--players", type=int, default=4, help="players in each room")
+    args = parser.parse_args(argv)
+
+    total = 0.0
+    for stage in ("lobby", "begun", "mid"):
+        allocated, pickled = measure(stage, args.rooms, args.players)
+        total += allocated
+        print(f"{stage:>6}: {allocated:,.0f} bytes per room, {pickled:,.0f} bytes pickled")
+
+    print(f"100k rooms, evenly mixed: {total / 3 * 100_000 / 1024 / 1024:,.0f} MiB")
+
+if __name__ == "__main__":
+    main()
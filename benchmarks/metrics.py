@@ -0,0 +1,166 @@
+'''
+Measure the overhead of the server's metrics on every message.
+
+Plays random games in the server's own process, sending each action through
+the same path as a websocket command to websockets that discard what they
+are sent. The games are played once with the metrics recording, and once
+with every histogram and counter swapped for one that does nothing, and the
+difference in the time per action message is the overhead. Also reports the
+cost of the instrumentation calls on their own, and of rendering /metrics
+with many rooms:
+
+    python -m benchmarks.metrics --actions 20000 --rooms 1000
+'''
+import argparse
+import asyncio
+import random
+import time
+
+import server.main as main_module
+from core.game import Game
+from server.metrics import Registry
+
+class NullWebSocket:
+    '''
+    A websocket that discards every frame sent to it.
+    '''
+    async def send_text(self, text: str) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+class NullMetric:
+    '''
+    A histogram or counter that records nothing.
+    '''
+    def observe(self, value: float, *labels) -> None:
+        pass
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        pass
+
+INSTRUMENTS = ("COMMAND_SECONDS", "QUEUE_WAIT_SECONDS", "ACTION_SECONDS",
+               "VISIBLE_STATE_SECONDS", "BROADCAST_SECONDS", "ERRORS")
+
+async def play(num_actions: int, num_players: int, seed: int) -> float:
+    '''
+    Take random actions through run_command. Returns the mean seconds per
+    action message.
+    '''
+    rng = random.Random(seed)
+    websockets = [NullWebSocket() for _ in range(num_players)]
+    for websocket in websockets:
+        main_module.manager.register(websocket)
+
+    total = 0.0
+    taken = 0
+    room = 0
+    while taken < num_actions:
+        room_name = f"metrics-{seed}-{room}"
+        room += 1
+        main_module.games[room_name] = Game()
+        for seat, websocket in enumerate(websockets):
+            main_module.games[room_name].add_player(f"p{seat}")
+            await main_module.manager.connect(websocket, room_name)
+        main_module.games[room_name].begin(main_module.catalog, seed=seed + room)
+
+        game = main_module.games[room_name]
+        while taken < num_actions and game.winner is None:
+            player_id = game._get_current_player()
+            legal = game.legal_actions(player_id)
+            if not legal:
+                break
+
+            action, action_args = rng.choice(legal)
+            message = {"command": "action", "room_name": room_name, "username": player_id,
+                       "action": action, "action_args": action_args}
+            websocket = websockets[int(player_id[1:])]
+
+            start = time.perf_counter()
+            await main_module.run_command(websocket, room_name, message, start)
+            total += time.perf_counter() - start
+            taken += 1
+
+            # Let the writers drain the frames
+            await asyncio.sleep(0)
+
+        del main_module.games[room_name]
+
+    for websocket in websockets:
+        main_module.manager.disconnect(websocket)
+    return total / taken
+
+def instrumentation_cost(calls: int) -> float:
+    '''
+    The seconds taken by the instrumentation of one action message on its
+    own: five histogram observations and the clock reads around them.
+    '''
+    registry = Registry()
+    histograms = [registry.histogram(f"h{index}", "", ("label",)) for index in range(5)]
+    clock = time.perf_counter
+
+    start = clock()
+    for _ in range(calls):
+        for histogram in histograms:
+            begin = clock()
+            histogram.observe(clock() - begin, "action")
+    return (clock() - start) / calls
+
+def render_cost(num_rooms: int, repeats: int = 5) -> tuple[float, int]:
+    '''
+    The seconds taken to render /metrics with a websocket in every room,
+    and the size of the rendering.
+    '''
+    async def render():
+        websockets = [NullWebSocket() for _ in range(num_rooms)]
+        for index, websocket in enumerate(websockets):
+            main_module.manager.register(websocket)
+            main_module.games[f"render-{index}"] = Game()
+            await main_module.manager.connect(websocket, f"render-{index}")
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            text = main_module.metrics.render()
+        elapsed = (time.perf_counter() - start) / repeats
+
+        for index, websocket in enumerate(websockets):
+            main_module.manager.disconnect(websocket)
+            del main_module.games[f"render-{index}"]
+        return elapsed, len(text)
+
+    return asyncio.run(render())
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the overhead of the server's metrics.")
+    parser.add_argument("--actions", type=int, default=20000, help="action messages in each run")
+    parser.add_argument("--players", type=int, default=4, help="players in each room")
+    parser.add_argument("--rooms", type=int, default=1000, help="rooms to render /metrics with")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    instruments = {name: getattr(main_module, name) for name in INSTRUMENTS}
+    results = {}
+
+    # Alternate between the two, so that drift affects both alike
+    for round in range(3):
+        for enabled in (True, False):
+            for name, instrument in instruments.items():
+                setattr(main_module, name, instrument if enabled else NullMetric())
+            per_action = asyncio.run(play(args.actions, args.players, args.seed + round))
+            results.setdefault(enabled, []).append(per_action)
+
+    for name, instrument in instruments.items():
+        setattr(main_module, name, instrument)
+
+    enabled, disabled = min(results[True]), min(results[False])
+    print(f"action message with metrics:    {enabled * 1e6:8.2f} us")
+    print(f"action message without metrics: {disabled * 1e6:8.2f} us")
+    print(f"overhead: {(enabled - disabled) * 1e6:.2f} us per message ({enabled / disabled - 1:+.1%})")
+    print(f"instrumentation alone: {instrumentation_cost(100000) * 1e6:.2f} us per message")
+
+    elapsed, size = render_cost(args.rooms)
+    print(f"/metrics with {args.rooms:,} rooms: {elapsed * 1000:.1f} ms, {size / 1024:,.0f} KiB")
+
+if __name__ == "__main__":
+    main()
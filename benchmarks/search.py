@@ -0,0 +1,92 @@
+'''
+Benchmark tree search with make/undo against copying the game at every node.
+
+Walks every line of play to a fixed depth from a mid-game position, and
+reports nodes/sec for both methods:
+
+    python -m benchmarks.search --depth 3
+'''
+import argparse
+import copy
+import random
+import time
+
+from core.game import Game
+from core.simulate import random_policy
+
+def mid_game(seed: int, num_players: int, turns: int) -> Game:
+    '''
+    Play a game with the random policy for a number of turns.
+    '''
+    rng = random.Random(seed)
+    game = Game()
+    for seat in range(num_players):
+        game.add_player(f"p{seat}")
+    game.begin(seed=seed)
+
+    while game.turn < turns and game.winner is None:
+        player_id = game._get_current_player()
+        choice = random_policy(game, player_id, rng)
+        if choice is None:
+            game.debug_action_pass(player_id)
+        else:
+            game.make_action(choice[0], player_id, **choice[1])
+
+    return game
+
+def search_make_undo(game: Game, depth: int) -> int:
+    '''
+    Count the nodes to a depth, taking and undoing actions in place.
+    '''
+    if depth == 0 or game.winner is not None:
+        return 1
+
+    nodes = 1
+    player_id = game._get_current_player()
+    for action, kwargs in game.legal_actions(player_id):
+        record = game.make_action(action, player_id, **kwargs)
+        nodes += search_make_undo(game, depth - 1)
+        game.undo(record)
+
+    return nodes
+
+def search_deepcopy(game: Game, depth: int) -> int:
+    '''
+    Count the nodes to a depth, copying the game for every action.
+    '''
+    if depth == 0 or game.winner is not None:
+        return 1
+
+    nodes = 1
+    player_id = game._get_current_player()
+    for action, kwargs in game.legal_actions(player_id):
+        child = copy.deepcopy(game)
+        child.make_action(action, player_id, **kwargs)
+        nodes += search_deepcopy(child, depth - 1)
+
+    return nodes
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark make/undo against deepcopy search.")
+    parser.add_argument("--depth", type=int, default=3, help="depth to search to")
+    parser.add_argument("--players", type=int, default=2, help="number of players")
+    parser.add_argument("--turns", type=int, default=20, help="turns to play before searching")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    game = mid_game(args.seed, args.players, args.turns)
+    results = {}
+    for name, search in (("make/undo", search_make_undo), ("deepcopy", search_deepcopy)):
+        start = time.perf_counter()
+        nodes = search(game, args.depth)
+        elapsed = time.perf_counter() - start
+        results[name] = (nodes, nodes / elapsed)
+        print(f"{name:>10}: {nodes} nodes in {elapsed:.2f}s ({nodes / elapsed:,.0f} nodes/s)")
+
+    if results["make/undo"][0] != results["deepcopy"][0]:
+        raise AssertionError("The searches visited a different number of nodes")
+
+    print(f"Speedup: {results['make/undo'][1] / results['deepcopy'][1]:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+'''
+Benchmark the throughput of the sharded server as the number of shards grows.
+
+Starts python -m server.shards with each number of workers, and plays random
+games in many rooms at once through the router, counting the actions taken.
+The same games are then played connected straight to the shard that owns
+each room, and the share of a core the router was busy for is reported, to
+show whether the router, which every frame passes through, is what limits
+the throughput:
+
+    python -m benchmarks.shards --workers 1 2 4 --rooms 64 --duration 10
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from server.shards import shard_for, wait_for_port
+
+async def play_room(urls: list[str], room_name: str, deadline: float, seed: int) -> int:
+    '''
+    Play random actions until the deadline, alternating between two players,
+    and starting a new game in a new room whenever one ends or stalls.
+    Each game connects to the URL its room hashes to, of the router or of
+    each shard. Returns the number of actions taken.
+    '''
+    from websockets.asyncio.client import connect
+
+    rng = random.Random(seed)
+    actions = 0
+
+    for game in itertools.count():
+        if time.monotonic() >= deadline:
+            break
+
+        room = f"{room_name}-{game}"
+        async with connect(urls[shard_for(room, len(urls))], max_size=None) as websocket:
+            actions += await play_game(websocket, room, deadline, rng)
+
+    return actions
+
+async def play_game(websocket, room: str, deadline: float, rng: random.Random) -> int:
+    '''
+    Play a game in a new room until it ends, stalls or the deadline passes.
+    Returns the number of actions taken.
+    '''
+    async def command(message: dict, reply_type: str) -> dict:
+        await websocket.send(json.dumps(message))
+        while True:
+            reply = json.loads(await websocket.recv())
+            if reply["type"] in (reply_type, "error"):
+                return reply
+
+    actions = 0
+    await command({"command": "create_room", "room_name": room, "username": "p0"}, "game_state_update")
+    await command({"command": "join_room", "room_name": room, "username": "p1"}, "game_state_update")
+    await command({"command": "begin_game", "room_name": room}, "game_state_update")
+
+    turn = 0
+    while time.monotonic() < deadline:
+        player_id = f"p{turn % 2}"
+        legal = await command({"command": "legal_actions", "room_name": room,
+                               "username": player_id}, "legal_actions")
+        if legal["type"] == "error" or not legal["actions"]:
+            break
+
+        choice = rng.choice(legal["actions"])
+        state = await command({"command": "action", "room_name": room, "username": player_id,
+                               **choice}, "game_state_update")
+        if state["type"] == "error":
+            break
+
+        actions += 1
+        turn += 1
+        if state["gameStateDelta"]["game"]["winner"] is not None:
+            break
+
+    return actions
+
+def _play_rooms(urls: list[str], room_names: list[str], duration: float, seed: int) -> int:
+    async def play():
+        deadline = time.monotonic() + duration
+        results = await asyncio.gather(*(
+            play_room(urls, room_name, deadline, seed + index)
+            for index, room_name in enumerate(room_names)
+        ))
+        return sum(results)
+
+    return asyncio.run(play())
+
+def cpu_seconds(pid: int) -> float | None:
+    '''
+    The CPU time a process has used, or None where /proc isn't available.
+    '''
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # The fields after the command, which may contain spaces
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def play(urls: list[str], rooms: list[str], duration: float, client_processes: int,
+         seed: int) -> float:
+    '''
+    Play games in the rooms from several processes. Returns the actions per second.
+    '''
+    chunks = [rooms[index::client_processes] for index in range(client_processes)]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=client_processes) as pool:
+        actions = sum(pool.map(_play_rooms, [urls] * len(chunks), chunks,
+                               [duration] * len(chunks), [seed] * len(chunks)))
+    return actions / (time.perf_counter() - start)
+
+def run(num_workers: int, num_rooms: int, duration: float, client_processes: int,
+        port: int, seed: int) -> tuple[float, float | None, float]:
+    '''
+    Start a sharded server and measure how many actions per second it takes
+    through the router, the share of a core the router was busy for, and
+    how many actions per second the shards take without it.
+    '''
+    server = subprocess.Popen(
+        [sys.executable, "-m", "server.shards", "--workers", str(num_workers),
+         "--host", "127.0.0.1", "--port", str(port), "--base-port", str(port + 1)],
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port("127.0.0.1", port)
+        for index in range(num_workers):
+            wait_for_port("127.0.0.1", port + 1 + index)
+
+        # The router is the server process itself, and the shards its children
+        started = cpu_seconds(server.pid)
+        start = time.perf_counter()
+        routed = play([f"ws://127.0.0.1:{port}/ws"], [f"routed-{seed}-{index}" for index in range(num_rooms)],
+                      duration, client_processes, seed)
+        elapsed = time.perf_counter() - start
+        router_busy = (cpu_seconds(server.pid) - started) / elapsed if started is not None else None
+
+        direct = play([f"ws://127.0.0.1:{port + 1 + index}/ws" for index in range(num_workers)],
+                      [f"direct-{seed}-{index}" for index in range(num_rooms)],
+                      duration, client_processes, seed)
+
+        return routed, router_busy, direct
+    finally:
+        server.terminate()
+        server.wait()
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the sharded server.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="numbers of shards to measure")
+    parser.add_argument("--rooms", type=int, default=64, help="rooms played at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to play for")
+    parser.add_argument("--client-processes", type=int, default=2, help="processes playing the rooms")
+    parser.add_argument("--port", type=int, default=8500, help="port of the router")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print(f"{os.cpu_count()} cores")
+    baseline = None
+    for num_workers in args.workers:
+        throughput, router_busy, direct = run(num_workers, args.rooms, args.duration,
+                                              args.client_processes, args.port, args.seed)
+        baseline = baseline or throughput / num_workers
+        print(f"{num_workers} shards: {throughput:,.0f} actions/s "
+              f"({throughput / (baseline * num_workers):.0%} of linear)")
+
+        # The router is the limit if it is busy for all of a core, or the
+        # shards take many more actions without it
+        busy = f"{router_busy:.0%} of a core" if router_busy is not None else "unknown"
+        print(f"  router busy: {busy}, without the router: {direct:,.0f} actions/s "
+              f"(router at {throughput / direct:.0%} of direct)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+'''
+Measure the turn timers with many active rooms.
+
+Arms a turn timer for every room on the server's timer wheel, and reports
+the time to re-arm one as its turn advances and to cancel one, the memory
+each takes, and the time to process each tick as turns run out and are
+timed again, as a share of a core. The same is measured for a call_later
+handle per room on the event loop, for comparison:
+
+    python -m benchmarks.timers --rooms 100000 --turn-seconds 60
+'''
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+
+from server.timers import TimerWheel
+
+class Clock:
+    '''
+    A clock that only moves when told to.
+    '''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def allocated(function) -> int:
+    '''
+    The bytes still allocated after calling a function.
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+def wheel(num_rooms: int, turn_seconds: float, tick: float, seconds: float, seed: int) -> None:
+    rng = random.Random(seed)
+    clock = Clock()
+    rooms = [f"room-{index}" for index in range(num_rooms)]
+
+    def timed_out(room_name, turn):
+        # The turn is passed, and the next one timed
+        timers.arm(room_name, turn_seconds, turn + 1)
+
+    timers = TimerWheel(timed_out, tick=tick, clock=clock)
+
+    def arm_all():
+        # Rooms part way through their turns
+        for room_name in rooms:
+            timers.arm(room_name, rng.uniform(0, turn_seconds), 0)
+
+    size = allocated(arm_all)
+    print("timer wheel")
+    print(f"  memory:   {size / num_rooms:8.1f} bytes per room")
+
+    sample = rng.sample(rooms, min(num_rooms, 10000))
+    start = time.perf_counter()
+    for room_name in sample:
+        timers.arm(room_name, turn_seconds, 1)
+    print(f"  re-arm:   {(time.perf_counter() - start) / len(sample) * 1e6:8.3f} us")
+
+    start = time.perf_counter()
+    for room_name in sample:
+        timers.cancel(room_name)
+    print(f"  cancel:   {(time.perf_counter() - start) / len(sample) * 1e6:8.3f} us")
+    for room_name in sample:
+        timers.arm(room_name, rng.uniform(0, turn_seconds), 0)
+
+    # Run the clock, with every turn running out
+    ticks = int(seconds / tick)
+    elapsed = []
+    for _ in range(ticks):
+        clock.now += tick
+        start = time.perf_counter()
+        timers.advance()
+        elapsed.append(time.perf_counter() - start)
+
+    elapsed.sort()
+    print(f"  tick:     {sum(elapsed) / ticks * 1e6:8.1f} us mean, {elapsed[int(ticks * 0.99)] * 1e6:.1f} us p99, "
+          f"{timers.fired / ticks:.0f} timeouts per tick")
+    print(f"  overhead: {sum(elapsed) / (ticks * tick):8.3%} of a core")
+
+async def call_later(num_rooms: int, turn_seconds: float, seed: int) -> None:
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    rooms = [f"room-{index}" for index in range(num_rooms)]
+    handles = {}
+
+    def timed_out():
+        pass
+
+    def arm_all():
+        for room_name in rooms:
+            handles[room_name] = loop.call_later(rng.uniform(0, turn_seconds), timed_out)
+
+    size = allocated(arm_all)
+    print("call_later per room")
+    print(f"  memory:   {size / num_rooms:8.1f} bytes per room")
+
+    sample = rng.sample(rooms, min(num_rooms, 10000))
+    start = time.perf_counter()
+    for room_name in sample:
+        handles[room_name].cancel()
+        handles[room_name] = loop.call_later(turn_seconds, timed_out)
+    print(f"  re-arm:   {(time.perf_counter() - start) / len(sample) * 1e6:8.3f} us")
+
+    start = time.perf_counter()
+    for room_name in sample:
+        handles[room_name].cancel()
+    print(f"  cancel:   {(time.perf_counter() - start) / len(sample) * 1e6:8.3f} us")
+
+    # Turns of the loop, which has to keep its heap of every room's timer
+    # in order, and run those that are due
+    start = time.perf_counter()
+    for _ in range(100):
+        await asyncio.sleep(0)
+    print(f"  loop run: {(time.perf_counter() - start) / 100 * 1e6:8.1f} us")
+
+    for handle in handles.values():
+        handle.cancel()
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the turn timers with many active rooms.")
+    parser.add_argument("--rooms", type=int, default=100000, help="rooms with a turn being timed")
+    parser.add_argument("--turn-seconds", type=float, default=60, help="time allowed for each turn")
+    parser.add_argument("--tick", type=float, default=0.1, help="seconds between ticks of the wheel")
+    parser.add_argument("--seconds", type=float, default=120, help="simulated seconds to run the clock for")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print(f"{args.rooms:,} rooms, {args.turn_seconds:g}s turns")
+    wheel(args.rooms, args.turn_seconds, args.tick, args.seconds, args.seed)
+    asyncio.run(call_later(args.rooms, args.turn_seconds, args.seed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+'''
+Benchmark the server's write-ahead log: the cost of logging each action, and
+the time to recover every room after a crash.
+
+    python -m benchmarks.wal --rooms 10000 --actions 40
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from core.catalog import Catalog
+from core.game import Game, WinException
+from core.simulate import random_policy
+from server.wal import ActionLog, deal_record
+
+def populate(log: ActionLog, num_rooms: int, num_actions: int, seed: int,
+             snapshot_at: float | None) -> dict[str, Game]:
+    '''
+    Play random games in many rooms, logging every change the way the server
+    does. A snapshot is taken once the given fraction of the rooms are done.
+    '''
+    catalog = Catalog.default()
+    rng = random.Random(seed)
+    games = {}
+
+    for index in range(num_rooms):
+        room_name = f"room{index}"
+        games[room_name] = Game().add_player("p0")
+        log.append("create", room_name, player="p0")
+        games[room_name].add_player("p1")
+        log.append("join", room_name, player="p1")
+
+        game_seed = rng.getrandbits(64)
+        games[room_name].begin(catalog, seed=game_seed)
+        log.append("begin", room_name, seed=game_seed, **deal_record(games[room_name]))
+
+        game = games[room_name]
+        for _ in range(num_actions):
+            if game.winner is not None:
+                break
+
+            player_id = game._get_current_player()
+            choice = random_policy(game, player_id, rng)
+            if choice is None:
+                game.debug_action_pass(player_id)
+                log.append("pass", room_name, player=player_id)
+                continue
+
+            try:
+                game.do_action(choice[0], player_id, **choice[1])
+            except WinException:
+                pass
+            log.append("action", room_name, player=player_id, action=choice[0], args=choice[1])
+
+        if snapshot_at is not None and index + 1 == int(num_rooms * snapshot_at):
+            log.snapshot(games, {})
+
+    log.sync()
+    return games
+
+def logging_overhead(num_actions: int, batch: int, seed: int) -> tuple[float, float]:
+    '''
+    Time taking actions with and without logging them, fsyncing every batch
+    of records. Returns the microseconds per action of both.
+    '''
+    rng = random.Random(seed)
+    catalog = Catalog.default()
+
+    def play(log: ActionLog | None) -> float:
+        game_rng = random.Random(seed)
+        elapsed = 0.0
+        taken = 0
+        while taken < num_actions:
+            game = Game().add_player("p0").add_player("p1").begin(catalog, seed=rng.getrandbits(64))
+            while taken < num_actions and game.winner is None:
+                player_id = game._get_current_player()
+                choice = random_policy(game, player_id, game_rng) or ("pass", {})
+
+                start = time.perf_counter()
+                try:
+                    if choice[0] == "pass":
+                        game.debug_action_pass(player_id)
+                    else:
+                        game.do_action(choice[0], player_id, **choice[1])
+                except WinException:
+                    pass
+                if log is not None:
+                    log.append("action", "room", player=player_id, action=choice[0], args=choice[1])
+                    if log.seq % batch == 0:
+                        log.sync()
+                elapsed += time.perf_counter() - start
+                taken += 1
+
+        return elapsed / num_actions * 1e6
+
+    without = play(None)
+    with tempfile.TemporaryDirectory() as directory:
+        log = ActionLog(directory)
+        log.recover(catalog)
+        with_log = play(log)
+        log.close()
+
+    return without, with_log
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the write-ahead log.")
+    parser.add_argument("--rooms", type=int, default=10000, help="number of rooms to recover")
+    parser.add_argument("--actions", type=int, default=40, help="actions taken in each room")
+    parser.add_argument("--overhead-actions", type=int, default=20000,
+                        help="actions to time the logging overhead over")
+    parser.add_argument("--batch", type=int, default=64, help="records per fsync")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    without, with_log = logging_overhead(args.overhead_actions, args.batch, args.seed)
+    print(f"Action: {without:.1f}us, logged: {with_log:.1f}us "
+          f"(+{with_log - without:.1f}us per action, fsync every {args.batch})")
+
+    catalog = Catalog.default()
+    for name, snapshot_at in (("log only", None), ("snapshot + tail", 0.9)):
+        with tempfile.TemporaryDirectory() as directory:
+            log = ActionLog(directory)
+            log.recover(catalog)
+            games = populate(log, args.rooms, args.actions, args.seed, snapshot_at)
+            log.close()
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+            start = time.perf_counter()
+            recovered, _ = ActionLog(directory).recover(catalog)
+            elapsed = time.perf_counter() - start
+
+            if any(repr(recovered[room_name]) != repr(game) for room_name, game in games.items()):
+                raise AssertionError("The recovered rooms differ from the originals")
+
+            print(f"Recover {args.rooms} rooms ({name}, {size / 1e6:.1f} MB on disk): {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    main()
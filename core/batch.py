@@ -0,0 +1,509 @@
+'''
+A vectorized engine that plays thousands of games in lockstep, for balance
+testing at a throughput that Game's per-game dictionaries can't reach.
+
+The games are held as NumPy arrays, and every step applies one action to
+each game that hasn't finished. The rules are the same as Game's, which can
+be proven by running with --cross-check, replaying every game through Game
+and comparing the two after every step:
+
+    python -m core.batch --games 4096 --players 2 --cross-check 64
+
+Actions are integers. Purchases always use the least gold possible.
+'''
+import argparse
+import random
+import time
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("The batch engine requires numpy, install it with `pip install numpy`") from e
+
+from core.catalog import Catalog, GEM_COLORS, GOLD
+from core.game import Game, WinException, DIFFERENT_COLOR_CHOICES
+
+NUM_TIERS = 3
+NUM_REVEALED = 4
+MAX_RESERVATIONS = 3
+
+# The action space
+TAKE_DIFFERENT = 0
+TAKE_SAME = TAKE_DIFFERENT + len(DIFFERENT_COLOR_CHOICES)
+RESERVE_VISIBLE = TAKE_SAME + len(GEM_COLORS)
+RESERVE_HIDDEN = RESERVE_VISIBLE + NUM_TIERS * NUM_REVEALED
+PURCHASE_VISIBLE = RESERVE_HIDDEN + NUM_TIERS
+PURCHASE_RESERVED = PURCHASE_VISIBLE + NUM_TIERS * NUM_REVEALED
+PASS = PURCHASE_RESERVED + MAX_RESERVATIONS
+NUM_ACTIONS = PASS + 1
+
+# The colors taken by each take_different action
+DIFFERENT_COLORS = np.array([
+    [color in colors for color in GEM_COLORS] for colors in DIFFERENT_COLOR_CHOICES
+], dtype=np.int16)
+
+class CrossCheckError(Exception):
+    '''
+    An exception to be raised when the batch engine and Game disagree.
+    '''
+    pass
+
+class BatchEngine:
+    '''
+    A batch of games with the same number of players, held as arrays with
+    the game as the leading axis.
+
+    Attributes:
+        bank (np.ndarray): (games, colors) tokens left in the bank.
+        wallet (np.ndarray): (games, players, colors) tokens held.
+        discounts (np.ndarray): (games, players, gem colors) discounts held.
+        score (np.ndarray): (games, players) score from developments.
+        developments (np.ndarray): (games, players, cards) cards developed.
+        reserved (np.ndarray): (games, players, 3) reserved card ids, -1 for
+            an empty slot.
+        attained_collection (np.ndarray): (games, players) collection id, -1
+            for none.
+        visible (np.ndarray): (games, tiers, 4) revealed card ids, -1 for an
+            empty slot.
+        hidden (np.ndarray): (games, tiers, cards) hidden card ids, drawn from
+            the end.
+        hidden_count (np.ndarray): (games, tiers) cards left in each hidden
+            deck.
+        collections_in_play (np.ndarray): (games, 5) collection ids.
+        turn (np.ndarray): (games,) turns taken.
+        winner (np.ndarray): (games,) winning player, -1 while playing.
+        seeds (list[int]): The seed each game was dealt with.
+    '''
+    def __init__(self, num_games: int, num_players: int, seed: int = 0,
+                 catalog: Catalog | None = None):
+        '''
+        Deal a batch of games. Game i is dealt exactly as Game.begin() would
+        deal it with seed + i.
+
+        Args:
+            num_games (int): The number of games.
+            num_players (int): The number of players in each game.
+            seed (int): The seed of the first game.
+            catalog (Catalog | None): The glossary of cards and collections to
+                play with. Defaults to the catalog shipped with the game.
+        '''
+        if not 1 <= num_players <= 4:
+            raise ValueError("Must have between 1 and 4 players")
+
+        self.catalog = catalog if catalog is not None else Catalog.default()
+        self.num_games = num_games
+        self.num_players = num_players
+        self.seeds = [seed + i for i in range(num_games)]
+        self.tiers = list(self.catalog.tiers)
+
+        # The catalog, as arrays
+        self.card_price = np.array(self.catalog.card_price, dtype=np.int16)[:, :GOLD]
+        self.card_price_by_color = np.ascontiguousarray(self.card_price.T)
+        self.card_discount = np.array(self.catalog.card_discount, dtype=np.int16)
+        self.card_score = np.array(self.catalog.card_score, dtype=np.int16)
+        self.collection_score = np.array(self.catalog.collection_score, dtype=np.int16)
+        self.collection_trigger = np.zeros((len(self.catalog.collections), GOLD), dtype=np.int16)
+        for collection_id, trigger in enumerate(self.catalog.collection_trigger):
+            for color_code, count in trigger:
+                self.collection_trigger[collection_id, color_code] = count
+
+        num_cards = len(self.catalog.cards)
+        deck_size = max(len(card_ids) for card_ids in self.catalog.tiers.values())
+
+        self.bank = np.tile(np.array([7, 7, 7, 7, 7, 5], dtype=np.int16), (num_games, 1))
+        self.wallet = np.zeros((num_games, num_players, GOLD + 1), dtype=np.int16)
+        self.discounts = np.zeros((num_games, num_players, GOLD), dtype=np.int16)
+        self.score = np.zeros((num_games, num_players), dtype=np.int16)
+        self.developments = np.zeros((num_games, num_players, num_cards), dtype=bool)
+        self.reserved = np.full((num_games, num_players, MAX_RESERVATIONS), -1, dtype=np.int16)
+        self.attained_collection = np.full((num_games, num_players), -1, dtype=np.int16)
+        self.visible = np.full((num_games, NUM_TIERS, NUM_REVEALED), -1, dtype=np.int16)
+        self.hidden = np.full((num_games, NUM_TIERS, deck_size), -1, dtype=np.int16)
+        self.hidden_count = np.zeros((num_games, NUM_TIERS), dtype=np.int16)
+        self.collections_in_play = np.zeros((num_games, 5), dtype=np.int16)
+        self.turn = np.zeros(num_games, dtype=np.int32)
+        self.winner = np.full(num_games, -1, dtype=np.int16)
+        self._legal_mask = None
+
+        for game, game_seed in enumerate(self.seeds):
+            decks, collections_in_play = self.catalog.deal(random.Random(game_seed))
+            for tier_index, tier in enumerate(self.tiers):
+                visible = decks[tier]["visible"]
+                hidden = decks[tier]["hidden"]
+                self.visible[game, tier_index, :len(visible)] = visible
+                self.hidden[game, tier_index, :len(hidden)] = hidden
+                self.hidden_count[game, tier_index] = len(hidden)
+            self.collections_in_play[game] = collections_in_play
+
+    @property
+    def done(self) -> np.ndarray:
+        '''
+        Whether each game is over.
+        '''
+        return self.winner >= 0
+
+    def _payment(self, games: np.ndarray, players: np.ndarray,
+                 cards: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Get the price of one card in each of n games after discounts, and the
+        shortfall of each color that must be paid in gold, as (n, colors).
+        '''
+        effective = np.maximum(0, self.card_price[cards] - self.discounts[games, players])
+        shortfall = np.maximum(0, effective - self.wallet[games, players, :GOLD])
+        return effective, shortfall
+
+    def _gold_needed(self, games: np.ndarray, players: np.ndarray,
+                     cards: np.ndarray) -> np.ndarray:
+        '''
+        Get the gold needed to purchase cards of shape (n, m) in n games.
+        Works a color at a time, since reducing over a short trailing axis of
+        colors is far slower than adding a few (n, m) arrays.
+        '''
+        discounts = self.discounts[games, players]
+        wallet = self.wallet[games, players]
+        needed = np.zeros(cards.shape, dtype=np.int16)
+        for code in range(GOLD):
+            owed = np.take(self.card_price_by_color[code], cards) - discounts[:, code, None]
+            np.maximum(owed, 0, out=owed)
+            owed -= wallet[:, code, None]
+            np.maximum(owed, 0, out=owed)
+            needed += owed
+        return needed
+
+    def legal_mask(self) -> np.ndarray:
+        '''
+        Get which actions are legal in each game. The mask is computed once
+        per step, and must not be modified.
+
+        Returns:
+            np.ndarray: (games, actions) of whether each action is legal. Games
+                that are over have no legal actions. Passing is only legal if
+                nothing else is.
+        '''
+        if self._legal_mask is not None:
+            return self._legal_mask
+
+        games = np.arange(self.num_games)
+        players = self.turn % self.num_players
+        wallet = self.wallet[games, players]
+        tokens = wallet.sum(axis=1)
+        bank = self.bank[:, :GOLD]
+        mask = np.zeros((self.num_games, NUM_ACTIONS), dtype=bool)
+
+        mask[:, TAKE_DIFFERENT:TAKE_SAME] = (tokens <= 7)[:, None] & (
+            (bank > 0).astype(np.int16) @ DIFFERENT_COLORS.T == 3
+        )
+        mask[:, TAKE_SAME:RESERVE_VISIBLE] = (tokens <= 8)[:, None] & (bank >= 4)
+
+        reservations = (self.reserved[games, players] >= 0).sum(axis=1)
+        can_reserve = (reservations < MAX_RESERVATIONS) & (tokens <= 9)
+        visible = self.visible.reshape(self.num_games, -1)
+        mask[:, RESERVE_VISIBLE:RESERVE_HIDDEN] = can_reserve[:, None] & (visible >= 0)
+        mask[:, RESERVE_HIDDEN:PURCHASE_VISIBLE] = can_reserve[:, None] & (self.hidden_count > 0)
+
+        cards = np.concatenate([visible, self.reserved[games, players]], axis=1)
+        mask[:, PURCHASE_VISIBLE:PASS] = (cards >= 0) & (
+            self._gold_needed(games, players, cards) <= wallet[:, None, GOLD]
+        )
+
+        mask[:, PASS] = ~mask[:, :PASS].any(axis=1)
+        mask[self.done] = False
+
+        self._legal_mask = mask
+        return mask
+
+    def step(self, actions: np.ndarray) -> None:
+        '''
+        Take one action in every game that isn't over.
+
+        Args:
+            actions (np.ndarray): (games,) the action to take in each game.
+                Ignored for games that are over.
+        '''
+        actions = np.asarray(actions)
+        games = np.nonzero(~self.done)[0]
+        actions = actions[games]
+        if not self.legal_mask()[games, actions].all():
+            raise ValueError("Illegal action")
+
+        players = self.turn[games] % self.num_players
+        wallet = self.wallet[games, players]
+        delta = np.zeros_like(wallet)
+        cards = np.full(len(games), -1, dtype=np.int16)
+
+        # Take tokens
+        taking = actions < TAKE_SAME
+        delta[taking, :GOLD] += DIFFERENT_COLORS[actions[taking]]
+        taking = np.nonzero((actions >= TAKE_SAME) & (actions < RESERVE_VISIBLE))[0]
+        delta[taking, actions[taking] - TAKE_SAME] += 2
+
+        # Take cards from the table, replacing them from the hidden deck
+        from_table = ((actions >= RESERVE_VISIBLE) & (actions < RESERVE_HIDDEN)) | (
+            (actions >= PURCHASE_VISIBLE) & (actions < PURCHASE_RESERVED))
+        slots = np.where(actions < RESERVE_HIDDEN, actions - RESERVE_VISIBLE,
+                         actions - PURCHASE_VISIBLE)[from_table]
+        tiers, slots = slots // NUM_REVEALED, slots % NUM_REVEALED
+        table_games = games[from_table]
+        cards[from_table] = self.visible[table_games, tiers, slots]
+        self.visible[table_games, tiers, slots] = self._draw(table_games, tiers)
+
+        # Take cards from the top of the hidden deck
+        from_hidden = (actions >= RESERVE_HIDDEN) & (actions < PURCHASE_VISIBLE)
+        cards[from_hidden] = self._draw(games[from_hidden], actions[from_hidden] - RESERVE_HIDDEN)
+
+        # Reserve cards, taking a gold token if there are any left
+        reserving = (actions >= RESERVE_VISIBLE) & (actions < PURCHASE_VISIBLE)
+        reserve_games, reserve_players = games[reserving], players[reserving]
+        free = np.argmax(self.reserved[reserve_games, reserve_players] < 0, axis=1)
+        self.reserved[reserve_games, reserve_players, free] = cards[reserving]
+        delta[reserving, GOLD] += self.bank[reserve_games, GOLD] > 0
+
+        # Take cards from reservations
+        from_reserved = (actions >= PURCHASE_RESERVED) & (actions < PASS)
+        reserved_games, reserved_players = games[from_reserved], players[from_reserved]
+        reserved_slots = actions[from_reserved] - PURCHASE_RESERVED
+        cards[from_reserved] = self.reserved[reserved_games, reserved_players, reserved_slots]
+        self.reserved[reserved_games, reserved_players, reserved_slots] = -1
+
+        # Purchase cards, using gold only for what the player is short of
+        purchasing = (actions >= PURCHASE_VISIBLE) & (actions < PASS)
+        purchase_games, purchase_players = games[purchasing], players[purchasing]
+        purchased = cards[purchasing]
+        effective, shortfall = self._payment(purchase_games, purchase_players, purchased)
+        delta[purchasing, :GOLD] -= effective - shortfall
+        delta[purchasing, GOLD] -= shortfall.sum(axis=1)
+        self.discounts[purchase_games, purchase_players, self.card_discount[purchased]] += 1
+        self.score[purchase_games, purchase_players] += self.card_score[purchased]
+        self.developments[purchase_games, purchase_players, purchased] = True
+
+        self.wallet[games, players] += delta
+        self.bank[games] -= delta
+
+        # Check for win condition, before collections are assigned
+        collections = self.attained_collection[games, players]
+        score = self.score[games, players] + np.where(
+            collections >= 0, self.collection_score[np.maximum(collections, 0)], 0)
+        won = score >= 15
+        self.winner[games[won]] = players[won]
+
+        # Assign the first eligible collection in play to players whose
+        # discounts changed, if they don't have one
+        checking = purchasing & ~won & (collections < 0)
+        check_games, check_players = games[checking], players[checking]
+        in_play = self.collections_in_play[check_games]
+        eligible = (self.discounts[check_games, check_players][:, None, :]
+                    >= self.collection_trigger[in_play]).all(axis=2)
+        attained = eligible.any(axis=1)
+        first = np.argmax(eligible, axis=1)
+        self.attained_collection[check_games[attained], check_players[attained]] = \
+            in_play[attained, first[attained]]
+
+        self.turn[games[~won]] += 1
+        self._legal_mask = None
+
+    def _draw(self, games: np.ndarray, tiers: np.ndarray) -> np.ndarray:
+        '''
+        Draw the top card of the hidden deck of a tier in each game, or -1 if
+        the deck is empty.
+        '''
+        counts = self.hidden_count[games, tiers]
+        has_cards = counts > 0
+        drawn = np.where(has_cards, self.hidden[games, tiers, np.maximum(counts - 1, 0)], -1)
+        self.hidden_count[games, tiers] -= has_cards
+        return drawn
+
+    def random_actions(self, rng: np.random.Generator) -> np.ndarray:
+        '''
+        Choose a legal action uniformly at random in every game.
+        '''
+        mask = self.legal_mask()
+        return np.argmax(rng.random(mask.shape) * mask, axis=1)
+
+    def greedy_actions(self, rng: np.random.Generator) -> np.ndarray:
+        '''
+        Purchase a card if possible, and otherwise act at random.
+        '''
+        mask = self.legal_mask()
+        weights = rng.random(mask.shape) * mask
+        weights[:, PURCHASE_VISIBLE:PASS] += 1
+        return np.argmax(weights * mask, axis=1)
+
+    def describe_action(self, game: int, action: int) -> tuple[str, dict]:
+        '''
+        Translate an action in a game into the arguments Game.do_action()
+        takes, given the game's current state.
+
+        Returns:
+            tuple[str, dict]: The action and its arguments. Passing is
+                described as the action "pass".
+        '''
+        player = self.turn[game] % self.num_players
+
+        if action < TAKE_SAME:
+            return "take_different", {"colors": DIFFERENT_COLOR_CHOICES[action - TAKE_DIFFERENT]}
+        if action < RESERVE_VISIBLE:
+            return "take_same", {"color": GEM_COLORS[action - TAKE_SAME]}
+        if action < RESERVE_HIDDEN:
+            tier, slot = divmod(action - RESERVE_VISIBLE, NUM_REVEALED)
+            return "reserve", {"tier": self.tiers[tier], "card_id": int(self.visible[game, tier, slot])}
+        if action < PURCHASE_VISIBLE:
+            return "reserve", {"tier": self.tiers[action - RESERVE_HIDDEN], "card_id": None}
+        if action == PASS:
+            return "pass", {}
+
+        if action < PURCHASE_RESERVED:
+            tier, slot = divmod(action - PURCHASE_VISIBLE, NUM_REVEALED)
+            card_id = int(self.visible[game, tier, slot])
+        else:
+            card_id = int(self.reserved[game, player, action - PURCHASE_RESERVED])
+
+        _, shortfall = self._payment(np.array([game]), np.array([player]), np.array([card_id]))
+        gold_usage = [color for code, color in enumerate(GEM_COLORS)
+                      for _ in range(shortfall[0, code])]
+        return "purchase", {"card_id": card_id, "gold_usage": gold_usage}
+
+    def summary(self, game: int) -> dict:
+        '''
+        Summarize the state of a game in a form that can be compared with
+        summarize_game(). Card orders are not compared, since the batch engine
+        keeps cards in fixed slots.
+        '''
+        return {
+            "bank": self.bank[game].tolist(),
+            "players": [
+                {
+                    "wallet": self.wallet[game, player].tolist(),
+                    "developments": np.nonzero(self.developments[game, player])[0].tolist(),
+                    "reservations": sorted(int(card_id) for card_id in self.reserved[game, player] if card_id >= 0),
+                    "attained_collection": int(self.attained_collection[game, player]) if self.attained_collection[game, player] >= 0 else None,
+                }
+                for player in range(self.num_players)
+            ],
+            "decks": [
+                {
+                    "visible": sorted(int(card_id) for card_id in self.visible[game, tier] if card_id >= 0),
+                    "hidden_count": int(self.hidden_count[game, tier]),
+                }
+                for tier in range(NUM_TIERS)
+            ],
+            "turn": int(self.turn[game]),
+            "winner": int(self.winner[game]) if self.winner[game] >= 0 else None,
+        }
+
+def summarize_game(game: Game) -> dict:
+    '''
+    Summarize the state of a Game in the same form as BatchEngine.summary().
+    '''
+    player_ids = list(game.players)
+    return {
+        "bank": list(game.bank),
+        "players": [
+            {
+                "wallet": list(player.wallet),
+                "developments": sorted(player.developments),
+                "reservations": sorted(player.reservations),
+                "attained_collection": player.attained_collection,
+            }
+            for player in game.players.values()
+        ],
+        "decks": [
+            {
+                "visible": sorted(deck.visible),
+                "hidden_count": len(deck.hidden),
+            }
+            for deck in game.decks.values()
+        ],
+        "turn": game.turn,
+        "winner": player_ids.index(game.winner) if game.winner is not None else None,
+    }
+
+def cross_check(num_games: int, num_players: int, max_steps: int = 500, seed: int = 0,
+                policy: str = "random") -> int:
+    '''
+    Play a batch of games, replaying every action through Game and comparing
+    the two engines after every step.
+
+    Returns:
+        int: The number of actions compared.
+
+    Raises:
+        CrossCheckError: If the engines disagree.
+    '''
+    engine = BatchEngine(num_games, num_players, seed=seed)
+    rng = np.random.default_rng(seed)
+    references = []
+    for game_seed in engine.seeds:
+        game = Game()
+        for player in range(num_players):
+            game.add_player(f"p{player}")
+        references.append(game.begin(engine.catalog, seed=game_seed))
+
+    compared = 0
+    for _ in range(max_steps):
+        if engine.done.all():
+            break
+
+        actions = getattr(engine, f"{policy}_actions")(rng)
+        live = np.nonzero(~engine.done)[0]
+        described = {game: engine.describe_action(game, actions[game]) for game in live}
+        engine.step(actions)
+
+        for game in live:
+            reference = references[game]
+            action, kwargs = described[game]
+            player_id = reference._get_current_player()
+
+            try:
+                if action == "pass":
+                    reference.debug_action_pass(player_id)
+                else:
+                    reference.do_action(action, player_id, **kwargs)
+            except WinException:
+                pass
+
+            if engine.summary(game) != summarize_game(reference):
+                raise CrossCheckError(
+                    f"Game {game} (seed {engine.seeds[game]}) diverged after {action} {kwargs}: "
+                    f"{engine.summary(game)} != {summarize_game(reference)}"
+                )
+            compared += 1
+
+    return compared
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Play a batch of games in lockstep.")
+    parser.add_argument("--games", type=int, default=4096, help="number of games to play")
+    parser.add_argument("--players", type=int, default=2, help="number of players in each game")
+    parser.add_argument("--policy", choices=["random", "greedy"], default="greedy")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--max-steps", type=int, default=500, help="steps before stopping")
+    parser.add_argument("--cross-check", type=int, default=0, metavar="GAMES",
+                        help="also replay this many games through Game and compare")
+    args = parser.parse_args(argv)
+
+    engine = BatchEngine(args.games, args.players, seed=args.seed)
+    rng = np.random.default_rng(args.seed)
+    choose = getattr(engine, f"{args.policy}_actions")
+
+    actions = 0
+    start = time.perf_counter()
+    for _ in range(args.max_steps):
+        if engine.done.all():
+            break
+        actions += int((~engine.done).sum())
+        engine.step(choose(rng))
+    elapsed = time.perf_counter() - start
+
+    finished = int(engine.done.sum())
+    print(f"{args.games} games in {elapsed:.2f}s ({finished / elapsed:.1f} finished games/s, "
+          f"{actions / elapsed:.0f} actions/s)")
+    print(f"Finished: {finished}, mean turns: {engine.turn[engine.done].mean() if finished else 0:.1f}")
+    for player in range(args.players):
+        print(f"Seat {player}: {int((engine.winner == player).sum())} wins")
+
+    if args.cross_check:
+        compared = cross_check(args.cross_check, args.players, args.max_steps, args.seed, args.policy)
+        print(f"Cross-check passed: {compared} actions agreed with Game")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+'''
+A bot player that chooses its actions with Monte Carlo tree search.
+
+Only the order of the hidden decks is unknown to a player, so every
+iteration of the search is played on a determinization of the game: a copy
+with the hidden decks reshuffled. The statistics of every determinization
+are shared in one tree, keyed by action, with an action's exploration term
+counting only the iterations it was available in.
+'''
+import copy
+import math
+import random
+import time
+
+from core.game import Game
+
+# The exploration constant of UCB1
+EXPLORATION = 0.7
+
+# The number of actions a rollout plays before its game is scored
+ROLLOUT_DEPTH = 30
+
+def _key(action: str, kwargs: dict) -> tuple:
+    '''
+    Get a hashable key for an action.
+    '''
+    return (action, tuple(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in sorted(kwargs.items())
+    ))
+
+def _actions(game: Game, player_id: str) -> list[tuple[str, dict]]:
+    '''
+    Get the legal actions of a player, passing if there are none.
+    '''
+    return game.legal_actions(player_id) or [("pass", {})]
+
+def _rewards(game: Game) -> dict[str, float]:
+    '''
+    Score a game for every player between 0 and 1. A finished game is a win
+    or a loss, otherwise players are rewarded for leading on points.
+    '''
+    if game.winner is not None:
+        return {player_id: float(player_id == game.winner) for player_id in game.players}
+
+    scores = {player_id: game._get_player_score(player_id) for player_id in game.players}
+    rewards = {}
+    for player_id, score in scores.items():
+        best_other = max((other for other_id, other in scores.items() if other_id != player_id), default=0)
+        rewards[player_id] = min(1.0, max(0.0, 0.5 + (score - best_other) / 30))
+
+    return rewards
+
+def _rollout_action(game: Game, player_id: str, rng: random.Random) -> tuple[str, dict]:
+    '''
+    Choose an action for a rollout: the best purchase if there is one,
+    otherwise any action at random.
+    '''
+    actions = _actions(game, player_id)
+    purchases = [action for action in actions if action[0] == "purchase"]
+    if purchases:
+        return max(purchases, key=lambda action: (
+            game.catalog.card_score[action[1]["card_id"]], rng.random()
+        ))
+
+    return rng.choice(actions)
+
+class Node:
+    '''
+    A node in the search tree.
+
+    Attributes:
+        player_id (str | None): The player who took the action into the node.
+        children (dict[tuple, Node]): The child nodes, keyed by action.
+        visits (int): The number of iterations through the node.
+        value (float): The total reward of player_id over those iterations.
+        availability (int): The number of iterations the node's action was
+            available in.
+    '''
+    __slots__ = ("player_id", "children", "visits", "value", "availability")
+
+    def __init__(self, player_id: str | None = None):
+        self.player_id = player_id
+        self.children = {}
+        self.visits = 0
+        self.value = 0.0
+        self.availability = 0
+
+    def ucb(self) -> float:
+        return (self.value / self.visits
+                + EXPLORATION * math.sqrt(math.log(self.availability) / self.visits))
+
+def choose_action(game: Game, player_id: str, iterations: int | None = None,
+                  time_limit: float | None = 1.0, seed: int | None = None) -> tuple[str, dict]:
+    '''
+    Choose an action for a player with Monte Carlo tree search.
+
+    The game is not modified. At least one iteration is always run.
+
+    Args:
+        game (Game): The game being played. Must be the player's turn.
+        player_id (str): The player to choose for.
+        iterations (int | None): The most iterations to run.
+        time_limit (float | None): The most seconds to think for.
+        seed (int | None): The seed for the determinizations and rollouts.
+
+    Returns:
+        tuple[str, dict]: The chosen action and its arguments. The action
+            "pass" means there are no legal actions.
+    '''
+    actions = _actions(game, player_id)
+    if len(actions) == 1:
+        return actions[0]
+
+    # Search on a copy, since every iteration reshuffles the hidden decks
+    rng = random.Random(seed)
+    game = copy.deepcopy(game)
+    root = Node()
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    iteration = 0
+
+    while iteration == 0 or (
+        (iterations is None or iteration < iterations)
+        and (deadline is None or time.perf_counter() < deadline)
+    ):
+        iteration += 1
+        for deck in game.decks.values():
+            rng.shuffle(deck.hidden)
+
+        records = []
+        path = [root]
+        node = root
+
+        # Select actions through the tree, until reaching an action that
+        # hasn't been tried yet
+        while game.winner is None:
+            current = game._get_current_player()
+            available = _actions(game, current)
+            untried = []
+            for action, kwargs in available:
+                child = node.children.get(_key(action, kwargs))
+                if child is None:
+                    untried.append((action, kwargs))
+                else:
+                    child.availability += 1
+
+            if untried:
+                action, kwargs = rng.choice(untried)
+                child = node.children[_key(action, kwargs)] = Node(current)
+                child.availability += 1
+                records.append(game.make_action(action, current, **kwargs))
+                path.append(child)
+                break
+
+            action, kwargs = max(available, key=lambda a: node.children[_key(*a)].ucb())
+            node = node.children[_key(action, kwargs)]
+            records.append(game.make_action(action, current, **kwargs))
+            path.append(node)
+
+        # Play out the rest of the game, up to a point
+        for _ in range(ROLLOUT_DEPTH):
+            if game.winner is not None:
+                break
+
+            current = game._get_current_player()
+            action, kwargs = _rollout_action(game, current, rng)
+            records.append(game.make_action(action, current, **kwargs))
+
+        rewards = _rewards(game)
+        for node in path:
+            node.visits += 1
+            if node.player_id is not None:
+                node.value += rewards[node.player_id]
+
+        for record in reversed(records):
+            game.undo(record)
+
+    return max(actions, key=lambda a: root.children[_key(*a)].visits
+               if _key(*a) in root.children else -1)
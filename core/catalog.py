@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import random
+
+COLORS = ("black", "white", "red", "blue", "green", "gold")
+GEM_COLORS = COLORS[:-1]
+COLOR_CODES = {color: code for code, color in enumerate(COLORS)}
+GOLD = COLOR_CODES["gold"]
+
+# Games keep card and collection ids in byte strings, so there can only be
+# so many of each
+MAX_IDS = 256
+
+DEFAULT_CARDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cards.json')
+DEFAULT_COLLECTIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'collections.json')
+
+class CatalogError(Exception):
+    '''
+    An exception to be raised when the cards or collections files are invalid.
+    '''
+    pass
+
+class Catalog:
+    '''
+    An immutable, validated glossary of every card and collection, compiled
+    once per process and shared by every game.
+
+    Games only keep the ids of the cards in their decks and look everything
+    else up here, so beginning a game does no file I/O and rooms don't each
+    hold their own copy of the glossary.
+
+    Attributes:
+        cards (tuple[dict]): The raw card info, indexed by card id.
+        collections (tuple[dict]): The raw collection info, indexed by
+            collection id.
+        tiers (dict[str, tuple[int]]): The ids of the cards in each tier.
+        card_tier (tuple[str]): The tier of each card.
+        card_discount (tuple[int]): The color code of each card's discount.
+        card_score (tuple[int]): The score of each card.
+        card_price (tuple[tuple[int, ...]]): The price of each card, as a
+            vector indexed by color code.
+        collection_score (tuple[int]): The score of each collection.
+        collection_trigger (tuple[tuple[tuple[int, int], ...]]): The
+            (color code, count) requirements of each collection.
+        content_hash (str): A hash of the catalog's contents.
+        source (tuple[str, str] | None): The files the catalog was loaded
+            from, if any.
+    '''
+    __slots__ = (
+        "cards", "collections", "tiers", "card_tier", "card_discount",
+        "card_score", "card_price", "collection_score", "collection_trigger",
+        "content_hash", "source",
+    )
+
+    _loaded: dict = {}
+
+    def __init__(self, cards_raw: list[dict], collections_raw: list[dict],
+                 source: tuple[str, str] | None = None):
+        '''
+        Compile a catalog from raw card and collection info.
+
+        Args:
+            cards_raw (list[dict]): The raw cards, as found in cards.json.
+            collections_raw (list[dict]): The raw collections, as found in
+                collections.json.
+            source (tuple[str, str] | None): The files the raw info was
+                loaded from, if any.
+        '''
+        cards = tuple(self._compile_card(index, card)
+                      for index, card in enumerate(cards_raw))
+        collections = tuple(self._compile_collection(index, collection)
+                            for index, collection in enumerate(collections_raw))
+
+        if len(cards) > MAX_IDS or len(collections) > MAX_IDS:
+            raise CatalogError(f"Cannot have more than {MAX_IDS} cards or collections")
+
+        # Get the ids of the cards in each tier, in order of tier
+        tiers = {}
+        for card in sorted(cards, key=lambda x: x['tier']):
+            tiers.setdefault(card['tier'], []).append(card['id'])
+
+        # Hash a canonical encoding of the contents, so that clients can tell
+        # whether their copy of the glossary is stale
+        content_hash = hashlib.sha256(json.dumps(
+            [cards, collections], sort_keys=True, separators=(',', ':')
+        ).encode()).hexdigest()
+
+        set_attribute = super().__setattr__
+        set_attribute("cards", cards)
+        set_attribute("collections", collections)
+        set_attribute("tiers", {tier: tuple(ids) for tier, ids in tiers.items()})
+        set_attribute("card_tier", tuple(card['tier'] for card in cards))
+        set_attribute("card_discount", tuple(COLOR_CODES[card['discount']] for card in cards))
+        set_attribute("card_score", tuple(card['score'] for card in cards))
+        set_attribute("card_price", tuple(
+            tuple(card['price'].get(color, 0) for color in COLORS) for card in cards
+        ))
+        set_attribute("collection_score", tuple(collection['score'] for collection in collections))
+        set_attribute("collection_trigger", tuple(
+            tuple((COLOR_CODES[color], count) for color, count in collection['trigger'].items())
+            for collection in collections
+        ))
+        set_attribute("content_hash", content_hash)
+        set_attribute("source", source)
+
+    @staticmethod
+    def _compile_card(index: int, card: dict) -> dict:
+        '''
+        Validate a raw card and normalize it into its glossary form.
+        '''
+        try:
+            tier = str(int(card['tier']))
+            discount = card['discount']
+            score = card['score']
+            price = card['price']
+        except (KeyError, TypeError, ValueError) as e:
+            raise CatalogError(f"Card {index} is malformed: {e}")
+
+        if discount not in GEM_COLORS:
+            raise CatalogError(f"Card {index} has invalid discount {discount}")
+
+        if not isinstance(score, int) or score < 0:
+            raise CatalogError(f"Card {index} has invalid score {score}")
+
+        for color, count in price.items():
+            if color not in GEM_COLORS:
+                raise CatalogError(f"Card {index} has invalid price color {color}")
+
+            if not isinstance(count, int) or count < 0:
+                raise CatalogError(f"Card {index} has invalid {color} price {count}")
+
+        return {**card, 'id': index, 'tier': tier}
+
+    @staticmethod
+    def _compile_collection(index: int, collection: dict) -> dict:
+        '''
+        Validate a raw collection and normalize it into its glossary form.
+        '''
+        try:
+            score = collection['score']
+            trigger = collection['trigger']
+        except (KeyError, TypeError) as e:
+            raise CatalogError(f"Collection {index} is malformed: {e}")
+
+        if not isinstance(score, int) or score < 0:
+            raise CatalogError(f"Collection {index} has invalid score {score}")
+
+        for color, count in trigger.items():
+            if color not in GEM_COLORS:
+                raise CatalogError(f"Collection {index} has invalid trigger color {color}")
+
+            if not isinstance(count, int) or count < 1:
+                raise CatalogError(f"Collection {index} has invalid {color} trigger {count}")
+
+        return {**collection, 'id': index}
+
+    @classmethod
+    def load(cls, cards_file: str, collections_file: str) -> "Catalog":
+        '''
+        Load a catalog from JSON files. Each pair of files is only read and
+        compiled once per process.
+
+        Args:
+            cards_file (str): The path to the JSON file containing the cards.
+            collections_file (str): The path to the JSON file containing the
+                collections.
+
+        Returns:
+            Catalog: The compiled catalog.
+        '''
+        key = (os.path.abspath(cards_file), os.path.abspath(collections_file))
+
+        if key not in cls._loaded:
+            try:
+                with open(key[0], 'r') as f:
+                    cards_raw = json.load(f)
+                with open(key[1], 'r') as f:
+                    collections_raw = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                raise CatalogError(f"Could not load catalog: {e}")
+
+            cls._loaded[key] = cls(cards_raw, collections_raw, source=key)
+
+        return cls._loaded[key]
+
+    @classmethod
+    def default(cls) -> "Catalog":
+        '''
+        Load the catalog shipped alongside the game.
+
+        Returns:
+            Catalog: The compiled catalog.
+        '''
+        return cls.load(DEFAULT_CARDS_FILE, DEFAULT_COLLECTIONS_FILE)
+
+    def has_card(self, card_id) -> bool:
+        '''
+        Check whether a card id exists in the catalog.
+        '''
+        return type(card_id) is int and 0 <= card_id < len(self.cards)
+
+    def deal(self, rng: random.Random = random, num_revealed: int = 4,
+             num_collections: int = 5) -> tuple[dict, list[int]]:
+        '''
+        Shuffle the decks and draw the collections for a new game.
+
+        Args:
+            rng (random.Random): The random number generator to shuffle with.
+            num_revealed (int): The number of cards to reveal from each tier.
+            num_collections (int): The number of collections to draw.
+
+        Returns:
+            tuple[dict, list[int]]: A tuple containing:
+                - dict[str, {visible: list[int], hidden: list[int]}] of the
+                deck of cards, keyed by tier, and
+                - list[int] of the ids of the collections that were drawn.
+        '''
+        decks = {}
+        for tier, card_ids in self.tiers.items():
+            shuffled = rng.sample(card_ids, len(card_ids))
+            decks[tier] = {
+                "visible": shuffled[:num_revealed],
+                "hidden": shuffled[num_revealed:],
+            }
+
+        collections_in_play = rng.sample(range(len(self.collections)), num_collections)
+
+        return decks, collections_in_play
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Catalog is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Catalog is immutable")
+
+    def __copy__(self) -> "Catalog":
+        return self
+
+    def __deepcopy__(self, memo) -> "Catalog":
+        return self
+
+    def __reduce__(self):
+        # Catalogs loaded from files are reloaded (once) in the receiving
+        # process rather than shipped with every pickled game
+        if self.source is not None:
+            return (Catalog.load, self.source)
+
+        return (Catalog, (list(self.cards), list(self.collections)))
+
+    def __repr__(self) -> str:
+        return f"Catalog(cards={len(self.cards)}, collections={len(self.collections)}, hash={self.content_hash[:12]})"
@@ -1,100 +1,13 @@
 import json
-from itertools import groupby
 import random
-import copy
+from itertools import combinations
 
-class CardLoader:
-    '''
-    A static class for loading the decks of cards from a JSON file.
-    
-    Not gonna lie, I'm don't think I should have made this a class, but
-    whatever.
-    '''
-    @staticmethod
-    def load_decks(cards_file: str, num_revealed: int = 4) -> tuple[list, dict]:
-        '''
-        Load the decks from a JSON file.
-        
-        Args:
-            cards_file (str): The path to the JSON file containing the cards.
-            num_revealed (int): The number of cards to reveal from each tier.
-            
-        Returns:
-            tuple[list, dict]: A tuple containing:
-                - list[dict] of raw card info, and
-                - dict[int, {visible: list[int], hidden: list[int]}] of the
-                deck of cards, keyed by tier.
-        '''
-        # Load the raw cards
-        with open(cards_file, 'r') as f:
-            cards_raw = json.load(f)
-        
-        # Add an id to each card
-        for index, card in enumerate(cards_raw):
-            card['id'] = index
-            card['tier'] = str(card['tier'])
-            
-        # Get dictionary of cards, keyed by id
-        cards_glossary = {card['id']: card for card in cards_raw}
-
-        # Group the cards by tier
-        cards_grouped = {
-            tier: list(cards)
-            for tier, cards in groupby(
-                sorted(cards_raw, key=lambda x: x['tier']), key=lambda x: x['tier'])
-        }
-        
-        # Get the ids of the cards in each tier
-        cards_ids = {
-            tier: [card['id'] for card in cards]
-            for tier, cards in cards_grouped.items()
-        }
-
-        # Shuffle the cards
-        cards_shuffled = {
-            tier: random.sample(cards, len(cards))
-            for tier, cards in cards_ids.items()
-        }
+from core.catalog import Catalog, COLORS, COLOR_CODES, GEM_COLORS, GOLD
 
-        # Split the cards into visible and hidden decks
-        cards_drawn = {
-            str(tier): { 
-                "visible": cards_shuffled[tier][:num_revealed], 
-                "hidden": cards_shuffled[tier][num_revealed:]
-            }
-            for tier in cards_shuffled.keys()
-        }
-        
-        return cards_glossary, cards_drawn
-
-class CollectionsLoader:
-    '''
-    A static class for loading the collections from a JSON file.
-    
-    Not gonna lie, I'm don't think I should have made this a class, but
-    whatever.
-    '''
-    @staticmethod
-    def load_collections(collections_file: str, num_collections: int = 5) -> tuple[list[dict], list[int]]:
-        '''
-        Load the collections from a JSON file.
-        
-        Args:
-            collections_file (str): The path to the JSON file containing the collections.
-            num_collections (int): The number of collections to draw.
-            
-        Returns:
-            tuple[list[dict], list[int]]: A tuple containing:
-                - list[dict] of raw collection info, and
-                - list[int] of the ids of the collections that were drawn.
-        '''
-        with open(collections_file, 'r') as f:
-            collections_raw = json.load(f)
-            
-        # Draw collections at random to be at play
-        collections_at_play = random.sample(range(len(collections_raw)), num_collections)
-        
-        return collections_raw, collections_at_play
+# Every way of choosing 3 different colors to take, and their color codes
+DIFFERENT_COLOR_CHOICES = tuple(combinations(GEM_COLORS, 3))
+DIFFERENT_CODE_CHOICES = tuple(tuple(COLOR_CODES[color] for color in colors)
+                               for colors in DIFFERENT_COLOR_CHOICES)
 
 class WinException(Exception):
     '''
@@ -108,6 +21,53 @@ class ActionInvalidException(Exception):
     '''
     pass
 
+class Player:
+    '''
+    A player's part of the game state.
+    
+    Every room holds one of these per player, so they are kept compact:
+    token counts are bytearrays indexed by color code, and cards are byte
+    strings of card ids in the order they were taken. The byte strings are
+    immutable, so they can be captured by reference.
+    
+    Attributes:
+        wallet (bytearray): The number of tokens of each color the player
+            has, indexed by color code.
+        developments (bytes): The ids of the cards the player has developed.
+        reservations (bytes): The ids of the cards the player has reserved.
+        attained_collection (int | None): The id of the collection the player
+            has attained, if any.
+        discounts (bytearray): The running number of discounts the player
+            has of each color, indexed by color code.
+        score (int): The running score the player has from their
+            developments.
+    '''
+    __slots__ = ("wallet", "developments", "reservations", "attained_collection",
+                 "discounts", "score")
+    
+    def __init__(self):
+        self.wallet = bytearray(len(COLORS))
+        self.developments = b""
+        self.reservations = b""
+        self.attained_collection = None
+        self.discounts = bytearray(len(COLORS))
+        self.score = 0
+
+class Deck:
+    '''
+    The cards of one tier.
+    
+    Attributes:
+        visible (bytearray): The ids of the cards on the table.
+        hidden (bytearray): The ids of the cards left to draw, drawn from the
+            end.
+    '''
+    __slots__ = ("visible", "hidden")
+    
+    def __init__(self, visible: list[int], hidden: list[int]):
+        self.visible = bytearray(visible)
+        self.hidden = bytearray(hidden)
+
 class Game:
     '''
     A class representing a game. 
@@ -119,21 +79,33 @@ class Game:
     begun.
     
     Attributes:
-        players (dict[str, dict]): A dictionary of players, keyed by id.
+        players (dict[str, Player]): A dictionary of players, keyed by id.
         began (bool): Whether the game has begun.
-        cards (list[dict]): A list of all the cards in the game.
-        decks (dict[int, dict[str, list[int]]]): A dictionary of the decks of
-            cards, keyed by tier.
-        collections (list[dict]): A list of all the collections in the game.
-        collections_in_play (list[int]): A list of the ids of the collections that are
+        catalog (Catalog): The glossary of cards and collections, shared with
+            every other game.
+        decks (dict[str, Deck]): A dictionary of the decks of card ids, keyed
+            by tier.
+        collections_in_play (bytes): The ids of the collections that are
             currently in play.
-        bank (dict[str, int]): A dictionary of the bank of tokens, keyed by
-            color.
+        bank (bytearray): The bank of tokens, indexed by color code.
         turn (int): The number of turns that have passed.
+        winner (str | None): The id of the player who won the game, if the
+            game is over.
+        version (int): The version of the game state, incremented every
+            time the game state changes.
+        _delta_base (tuple | None): The version and a capture of the state
+            the last action was taken from, if the last change to the game
+            state was an action.
     '''
+    __slots__ = ("players", "began", "winner", "version", "_delta_base", "catalog",
+                 "decks", "collections_in_play", "bank", "turn")
+    
     def __init__(self):
         self.players = {}
         self.began = False
+        self.winner = None
+        self.version = 0
+        self._delta_base = None
     
     def _ensure_game_began(func):
         '''
@@ -158,10 +130,10 @@ class Game:
         Returns:
             int: The tier of the card.
         '''
-        if card_id not in self.cards:
+        if not self.catalog.has_card(card_id):
             raise ActionInvalidException(f"Card {card_id} does not exist")
         
-        return self.cards[card_id]['tier']
+        return self.catalog.card_tier[card_id]
     
     @_ensure_game_began
     def _get_player_discount(self, player_id: str, color: str) -> dict[str, int]:
@@ -175,12 +147,7 @@ class Game:
         Returns:
             int: The number of discounts the player has for the given color.
         '''
-        player = self.players[player_id]
-        
-        # Count the number of cards in the player's developments that have the
-        # given discount color
-        return len([card_id for card_id in player["developments"] 
-                    if self.cards[card_id]["discount"] == color])
+        return self.players[player_id].discounts[COLOR_CODES[color]]
 
     @_ensure_game_began
     def _get_player_score(self, player_id: str) -> int:
@@ -189,13 +156,12 @@ class Game:
         '''
         player = self.players[player_id]
         
-        # Sum the scores of the player's developments
-        score_from_developments = sum(self.cards[card_id]["score"] 
-                                      for card_id in player["developments"])
+        # The score of the player's developments is tallied as they are added
+        score_from_developments = player.score
         
         # Add the score of the player's collection, if they have one
-        if player["attained_collection"] is not None:
-            score_from_collection = self.collections[player["attained_collection"]]["score"]
+        if player.attained_collection is not None:
+            score_from_collection = self.catalog.collection_score[player.attained_collection]
         else:
             score_from_collection = 0
         
@@ -219,29 +185,42 @@ class Game:
             bool: Whether a collection was assigned to the player.
         '''
         player = self.players[player_id]
+        discounts = player.discounts
         
         # If the player has already attained a collection, they will not be
         # eligible for any more
-        if player["attained_collection"] is not None:
+        if player.attained_collection is not None:
             return False
         
         # Look through every available collection
-        for collection_id in tuple(self.collections_in_play):
-            collection = self.collections[collection_id]
-            
+        for collection_id in self.collections_in_play:
             # For every required color in the collection
-            for color, count in collection["trigger"].items():
+            for color_code, count in self.catalog.collection_trigger[collection_id]:
                 # If the player doesn't have the required number of cards,
                 # they are not eligible
-                if sum(self.cards[card_id]["discount"] == color 
-                       for card_id in player["developments"]) < count:
+                if discounts[color_code] < count:
                     break
             else: # This is intended to be a for-else loop
                 # Assign the collection to the player
-                player["attained_collection"] = collection["id"]
+                player.attained_collection = collection_id
                 return True
         
         return False
+    
+    @_ensure_game_began
+    def _add_development(self, player_id: str, card_id: int) -> None:
+        '''
+        Add a card to a player's developments, keeping their running discount
+        and score tallies up to date.
+        
+        Args:
+            player_id (str): The id of the player to add the card to.
+            card_id (int): The id of the card to add.
+        '''
+        player = self.players[player_id]
+        player.developments += bytes((card_id,))
+        player.discounts[self.catalog.card_discount[card_id]] += 1
+        player.score += self.catalog.card_score[card_id]
         
     def add_player(self, id: str) -> "Game":
         '''
@@ -266,23 +245,23 @@ class Game:
             raise ActionInvalidException("Cannot have more than 4 players")
         
         # Initialize the player's wallet, developments, and reservations
-        self.players[id] = {
-            "wallet": { "black": 0, "white": 0, "red": 0, "blue": 0, "green": 0, "gold": 0 },
-            "developments": tuple(),
-            "reservations": tuple(),
-            "attained_collection": None,
-        }
+        self.players[id] = Player()
+        
+        self.version += 1
+        self._delta_base = None
         
         return self
     
-    def begin(self, cards_file: str, collections_file: str) -> "Game":
+    def begin(self, catalog: Catalog | None = None, seed: int | None = None) -> "Game":
         '''
         Initialize the game. Is idempotent and to be called after all players
         have been added.
         
         Args:
-            cards_file (str): The path to the JSON file containing the cards.
-            collections_file (str): The path to the JSON file containing the collections.
+            catalog (Catalog | None): The glossary of cards and collections to
+                play with. Defaults to the catalog shipped with the game.
+            seed (int | None): The seed to shuffle the decks and draw the
+                collections with. Defaults to a random seed.
             
         Returns:
             Game: The initialized game state.
@@ -296,13 +275,55 @@ class Game:
         self.began = True
         
         # Load everything else needed in the game state
-        self.cards, self.decks = CardLoader.load_decks(cards_file)
-        self.collections, self.collections_in_play = CollectionsLoader.load_collections(collections_file)
-        self.bank = { "black": 7, "white": 7, "red": 7,"blue": 7, "green": 7, "gold": 5 }
+        self.catalog = catalog if catalog is not None else Catalog.default()
+        decks, collections_in_play = self.catalog.deal(random.Random(seed))
+        self.decks = {tier: Deck(deck["visible"], deck["hidden"]) for tier, deck in decks.items()}
+        self.collections_in_play = bytes(collections_in_play)
+        self.bank = bytearray((7, 7, 7, 7, 7, 5))
         self.turn = 0
         
+        self.version += 1
+        self._delta_base = None
+        
         return self
 
+    def _get_current_player(self) -> str:
+        '''
+        Get the id of the player whose turn it is.
+        '''
+        return list(self.players.keys())[self.turn % len(self.players.keys())]
+
+    def _capture(self, player_id: str) -> tuple:
+        '''
+        Capture the parts of the game state that an action by a player can
+        change. Developments and reservations are tuples, so they are
+        captured by reference. An action draws at most one card from the top
+        of any hidden deck, so only the top card is captured.
+        
+        Args:
+            player_id (str): The id of the player taking the action.
+            
+        Returns:
+            tuple: The captured state.
+        '''
+        player = self.players[player_id]
+        
+        return (
+            player_id,
+            bytes(self.bank),
+            bytes(player.wallet),
+            player.developments,
+            player.reservations,
+            player.attained_collection,
+            {tier: (bytes(deck.visible), len(deck.hidden),
+                    deck.hidden[-1] if deck.hidden else None)
+             for tier, deck in self.decks.items()},
+            self.turn,
+            self.winner,
+            bytes(player.discounts),
+            player.score,
+        )
+
     def action(func):
         '''
         A decorator for actions that can be taken by a player.
@@ -312,22 +333,35 @@ class Game:
             if not self.began:
                 raise ActionInvalidException("Game has not begun")
             
+            # Ensure the game is not over
+            if self.winner is not None:
+                raise ActionInvalidException(f"Player {self.winner} has already won the game")
+            
             # Ensure the action is being taken by the player whose turn it is
-            current_player = list(self.players.keys())[
-                self.turn % len(self.players.keys())
-            ]
+            current_player = self._get_current_player()
             if current_player != player_id:
                 raise ActionInvalidException(f"Currently Player {current_player}'s turn")
 
             # Execute the action
+            before = self._capture(player_id)
+            developments_before = len(self.players[player_id].developments)
             result = func(self, player_id, *args, **kwargs)
+            
+            # The action has changed the game state, so remember what it was
+            # changed from to produce a delta later
+            self._delta_base = (self.version, before)
+            self.version += 1
 
-            # Check for win condition
+            # Check for win condition. The action has still been taken, so
+            # the game state reflects the winning move
             if self._get_player_score(player_id) >= 15:
-                raise ActionInvalidException(f"Player {player_id} has won the game")
+                self.winner = player_id
+                raise WinException(f"Player {player_id} has won the game")
             
-            # Assign a collection to the player if they are eligible
-            self._assign_collection_if_eligible(player_id)
+            # Assign a collection to the player if they are eligible, which
+            # can only change when their discounts do
+            if len(self.players[player_id].developments) != developments_before:
+                self._assign_collection_if_eligible(player_id)
 
             # Increment the turn counter
             self.turn += 1
@@ -352,11 +386,14 @@ class Game:
         
         player = self.players[player_id]
         
-        if sum(player["wallet"].values()) > 7:
+        if sum(player.wallet) > 7:
             raise ActionInvalidException("Cannot have more than 10 tokens at once")
         
         for color in colors:
-            if self.bank[color] < 1:
+            if color not in COLOR_CODES:
+                raise ActionInvalidException(f"Color {color} is not a valid color")
+            
+            if self.bank[COLOR_CODES[color]] < 1:
                 raise ActionInvalidException(f"Not enough {color} tokens left in the bank")
             
             if color == "gold":
@@ -365,8 +402,8 @@ class Game:
         # Add 1 token to the player's wallet and remove 1 from the bank, of
         # each chosen color
         for color in colors:
-            player["wallet"][color] += 1
-            self.bank[color] -= 1
+            player.wallet[COLOR_CODES[color]] += 1
+            self.bank[COLOR_CODES[color]] -= 1
             
         return self
     
@@ -386,22 +423,23 @@ class Game:
         '''
         player = self.players[player_id]
         
-        if color not in player["wallet"]:
+        if color not in COLOR_CODES:
             raise ActionInvalidException(f"Color {color} is not a valid color")
         
         if color == "gold":
             raise ActionInvalidException("Cannot take gold tokens")
         
-        if self.bank[color] < 4:
+        code = COLOR_CODES[color]
+        if self.bank[code] < 4:
             raise ActionInvalidException(f"There are less than 4 {color} tokens left in the bank")
         
-        if sum(player["wallet"].values()) > 8:
+        if sum(player.wallet) > 8:
             raise ActionInvalidException("Cannot have more than 10 tokens at once")
 
         # Add 2 tokens to the player's wallet and remove 2 from the bank, of
         # the chosen color
-        player["wallet"][color] += 2
-        self.bank[color] -= 2
+        player.wallet[code] += 2
+        self.bank[code] -= 2
 
         return self
     
@@ -431,7 +469,7 @@ class Game:
         if tier not in self.decks:
             raise ActionInvalidException(f"Tier {tier} does not exist")
         
-        if card_id is not None and card_id not in self.cards:
+        if card_id is not None and not self.catalog.has_card(card_id):
             raise ActionInvalidException(f"Card {card_id} does not exist")
         
         # If the card is specified, find its tier
@@ -440,46 +478,47 @@ class Game:
         
         # If the card is not on the table, i.e. it's not available to be
         # reserved or purchased
-        if card_id is not None and card_id not in self.decks[tier]["visible"]:
+        deck = self.decks[tier]
+        if card_id is not None and card_id not in deck.visible:
             raise ActionInvalidException(f"Card {card_id} is not up for grabs")
         
-        if len(player["reservations"]) >= 3:
+        if len(player.reservations) >= 3:
             raise ActionInvalidException("Cannot have more than 3 reserved cards at once")
         
-        if sum(player["wallet"].values()) > 9:
+        if sum(player.wallet) > 9:
             raise ActionInvalidException("Cannot have more than 10 tokens at once")
         
         # If the card is not specified, the player is choosing the topmost
         # card from the hidden deck
         if card_id is None:
             # If there are no cards left in the hidden deck, raise an error...
-            if len(self.decks[tier]["hidden"]) == 0:
+            if len(deck.hidden) == 0:
                 raise ActionInvalidException(f"No cards left in tier {tier}")
             
             # ...otherwise, pop the top card from the hidden deck
-            card_id = self.decks[tier]["hidden"].pop()
+            card_id = deck.hidden.pop()
             
             is_from_visible = False
         else:
             # Remove the card from the visible deck
-            self.decks[tier]["visible"].remove(card_id)
+            deck.visible.remove(card_id)
             
             is_from_visible = True
 
         # Add the card to the player's reservations
-        player["reservations"] += (card_id,)
+        player.reservations += bytes((card_id,))
         
         # If there are any gold tokens left, take one
-        if self.bank["gold"] > 0:
-            player["wallet"]["gold"] += 1
-            self.bank["gold"] -= 1
+        if self.bank[GOLD] > 0:
+            player.wallet[GOLD] += 1
+            self.bank[GOLD] -= 1
 
         # Replace the reserved card with a new one from the hidden deck, if
         # there are cards left in the hidden deck.
         if is_from_visible:
-            if len(self.decks[tier]["hidden"]) > 0:
-                new_card = self.decks[tier]["hidden"].pop()
-                self.decks[tier]["visible"].append(new_card)
+            if len(deck.hidden) > 0:
+                new_card = deck.hidden.pop()
+                deck.visible.append(new_card)
         
         return self
         
@@ -501,69 +540,69 @@ class Game:
         '''
         player = self.players[player_id]
         
-        if card_id not in self.cards:
+        if not self.catalog.has_card(card_id):
             raise ActionInvalidException(f"Card {card_id} does not exist")
         
-        if player["wallet"]["gold"] < len(gold_usage):
+        if player.wallet[GOLD] < len(gold_usage):
             raise ActionInvalidException("Not enough gold tokens to use")
         
         # Calculate the effective price of the card, taking into account the
-        # player's discounts
-        effective_price = {
-            color: price - self._get_player_discount(player_id, color)
-            for color, price in self.cards[card_id]["price"].items()
-        }
+        # player's discounts. Discounts can't take the price below 0
+        effective_price = [
+            max(0, price - discount)
+            for price, discount in zip(self.catalog.card_price[card_id], player.discounts)
+        ]
         
         # If the player is using gold tokens, adjust the effective price
         for color in gold_usage:
+            code = COLOR_CODES.get(color)
+            
             # Effective price can't go below 0
-            if effective_price[color] < 1:
+            if code is None or effective_price[code] < 1:
                 raise ActionInvalidException(f"Used excessive gold tokens for {color}")
             
-            # Discount the price of the color...
-            effective_price[color] -= 1
-            
-            # ...and add to the price of gold
-            if "gold" not in effective_price:
-                effective_price["gold"] = 1
-            else:
-                effective_price["gold"] += 1
+            # Discount the price of the color, and add to the price of gold
+            effective_price[code] -= 1
+            effective_price[GOLD] += 1
+        
+        # Check if player can afford the card, naming the first color short in
+        # the order the card lists its price
+        wallet = player.wallet
+        if any(count < price for count, price in zip(wallet, effective_price)):
+            for color in (*self.catalog.cards[card_id]["price"], "gold"):
+                if wallet[COLOR_CODES[color]] < effective_price[COLOR_CODES[color]]:
+                    raise ActionInvalidException(f"Not enough {color} tokens to purchase card")
                 
-        
-        # Check if player can afford the card
-        for color, price in effective_price.items():
-            if player["wallet"][color] < price:
-                raise ActionInvalidException(f"Not enough {color} tokens to purchase card")
-                
-        if card_id in player["reservations"]:
+        if card_id in player.reservations:
             # Transfer the card from reservations to developments
-            player["reservations"] = tuple(
-                card_id for card_id in player["reservations"] if card_id != card_id
+            player.reservations = bytes(
+                reserved for reserved in player.reservations if reserved != card_id
             )
-            player["developments"] += (card_id,)
+            self._add_development(player_id, card_id)
             
         else:
             # Check if the card is available to be purchased
             tier = self._find_tier_of_card(card_id)
-            if card_id not in self.decks[tier]["visible"]:
+            deck = self.decks[tier]
+            if card_id not in deck.visible:
                 raise ActionInvalidException(f"Card {card_id} is not up for grabs")
             
             # Transfer the card from the visible deck to the player's
             # developments
-            self.decks[tier]["visible"].remove(card_id)
-            player["developments"] += (card_id,)
+            deck.visible.remove(card_id)
+            self._add_development(player_id, card_id)
             
             # Replace the purchased card with a new one from the hidden deck,
             # if there are cards left in the hidden deck
-            if len(self.decks[tier]["hidden"]) > 0:
-                new_card = self.decks[tier]["hidden"].pop()
-                self.decks[tier]["visible"].append(new_card)
+            if len(deck.hidden) > 0:
+                new_card = deck.hidden.pop()
+                deck.visible.append(new_card)
             
         # Transfer the price of the card from the player's wallet to the 
         # bank
-        for color, price in effective_price.items():
-            player["wallet"][color] -= price
-            self.bank[color] += price
+        for code, price in enumerate(effective_price):
+            wallet[code] -= price
+            self.bank[code] += price
             
         return self
     
@@ -582,6 +621,10 @@ class Game:
             
         Returns:
             Game: The updated game state.
+            
+        Raises:
+            WinException: If the action wins the game. The action has still
+                been taken, and no further actions can be taken.
         '''
         if action == "take_different":
             return self.action_take_different(player_id, *args, **kwargs)
@@ -594,6 +637,173 @@ class Game:
         else:
             raise ActionInvalidException(f"Unknown action: {action}")
 
+    def make_action(self, action: str, player_id: str, *args, **kwargs) -> tuple:
+        '''
+        Take an action specified by a string, returning a record that undo()
+        can use to take it back. Intended for searching the game tree without
+        copying the game at every node.
+        
+        Unlike do_action(), a winning action doesn't raise WinException, so
+        that it can be undone. Check winner instead. The action "pass" passes
+        the turn, for players that have no legal actions.
+        
+        Args:
+            action (str): The action to take.
+            player_id (str): The player taking the action.
+            
+        Returns:
+            tuple: The undo record of the action.
+        '''
+        delta_base = self._delta_base
+        
+        try:
+            if action == "pass":
+                self.debug_action_pass(player_id)
+            else:
+                self.do_action(action, player_id, *args, **kwargs)
+        except WinException:
+            pass
+        
+        return (delta_base, self._delta_base)
+    
+    def undo(self, record: tuple) -> "Game":
+        '''
+        Take back the last action, restoring the exact game state from before
+        it was taken, including its version and any cards drawn from the
+        hidden decks.
+        
+        Args:
+            record (tuple): The undo record returned by make_action().
+            
+        Returns:
+            Game: The restored game state.
+        '''
+        delta_base, (version, (player_id, bank, wallet, developments, reservations,
+                               attained_collection, decks, turn, winner,
+                               discounts, score)) = record
+        
+        if version != self.version - 1:
+            raise ActionInvalidException("Can only undo the last action")
+        
+        player = self.players[player_id]
+        self.bank[:] = bank
+        player.wallet[:] = wallet
+        player.developments = developments
+        player.reservations = reservations
+        player.attained_collection = attained_collection
+        
+        for tier, (visible, hidden_count, hidden_top) in decks.items():
+            deck = self.decks[tier]
+            deck.visible[:] = visible
+            
+            # Put back the card drawn from the top of the hidden deck
+            if len(deck.hidden) < hidden_count:
+                deck.hidden.append(hidden_top)
+        
+        player.discounts[:] = discounts
+        player.score = score
+        self.turn = turn
+        self.winner = winner
+        self.version = version
+        self._delta_base = delta_base
+        
+        return self
+
+    def legal_actions(self, player_id: str) -> list[tuple[str, dict]]:
+        '''
+        Enumerate every valid action a player can take, in one pass over their
+        wallet and the visible decks. Purchases are listed once for every
+        combination of gold usage that works.
+        
+        Args:
+            player_id (str): The player to enumerate the actions of.
+            
+        Returns:
+            list[tuple[str, dict]]: A list of (action, kwargs) pairs, each of
+                which can be taken with do_action(action, player_id, **kwargs).
+                Empty if it is not the player's turn, or the game is over.
+        '''
+        if not self.began or self.winner is not None or player_id != self._get_current_player():
+            return []
+        
+        player = self.players[player_id]
+        wallet = player.wallet
+        bank = self.bank
+        tokens = sum(wallet)
+        actions = []
+        
+        if tokens <= 7:
+            for colors, (a, b, c) in zip(DIFFERENT_COLOR_CHOICES, DIFFERENT_CODE_CHOICES):
+                if bank[a] > 0 and bank[b] > 0 and bank[c] > 0:
+                    actions.append(("take_different", {"colors": colors}))
+        
+        if tokens <= 8:
+            for code, color in enumerate(GEM_COLORS):
+                if bank[code] >= 4:
+                    actions.append(("take_same", {"color": color}))
+        
+        can_reserve = len(player.reservations) < 3 and tokens <= 9
+        purchasable = list(player.reservations)
+        
+        for tier, deck in self.decks.items():
+            purchasable.extend(deck.visible)
+            
+            if can_reserve:
+                for card_id in deck.visible:
+                    actions.append(("reserve", {"tier": tier, "card_id": card_id}))
+                
+                if deck.hidden:
+                    actions.append(("reserve", {"tier": tier, "card_id": None}))
+        
+        # Work out what the player has left to pay of each color after their
+        # discounts and tokens, which must be covered by gold
+        discounts = player.discounts
+        gold = wallet[GOLD]
+        card_price = self.catalog.card_price
+        for card_id in purchasable:
+            price = card_price[card_id]
+            ranges = []
+            shortfall = 0
+            for code, color in enumerate(GEM_COLORS):
+                effective_price = price[code] - discounts[code]
+                if effective_price > 0:
+                    # Gold can replace anywhere from the tokens the player
+                    # is short of, to the entire price of the color
+                    least = max(0, effective_price - wallet[code])
+                    shortfall += least
+                    ranges.append((color, least, effective_price))
+            
+            if shortfall > gold:
+                continue
+            
+            for gold_usage in self._gold_usages(ranges, gold):
+                actions.append(("purchase", {"card_id": card_id, "gold_usage": gold_usage}))
+        
+        return actions
+    
+    @staticmethod
+    def _gold_usages(ranges: list[tuple[str, int, int]], gold: int) -> list[list[str]]:
+        '''
+        Enumerate every way of using at most some number of gold tokens, given
+        the least and most gold that can be used for each color.
+        
+        Args:
+            ranges (list[tuple[str, int, int]]): (color, least, most) triples.
+            gold (int): The number of gold tokens available.
+            
+        Returns:
+            list[list[str]]: Every valid gold usage, as lists of colors.
+        '''
+        usages = [([], gold)]
+        for color, least, most in ranges:
+            usages = [
+                (usage + [color] * count, remaining - count)
+                for usage, remaining in usages
+                for count in range(least, min(most, remaining) + 1)
+            ]
+        
+        return [usage for usage, _ in usages]
+
     def get_visible_state(self) -> dict:
         '''
         Get the visible state of the game. Intended to be used for API
@@ -602,25 +812,101 @@ class Game:
         Returns:
             dict: A dictionary containing the visible state of the game.
         '''
-        out = copy.deepcopy(self.__dict__)
+        # Build the state field by field rather than copying everything, so
+        # the glossary, hidden decks and running tallies are never touched
+        out = {
+            "winner": self.winner,
+            "players": {
+                player_id: {
+                    "wallet": dict(zip(COLORS, player.wallet)),
+                    "developments": list(player.developments),
+                    "reservations": list(player.reservations),
+                    "attained_collection": player.attained_collection,
+                }
+                for player_id, player in self.players.items()
+            },
+            "began": self.began,
+            "version": self.version,
+        }
         
         if not self.began:
             return out
+        
+        # Don't show the hidden decks, only count the number of cards that
+        # are hidden
+        out["decks"] = {
+            tier: {
+                "visible": list(deck.visible),
+                "hidden_count": len(deck.hidden),
+            }
+            for tier, deck in self.decks.items()
+        }
+        out["collections_in_play"] = list(self.collections_in_play)
+        out["bank"] = dict(zip(COLORS, self.bank))
+        out["turn"] = self.turn
+        
+        return out
     
+    def get_delta(self) -> dict | None:
+        '''
+        Get the changes the last action made to the visible state, as a patch
+        from the previous version. Intended to be used for API endpoints to
+        communicate with the frontend.
+        
+        Each change is a [path, value] pair, where path is the list of keys
+        into the visible state that should be set to value.
         
-        # Don't show the hidden decks
-        for tier in out["decks"]:
-            # Count number of cards that are hidden
-            out["decks"][tier]["hidden_count"] = len(out["decks"][tier]["hidden"])
-            out["decks"][tier].pop("hidden")
+        Returns:
+            dict | None: A dictionary containing the version, the version the
+                patch applies to, and the changes. None if the last change to
+                the game state was not an action, in which case the visible
+                state should be used instead.
+        '''
+        if self._delta_base is None or self._delta_base[0] != self.version - 1:
+            return None
+        
+        base_version, (player_id, bank, wallet, developments, reservations,
+                       attained_collection, decks, turn, winner, _, _) = self._delta_base
+        player = self.players[player_id]
+        changes = []
+        
+        for color, before, count in zip(COLORS, bank, self.bank):
+            if before != count:
+                changes.append([["bank", color], count])
+        
+        for color, before, count in zip(COLORS, wallet, player.wallet):
+            if before != count:
+                changes.append([["players", player_id, "wallet", color], count])
+        
+        if player.developments != developments:
+            changes.append([["players", player_id, "developments"], list(player.developments)])
+        
+        if player.reservations != reservations:
+            changes.append([["players", player_id, "reservations"], list(player.reservations)])
+        
+        if player.attained_collection != attained_collection:
+            changes.append([["players", player_id, "attained_collection"], player.attained_collection])
+        
+        for tier, deck in self.decks.items():
+            visible, hidden_count, _ = decks[tier]
             
-        # Don't show the card glossary
-        out.pop("cards")
+            if deck.visible != visible:
+                changes.append([["decks", tier, "visible"], list(deck.visible)])
+            
+            if len(deck.hidden) != hidden_count:
+                changes.append([["decks", tier, "hidden_count"], len(deck.hidden)])
         
-        # Don't show the collection glossary
-        out.pop("collections")
+        if self.turn != turn:
+            changes.append([["turn"], self.turn])
         
-        return out
+        if self.winner != winner:
+            changes.append([["winner"], self.winner])
+        
+        return {
+            "version": self.version,
+            "base_version": base_version,
+            "changes": changes,
+        }
     
     def get_cards(self) -> list[dict]:
         '''
@@ -634,7 +920,7 @@ class Game:
             # Should migrate to a custom exception
             return ActionInvalidException("Game has not begun")
         
-        return list(self.cards.values())
+        return list(self.catalog.cards)
     
     def get_collections(self) -> list[dict]:
         '''
@@ -648,7 +934,7 @@ class Game:
             # Should migrate to a custom exception
             return ActionInvalidException("Game has not begun")
         
-        return self.collections  
+        return list(self.catalog.collections)
 
     @action
     def debug_action_pass(self, player_id: str) -> "Game":
@@ -664,4 +950,17 @@ class Game:
         return self
 
     def __repr__(self) -> str:
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return json.dumps(self, default=_jsonable, sort_keys=True, indent=4)
+
+def _jsonable(o) -> object:
+    '''
+    Convert the parts of a game that json can't encode by itself.
+    '''
+    # The catalog is shared by every game, so only identify it by its hash
+    if isinstance(o, Catalog):
+        return o.content_hash
+    
+    if isinstance(o, (bytes, bytearray)):
+        return list(o)
+    
+    return {name: getattr(o, name) for name in o.__slots__ if hasattr(o, name)}
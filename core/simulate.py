@@ -0,0 +1,242 @@
+'''
+A headless self-play simulator, for tuning cards.json and collections.json
+without playing real games.
+
+Runs complete games of Game with pluggable policies across a pool of
+processes, and reports how fast they were played and who won. For example:
+
+    python -m core.simulate --games 10000 --policies greedy random
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from core.catalog import Catalog, GEM_COLORS
+from core.game import Game, WinException
+
+def random_policy(game: Game, player_id: str, rng: random.Random) -> tuple[str, dict] | None:
+    '''
+    Take any legal action, uniformly at random.
+
+    Args:
+        game (Game): The game being played.
+        player_id (str): The player whose turn it is.
+        rng (random.Random): The random number generator to choose with.
+
+    Returns:
+        tuple[str, dict] | None: The action and its arguments, or None if
+            there are no legal actions.
+    '''
+    actions = game.legal_actions(player_id)
+
+    return rng.choice(actions) if actions else None
+
+def greedy_policy(game: Game, player_id: str, rng: random.Random) -> tuple[str, dict] | None:
+    '''
+    Buy the best card that can be bought, using as little gold as possible.
+    Otherwise, take the tokens that get closest to the cheapest card on
+    offer, reserving it if no tokens help.
+
+    Args:
+        game (Game): The game being played.
+        player_id (str): The player whose turn it is.
+        rng (random.Random): The random number generator to break ties with.
+
+    Returns:
+        tuple[str, dict] | None: The action and its arguments, or None if
+            there are no legal actions.
+    '''
+    actions = game.legal_actions(player_id)
+    if not actions:
+        return None
+
+    catalog = game.catalog
+    player = game.players[player_id]
+
+    purchases = [action for action in actions if action[0] == "purchase"]
+    if purchases:
+        return max(purchases, key=lambda action: (
+            catalog.card_score[action[1]["card_id"]],
+            -len(action[1]["gold_usage"]),
+            rng.random(),
+        ))
+
+    # Find the card that the player is closest to affording
+    def shortfall(card_id: int) -> dict[str, int]:
+        price = catalog.card_price[card_id]
+        return {
+            color: price[code] - player.discounts[code] - player.wallet[code]
+            for code, color in enumerate(GEM_COLORS)
+            if price[code] - player.discounts[code] - player.wallet[code] > 0
+        }
+
+    offered = list(player.reservations) + [
+        card_id for deck in game.decks.values() for card_id in deck.visible
+    ]
+    target = min(offered, key=lambda card_id: (
+        sum(shortfall(card_id).values()) - catalog.card_score[card_id],
+        rng.random(),
+    ), default=None)
+
+    if target is not None:
+        needed = shortfall(target)
+
+        def usefulness(action: tuple[str, dict]) -> int:
+            name, kwargs = action
+            if name == "take_different":
+                return sum(color in needed for color in kwargs["colors"])
+            if name == "take_same":
+                return min(2, needed.get(kwargs["color"], 0))
+            return 0
+
+        takes = [action for action in actions if action[0] in ("take_different", "take_same")]
+        best = max(takes, key=lambda action: (usefulness(action), rng.random()), default=None)
+        if best is not None and usefulness(best) > 0:
+            return best
+
+        for action in actions:
+            if action[0] == "reserve" and action[1]["card_id"] == target:
+                return action
+
+    return rng.choice(actions)
+
+POLICIES = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+}
+
+def play_game(seed: int, policies: list[str], max_turns: int = 500) -> dict:
+    '''
+    Play a complete game, with one player per policy.
+
+    Args:
+        seed (int): The seed for both the deal and the policies.
+        policies (list[str]): The name of the policy of each player, in turn
+            order.
+        max_turns (int): The number of turns after which the game is called
+            a draw.
+
+    Returns:
+        dict: The seed, the seat of the winner (None for a draw), the number
+            of turns and actions taken, and the final score of each seat.
+    '''
+    rng = random.Random(seed)
+    game = Game()
+    for seat in range(len(policies)):
+        game.add_player(f"p{seat}")
+    game.begin(Catalog.default(), seed=seed)
+
+    player_ids = list(game.players)
+    actions = 0
+
+    while game.turn < max_turns:
+        player_id = player_ids[game.turn % len(player_ids)]
+        choice = POLICIES[policies[game.turn % len(player_ids)]](game, player_id, rng)
+
+        try:
+            if choice is None:
+                # Nothing can be done, so the turn is passed
+                game.debug_action_pass(player_id)
+            else:
+                game.do_action(choice[0], player_id, **choice[1])
+        except WinException:
+            actions += 1
+            break
+
+        actions += 1
+
+    return {
+        "seed": seed,
+        "winner": player_ids.index(game.winner) if game.winner is not None else None,
+        "turns": game.turn,
+        "actions": actions,
+        "scores": [game._get_player_score(player_id) for player_id in player_ids],
+    }
+
+def _play_games(seeds: list[int], policies: list[str], max_turns: int) -> list[dict]:
+    return [play_game(seed, policies, max_turns) for seed in seeds]
+
+def simulate(num_games: int, policies: list[str], seed: int = 0, workers: int | None = None,
+             max_turns: int = 500, chunk_size: int = 50) -> dict:
+    '''
+    Play many games across a pool of processes.
+
+    Args:
+        num_games (int): The number of games to play.
+        policies (list[str]): The name of the policy of each player.
+        seed (int): The seed of the first game. Game i is played with seed
+            seed + i, so any game can be replayed on its own.
+        workers (int | None): The number of processes. Defaults to one per
+            core.
+        max_turns (int): The number of turns after which a game is a draw.
+        chunk_size (int): The number of games sent to a process at once.
+
+    Returns:
+        dict: A summary of the results, and the results of every game.
+    '''
+    for policy in policies:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy: {policy}")
+
+    seeds = list(range(seed, seed + num_games))
+    chunks = [seeds[i:i + chunk_size] for i in range(0, num_games, chunk_size)]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_play_games, chunk, policies, max_turns) for chunk in chunks]
+        games = [result for future in futures for result in future.result()]
+    elapsed = time.perf_counter() - start
+
+    actions = sum(game["actions"] for game in games)
+    wins = [0] * len(policies)
+    for game in games:
+        if game["winner"] is not None:
+            wins[game["winner"]] += 1
+
+    return {
+        "games": num_games,
+        "policies": policies,
+        "seconds": elapsed,
+        "games_per_second": num_games / elapsed,
+        "actions_per_second": actions / elapsed,
+        "mean_turns": sum(game["turns"] for game in games) / max(1, num_games),
+        "wins": wins,
+        "draws": num_games - sum(wins),
+        "results": games,
+    }
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Simulate games of self-play.")
+    parser.add_argument("--games", type=int, default=1000, help="number of games to play")
+    parser.add_argument("--policies", nargs="+", default=["greedy", "greedy"],
+                        choices=sorted(POLICIES), help="policy of each player, in turn order")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("--max-turns", type=int, default=500, help="turns before a game is a draw")
+    parser.add_argument("--json", action="store_true", help="print every result as JSON")
+    args = parser.parse_args(argv)
+
+    if not 1 <= len(args.policies) <= 4:
+        parser.error("Must have between 1 and 4 policies")
+
+    summary = simulate(args.games, args.policies, seed=args.seed,
+                       workers=args.workers or os.cpu_count(), max_turns=args.max_turns)
+
+    if args.json:
+        json.dump(summary, sys.stdout)
+        return
+
+    print(f"{summary['games']} games in {summary['seconds']:.2f}s "
+          f"({summary['games_per_second']:.1f} games/s, "
+          f"{summary['actions_per_second']:.0f} actions/s)")
+    print(f"Mean turns: {summary['mean_turns']:.1f}")
+    for seat, (policy, wins) in enumerate(zip(summary["policies"], summary["wins"])):
+        print(f"Seat {seat} ({policy}): {wins} wins ({wins / summary['games']:.1%})")
+    print(f"Draws: {summary['draws']}")
+
+if __name__ == "__main__":
+    main()
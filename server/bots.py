@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from core.bot import choose_action
+from core.game import Game
+
+logger = logging.getLogger(__name__)
+
+class BotManager:
+    """
+    Seats bot players in rooms and takes their turns.
+
+    Bots search for their moves in a pool of worker processes, so that their
+    thinking never holds up the event loop, or the human rooms on it. A bot
+    that can't choose or take its move passes instead, and if even that
+    fails, it tries its turn again after retry_delay seconds, so that a
+    game is never left waiting on a bot.
+    """
+    def __init__(self, games: Dict[str, Game],
+                 perform_action: Callable[[str, str, str, dict], Awaitable[Optional[str]]],
+                 workers: int = 1, time_limit: float = 1.0, iterations: Optional[int] = None,
+                 retry_delay: float = 1.0):
+        self.games = games
+        self.perform_action = perform_action
+        self.workers = workers
+        self.time_limit = time_limit
+        self.iterations = iterations
+        self.bots: Dict[str, Dict[str, dict]] = {}
+        self.thinking: Set[str] = set()
+        self.retry_delay = retry_delay
+        # The turns being taken, which the event loop only holds weakly
+        self.tasks: Set[asyncio.Task] = set()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        # Only start the worker processes once a bot is actually seated
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def is_bot(self, room_name: str, player_id: str) -> bool:
+        return player_id in self.bots.get(room_name, {})
+
+    def add_bot(self, room_name: str, name: Optional[str] = None,
+                time_limit: Optional[float] = None, iterations: Optional[int] = None) -> str:
+        """
+        Seat a bot in a room, with its own thinking budget per move. Returns
+        the bot's player id.
+        """
+        game = self.games[room_name]
+
+        if name is None:
+            number = 1
+            while f"bot{number}" in game.players:
+                number += 1
+            name = f"bot{number}"
+
+        game.add_player(name)
+        self.bots.setdefault(room_name, {})[name] = {
+            "time_limit": time_limit if time_limit is not None else self.time_limit,
+            "iterations": iterations if iterations is not None else self.iterations,
+        }
+        return name
+
+    def take_over(self, room_name: str, player_id: str) -> dict:
+        """
+        Hand a player's seat to a bot, such as when they forfeit it. Returns
+        the bot's thinking budget.
+        """
+        budget = self.bots.setdefault(room_name, {})[player_id] = {
+            "time_limit": self.time_limit,
+            "iterations": self.iterations,
+        }
+        return budget
+
+    def remove_room(self, room_name: str) -> None:
+        self.bots.pop(room_name, None)
+
+    def schedule(self, room_name: str) -> None:
+        """Start the turn of the bot in a room, if it is a bot's turn."""
+        game = self.games.get(room_name)
+        if game is None or not game.began or game.winner is not None:
+            return
+
+        if room_name in self.thinking or not self.is_bot(room_name, game._get_current_player()):
+            return
+
+        self.thinking.add(room_name)
+        task = asyncio.create_task(self._take_turn(room_name, game))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _take_turn(self, room_name: str, game: Game) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            player_id = game._get_current_player()
+            version = game.version
+            budget = self.bots[room_name][player_id]
+
+            try:
+                action, kwargs = await loop.run_in_executor(
+                    self.pool, choose_action, game, player_id,
+                    budget["iterations"], budget["time_limit"]
+                )
+            except Exception as e:
+                logger.exception("Bot %s in room %s failed to choose a move", player_id, room_name)
+                if isinstance(e, BrokenProcessPool):
+                    # A worker process died, so the next move starts new ones
+                    self.shutdown()
+                action, kwargs = "pass", {}
+
+            # Don't act on a game that changed while the bot was thinking
+            if self.games.get(room_name) is not game or game.version != version:
+                return
+
+            error = await self.perform_action(room_name, player_id, action, kwargs)
+            if error is not None and action != "pass":
+                logger.warning("Bot %s in room %s passed, as its move failed: %s", player_id, room_name, error)
+                error = await self.perform_action(room_name, player_id, "pass", {})
+            if error is not None:
+                raise RuntimeError(error)
+        except Exception:
+            logger.exception("Bot turn in room %s failed, retrying in %gs", room_name, self.retry_delay)
+            loop.call_later(self.retry_delay, self.schedule, room_name)
+            return
+        finally:
+            self.thinking.discard(room_name)
+
+        # The next player may be a bot too
+        self.schedule(room_name)
@@ -0,0 +1,328 @@
+import json
+import struct
+from typing import Any, List, Union
+
+from core.catalog import COLORS, COLOR_CODES
+
+# orjson is several times faster than the standard library, but optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def encode_json(data: Any) -> str:
+    """Encode a message as JSON text."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data)
+
+def decode_json(data: Union[str, bytes]) -> Any:
+    """Decode a JSON message. Raises ValueError if it isn't valid JSON."""
+    if orjson is not None:
+        return orjson.loads(data)
+    try:
+        return json.loads(data)
+    except RecursionError as e:
+        raise ValueError("Invalid JSON: nested too deeply") from e
+
+def _color_code(value: Any) -> Any:
+    return COLOR_CODES.get(value, value) if type(value) is str else value
+
+def _color_codes(value: Any) -> Any:
+    if type(value) is list or type(value) is tuple:
+        return [_color_code(color) for color in value]
+    return value
+
+def _color_array(value: Any) -> Any:
+    if type(value) is dict:
+        return [value.get(color, 0) for color in COLORS]
+    return value
+
+def _compact_changes(value: Any) -> Any:
+    # The colors of wallets and the bank are the last key of their paths,
+    # as in ["players", player_id, "wallet", color]
+    if type(value) is not list:
+        return value
+
+    changes = []
+    for path, item in value:
+        if path[:1] == ["bank"]:
+            depth = 1
+        elif path[:1] == ["players"] and path[2:3] == ["wallet"]:
+            depth = 3
+        else:
+            depth = None
+
+        if depth == len(path):
+            item = _color_array(item)
+        elif depth is not None and depth + 1 == len(path):
+            path = path[:-1] + [_color_code(path[-1])]
+        changes.append([path, item])
+    return changes
+
+# Where the colors are in each outbound message, by the keys that lead to
+# them, with "*" for every item of a list or every value of a map, and the
+# function that compacts them at the end. Fields of the same name anywhere
+# else, such as a player named "bank", are left alone
+_ACTION_ARGS = {"color": _color_code, "colors": _color_codes, "gold_usage": _color_codes}
+_SCHEMA = {
+    "gameStateDelta": {
+        "game": {"players": {"*": {"wallet": _color_array}}, "bank": _color_array},
+        "cards": {"*": {"price": _color_array, "discount": _color_code}},
+        "collections": {"*": {"trigger": _color_array}},
+    },
+    "changes": _compact_changes,
+    "action_args": _ACTION_ARGS,
+    "actions": {"*": {"action_args": _ACTION_ARGS}},
+}
+
+def _compact(value: Any, schema: Any) -> Any:
+    if not isinstance(schema, dict):
+        return schema(value)
+
+    kind = type(value)
+    every = schema.get("*")
+    if every is not None:
+        if kind is dict:
+            return {key: _compact(item, every) for key, item in value.items()}
+        if kind is list or kind is tuple:
+            return [_compact(item, every) for item in value]
+        return value
+
+    if kind is not dict:
+        return value
+    return {key: _compact(item, schema[key]) if key in schema else item for key, item in value.items()}
+
+def compact(message: dict) -> dict:
+    """
+    Replace the colors in an outbound message by their codes, and maps keyed
+    by color by arrays in the order of COLORS. Card and collection ids are
+    already integers.
+    """
+    return _compact(message, _SCHEMA)
+
+def expand(message: dict) -> dict:
+    """Replace the color codes in the arguments of an inbound action by their names."""
+    action_args = message.get("action_args")
+    if not isinstance(action_args, dict):
+        return message
+
+    expanded = {}
+    for key, value in action_args.items():
+        if key == "color" and isinstance(value, int):
+            value = _color(value)
+        elif key in ("colors", "gold_usage") and isinstance(value, list):
+            value = [_color(color) if isinstance(color, int) else color for color in value]
+        expanded[key] = value
+
+    return {**message, "action_args": expanded}
+
+def _color(code: int) -> Union[str, int]:
+    return COLORS[code] if 0 <= code < len(COLORS) else code
+
+# MessagePack, as far as JSON-like messages need it
+# https://github.com/msgpack/msgpack/blob/master/spec.md
+
+_pack_double = struct.Struct(">Bd").pack
+
+# The encodings of short strings, which are mostly the keys of messages
+_STRINGS: dict = {}
+_MAX_STRINGS = 4096
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode()
+    size = len(data)
+    if size < 32:
+        return bytes((0xa0 | size,)) + data
+    if size <= 0xff:
+        return bytes((0xd9, size)) + data
+    if size <= 0xffff:
+        return b"\xda" + size.to_bytes(2, "big") + data
+    return b"\xdb" + size.to_bytes(4, "big") + data
+
+def _pack_int(value: int) -> bytes:
+    if -0x20 <= value < 0:
+        return bytes((value & 0xff,))
+    if 0 <= value <= 0xff:
+        return bytes((0xcc, value))
+    if 0 <= value <= 0xffff:
+        return b"\xcd" + value.to_bytes(2, "big")
+    if 0 <= value <= 0xffffffff:
+        return b"\xce" + value.to_bytes(4, "big")
+    if 0 <= value <= 0xffffffffffffffff:
+        return b"\xcf" + value.to_bytes(8, "big")
+    if -0x80 <= value:
+        return b"\xd0" + value.to_bytes(1, "big", signed=True)
+    if -0x8000 <= value:
+        return b"\xd1" + value.to_bytes(2, "big", signed=True)
+    if -0x80000000 <= value:
+        return b"\xd2" + value.to_bytes(4, "big", signed=True)
+    return b"\xd3" + value.to_bytes(8, "big", signed=True)
+
+def _pack_header(size: int, fix: int, medium: bytes, large: bytes, fix_limit: int) -> bytes:
+    if size < fix_limit:
+        return bytes((fix | size,))
+    if size <= 0xffff:
+        return medium + size.to_bytes(2, "big")
+    return large + size.to_bytes(4, "big")
+
+def _pack(value: Any, out: bytearray) -> None:
+    # Checked by exact type first, in order of how common they are
+    kind = type(value)
+    if kind is str:
+        data = _STRINGS.get(value)
+        if data is None:
+            data = _pack_str(value)
+            if len(value) <= 32 and len(_STRINGS) < _MAX_STRINGS:
+                _STRINGS[value] = data
+        out += data
+    elif kind is int:
+        if 0 <= value < 0x80:
+            out.append(value)
+        else:
+            out += _pack_int(value)
+    elif kind is dict:
+        out += _pack_header(len(value), 0x80, b"\xde", b"\xdf", 16)
+        for key, item in value.items():
+            _pack(key, out)
+            _pack(item, out)
+    elif kind is list or kind is tuple:
+        out += _pack_header(len(value), 0x90, b"\xdc", b"\xdd", 16)
+        for item in value:
+            _pack(item, out)
+    elif value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif kind is float:
+        out += _pack_double(0xcb, value)
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+        if size <= 0xff:
+            out += bytes((0xc4, size))
+        elif size <= 0xffff:
+            out += b"\xc5" + size.to_bytes(2, "big")
+        else:
+            out += b"\xc6" + size.to_bytes(4, "big")
+        out += value
+    elif isinstance(value, (str, int, float, dict, list, tuple)):
+        # Subclasses, such as enums, are encoded as their base type
+        for base in (str, int, float, dict, list):
+            if isinstance(value, base):
+                _pack(base(value), out)
+                break
+        else:
+            _pack(list(value), out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__} as MessagePack")
+
+def encode_msgpack(data: Any) -> bytes:
+    """Encode a message as MessagePack."""
+    out = bytearray()
+    _pack(data, out)
+    return bytes(out)
+
+# The size of the length that follows each variable-length type byte, and
+# whether it is a string, binary, array or map
+_LENGTHS = {
+    0xd9: (1, "str"), 0xda: (2, "str"), 0xdb: (4, "str"),
+    0xc4: (1, "bin"), 0xc5: (2, "bin"), 0xc6: (4, "bin"),
+    0xdc: (2, "array"), 0xdd: (4, "array"),
+    0xde: (2, "map"), 0xdf: (4, "map"),
+}
+
+_FIXED = {
+    0xcc: struct.Struct(">B"), 0xcd: struct.Struct(">H"), 0xce: struct.Struct(">I"), 0xcf: struct.Struct(">Q"),
+    0xd0: struct.Struct(">b"), 0xd1: struct.Struct(">h"), 0xd2: struct.Struct(">i"), 0xd3: struct.Struct(">q"),
+    0xca: struct.Struct(">f"), 0xcb: struct.Struct(">d"),
+}
+
+# How deeply arrays and maps may be nested in an inbound message, far more
+# than any message needs, so that a message of nothing but nested arrays
+# can't exhaust the stack
+MAX_DEPTH = 32
+
+def _unpack(data: bytes, offset: int, depth: int = 0) -> tuple:
+    byte = data[offset]
+    offset += 1
+
+    if byte < 0x80:
+        return byte, offset
+    if byte >= 0xe0:
+        return byte - 0x100, offset
+    if 0xa0 <= byte < 0xc0:
+        end = offset + (byte & 0x1f)
+        return data[offset:end].decode(), end
+    if 0x90 <= byte < 0xa0:
+        return _unpack_array(data, offset, byte & 0x0f, depth)
+    if 0x80 <= byte < 0x90:
+        return _unpack_map(data, offset, byte & 0x0f, depth)
+    if byte == 0xc0:
+        return None, offset
+    if byte == 0xc2:
+        return False, offset
+    if byte == 0xc3:
+        return True, offset
+
+    fixed = _FIXED.get(byte)
+    if fixed is not None:
+        return fixed.unpack_from(data, offset)[0], offset + fixed.size
+
+    length = _LENGTHS.get(byte)
+    if length is None:
+        raise ValueError(f"Unsupported MessagePack type 0x{byte:02x}")
+    width, kind = length
+    size = int.from_bytes(data[offset:offset + width], "big")
+    offset += width
+
+    if kind == "str":
+        return data[offset:offset + size].decode(), offset + size
+    if kind == "bin":
+        return bytes(data[offset:offset + size]), offset + size
+    if kind == "array":
+        return _unpack_array(data, offset, size, depth)
+    return _unpack_map(data, offset, size, depth)
+
+def _unpack_array(data: bytes, offset: int, size: int, depth: int) -> tuple:
+    if depth >= MAX_DEPTH:
+        raise ValueError("Invalid MessagePack: nested too deeply")
+    items = []
+    for _ in range(size):
+        item, offset = _unpack(data, offset, depth + 1)
+        items.append(item)
+    return items, offset
+
+def _unpack_map(data: bytes, offset: int, size: int, depth: int) -> tuple:
+    if depth >= MAX_DEPTH:
+        raise ValueError("Invalid MessagePack: nested too deeply")
+    items = {}
+    for _ in range(size):
+        key, offset = _unpack(data, offset, depth + 1)
+        items[key], offset = _unpack(data, offset, depth + 1)
+    return items, offset
+
+# The start of a batch frame in MessagePack: a map of "type": "batch" and
+# "messages", whose array of messages follows
+_BATCH_PREFIX = encode_msgpack({"type": "batch"})[1:] + encode_msgpack("messages")
+
+def batch_frames(frames: List[Union[str, bytes]]) -> Union[str, bytes]:
+    """
+    Merge encoded messages into a single batch message, without decoding
+    them: {"type": "batch", "messages": [...]}. The messages must all be
+    JSON text, or all MessagePack.
+    """
+    if isinstance(frames[0], str):
+        return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+    return b"\x82" + _BATCH_PREFIX + _pack_header(len(frames), 0x90, b"\xdc", b"\xdd", 16) + b"".join(frames)
+
+def decode_msgpack(data: bytes) -> Any:
+    """Decode a MessagePack message. Raises ValueError if it isn't valid."""
+    try:
+        value, offset = _unpack(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError) as e:
+        raise ValueError(f"Invalid MessagePack: {e}") from e
+    if offset != len(data):
+        raise ValueError("Invalid MessagePack: trailing data")
+    return value
@@ -0,0 +1,326 @@
+from fastapi import WebSocket
+import asyncio
+import logging
+import zlib
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from server.codec import batch_frames, compact, encode_json, encode_msgpack
+
+# What to do with a client whose outbound queue is full
+#   drop: drop its queued state frames, since the latest one supersedes them
+#   disconnect: close its websocket
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect")
+
+# Close code sent to clients disconnected for being too slow (Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    """
+    A bounded queue of outbound frames for a single websocket, drained by its
+    own writer task so that a slow client never holds up anyone else.
+
+    If the client negotiated batches, everything queued by the time the
+    writer gets to run, such as the messages of one action, is sent as a
+    single batch frame, as long as it is all text or all binary. If it negotiated deflate, frames are then
+    compressed by the given function.
+    """
+    def __init__(self, websocket: WebSocket, max_size: int, policy: str):
+        self.websocket = websocket
+        self.max_size = max_size
+        self.policy = policy
+        self.frames: Deque[Tuple[Union[str, bytes], bool]] = deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.collapsed = 0
+        self.sent = 0
+        self.closed = False
+        self.batch = False
+        self.deflate: Optional[Callable[[Union[str, bytes]], Union[str, bytes]]] = None
+        self.task = asyncio.create_task(self._write())
+
+    def put(self, frame: Union[str, bytes], is_state: bool = False, supersedes: bool = False) -> bool:
+        """
+        Queue a text or binary frame to be sent. State frames may be dropped
+        in favour of a later one if the client falls behind, and a frame that
+        supersedes the state, such as a full state update, replaces every
+        state frame still queued. Returns whether the frame was queued.
+        """
+        if self.closed:
+            return False
+
+        if supersedes and self.frames:
+            kept = deque(queued for queued in self.frames if not queued[1])
+            self.collapsed += len(self.frames) - len(kept)
+            self.frames = kept
+
+        if len(self.frames) >= self.max_size and self.policy == "drop":
+            kept = deque(frame for frame in self.frames if not frame[1])
+            self.dropped += len(self.frames) - len(kept)
+            self.frames = kept
+
+        if len(self.frames) >= self.max_size:
+            self.close(SLOW_CONSUMER_CLOSE_CODE)
+            return False
+
+        self.frames.append((frame, is_state))
+        self.ready.set()
+        return True
+
+    def close(self, code: int = 1000) -> None:
+        """Stop sending frames, and close the websocket if code is given."""
+        if self.closed:
+            return
+
+        self.closed = True
+        self.frames.clear()
+        self.task.cancel()
+        asyncio.create_task(self._close(code))
+
+    async def _close(self, code: int) -> None:
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            # The websocket was already closed by the client
+            pass
+
+    async def _write(self) -> None:
+        while True:
+            while not self.frames:
+                self.ready.clear()
+                await self.ready.wait()
+
+            # Only frames of the same type can share a batch, which those
+            # queued either side of a hello that changed the encoding aren't
+            frames = [self.frames.popleft()[0]]
+            if self.batch:
+                kind = type(frames[0])
+                while self.frames and type(self.frames[0][0]) is kind:
+                    frames.append(self.frames.popleft()[0])
+
+            try:
+                frame = batch_frames(frames) if len(frames) > 1 else frames[0]
+                if self.deflate is not None:
+                    frame = self.deflate(frame)
+            except Exception:
+                logger.exception("Dropped %d frame(s) that could not be encoded", len(frames))
+                self.dropped += len(frames)
+                continue
+
+            self.sent += 1
+            try:
+                if isinstance(frame, str):
+                    await self.websocket.send_text(frame)
+                else:
+                    await self.websocket.send_bytes(frame)
+            except Exception:
+                # The websocket has gone away, its receive loop will clean up
+                self.closed = True
+                self.frames.clear()
+                return
+
+class ConnectionManager:
+    def __init__(self, max_queue_size: int = 64, slow_consumer_policy: str = "drop",
+                 compress_min_bytes: int = 512):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+
+        self.max_queue_size = max_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.compress_min_bytes = compress_min_bytes
+        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.websocket_to_room: Dict[WebSocket, str] = {}
+        self.websocket_features: Dict[WebSocket, Set[str]] = {}
+        self.glossary_hashes: Dict[WebSocket, str] = {}
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+
+        # The most recently compressed frames, since everyone in a room is
+        # usually sent the same ones
+        self.compressed: "OrderedDict[Union[str, bytes], bytes]" = OrderedDict()
+
+        # Counters carried over from outboxes that have since been removed
+        self.dropped_frames = 0
+        self.collapsed_frames = 0
+        self.sent_frames = 0
+        self.slow_consumer_disconnects = 0
+
+    def register(self, websocket: WebSocket) -> None:
+        """Start the writer task of a newly accepted websocket."""
+        self.outboxes[websocket] = Outbox(
+            websocket, self.max_queue_size, self.slow_consumer_policy
+        )
+
+    async def connect(self, websocket: WebSocket, room_name: str) -> None:
+        # A websocket that has already disconnected, whose commands were
+        # still queued, would otherwise be left in the room for good
+        if websocket not in self.outboxes:
+            return
+
+        # Disconnect from any previous room
+        if websocket in self.websocket_to_room:
+            old_room = self.websocket_to_room[websocket]
+            self.active_connections[old_room].remove(websocket)
+
+            if not self.active_connections[old_room]:
+                del self.active_connections[old_room]
+            del self.websocket_to_room[websocket]
+
+        # Connect to the new room
+        if room_name not in self.active_connections:
+            self.active_connections[room_name] = []
+
+        self.active_connections[room_name].append(websocket)
+        self.websocket_to_room[websocket] = room_name
+
+    def disconnect(self, websocket: WebSocket):
+        self.websocket_features.pop(websocket, None)
+        self.glossary_hashes.pop(websocket, None)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            self.dropped_frames += outbox.dropped
+            self.collapsed_frames += outbox.collapsed
+            self.sent_frames += outbox.sent
+            outbox.closed = True
+            outbox.task.cancel()
+
+        room_name = self.websocket_to_room.get(websocket)
+        if room_name and room_name in self.active_connections:
+            self.active_connections[room_name].remove(websocket)
+            if not self.active_connections[room_name]:
+                del self.active_connections[room_name]
+            del self.websocket_to_room[websocket]
+
+    def close_room(self, room_name: str) -> None:
+        """Remove every websocket from a room, leaving them connected."""
+        for websocket in self.active_connections.pop(room_name, []):
+            del self.websocket_to_room[websocket]
+
+    def set_features(self, websocket: WebSocket, features: Set[str]) -> None:
+        """Record the optional protocol features a websocket has negotiated."""
+        self.websocket_features[websocket] = features
+
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.batch = "batch" in features
+            outbox.deflate = self.deflate if "deflate" in features else None
+
+    def set_glossary_hash(self, websocket: WebSocket, content_hash: str) -> None:
+        """Record the hash of the glossary a websocket already has."""
+        self.glossary_hashes[websocket] = content_hash
+
+    def glossary_hash(self, websocket: WebSocket) -> Optional[str]:
+        """Get the hash of the glossary a websocket already has, if it said."""
+        return self.glossary_hashes.get(websocket)
+
+    def deflate(self, frame: Union[str, bytes]) -> Union[str, bytes]:
+        """
+        Compress a frame with zlib into a binary frame, if it is at least
+        compress_min_bytes long.
+        """
+        if len(frame) < self.compress_min_bytes:
+            return frame
+
+        compressed = self.compressed.get(frame)
+        if compressed is None:
+            compressed = zlib.compress(frame.encode() if isinstance(frame, str) else frame)
+            self.compressed[frame] = compressed
+            if len(self.compressed) > 256:
+                self.compressed.popitem(last=False)
+
+        return compressed
+
+    def has_feature(self, websocket: WebSocket, feature: str) -> bool:
+        """Check whether a websocket has negotiated an optional protocol feature."""
+        return feature in self.websocket_features.get(websocket, ())
+
+    def encode(self, websocket: WebSocket, data: dict) -> Union[str, bytes]:
+        """Encode a message as a websocket expects it, as JSON unless it negotiated MessagePack."""
+        if self.has_feature(websocket, "msgpack"):
+            return encode_msgpack(compact(data))
+        return encode_json(data)
+
+    def stats(self) -> dict:
+        """Get the outbound queue depths and dropped frame counters."""
+        depths = [len(outbox.frames) for outbox in self.outboxes.values()]
+        return {
+            "connections": len(self.outboxes),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "dropped_frames": self.dropped_frames + sum(
+                outbox.dropped for outbox in self.outboxes.values()
+            ),
+            "collapsed_frames": self.collapsed_frames + sum(
+                outbox.collapsed for outbox in self.outboxes.values()
+            ),
+            "sent_frames": self.sent_frames + sum(
+                outbox.sent for outbox in self.outboxes.values()
+            ),
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+        }
+
+    def _enqueue(self, websocket: WebSocket, frame: Union[str, bytes], is_state: bool = False,
+                 supersedes: bool = False) -> None:
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            return
+
+        was_closed = outbox.closed
+        if not outbox.put(frame, is_state, supersedes) and not was_closed:
+            self.slow_consumer_disconnects += 1
+
+    async def send_json(self, websocket: WebSocket, data: dict, is_state: bool = False,
+                        supersedes: bool = False):
+        """Send a message to a single websocket, in the encoding it negotiated."""
+        self._enqueue(websocket, self.encode(websocket, data), is_state, supersedes)
+
+    async def send_frame(self, websocket: WebSocket, frame: Union[str, bytes], is_state: bool = False,
+                         supersedes: bool = False):
+        """Send a message that is already in the encoding the websocket negotiated."""
+        self._enqueue(websocket, frame, is_state, supersedes)
+
+    async def send_error(self, websocket: WebSocket, message: str, request_id=None):
+        """Send an error message to a single websocket, about a request if it had an ID."""
+        error = {"type": "error", "message": message}
+        if request_id is not None:
+            error["request_id"] = request_id
+        await self.send_json(websocket, error)
+
+    async def send_success(self, websocket: WebSocket, message: str):
+        """Send a success or informational message to a single websocket."""
+        await self.send_json(websocket, {"type": "info", "message": message})
+
+    async def broadcast_json(self, room_name: str, data: dict, is_state: bool = False,
+                             supersedes: bool = False):
+        """Broadcast a JSON message to all websockets in a room."""
+        if room_name in self.active_connections:
+            await self.multicast_json(self.active_connections[room_name], data, is_state, supersedes)
+
+    async def multicast_json(self, websockets: List[WebSocket], data: dict, is_state: bool = False,
+                             supersedes: bool = False):
+        """
+        Send the same message to several websockets. The message is encoded
+        once for each encoding in use, then queued on each websocket's outbox
+        and sent concurrently by their writers.
+        """
+        text = packed = None
+        for connection in websockets:
+            if self.has_feature(connection, "msgpack"):
+                if packed is None:
+                    packed = encode_msgpack(compact(data))
+                self._enqueue(connection, packed, is_state, supersedes)
+            else:
+                if text is None:
+                    text = encode_json(data)
+                self._enqueue(connection, text, is_state, supersedes)
+
+    async def multicast_frames(self, websockets: List[WebSocket], frame: Callable[[bool], Union[str, bytes]],
+                               is_state: bool = False, supersedes: bool = False):
+        """
+        Send the same message to several websockets, given a function that
+        returns it already encoded, as MessagePack if its argument is True
+        or as JSON text otherwise.
+        """
+        for connection in websockets:
+            self._enqueue(connection, frame(self.has_feature(connection, "msgpack")), is_state, supersedes)
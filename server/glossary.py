@@ -0,0 +1,110 @@
+import gzip
+from typing import Dict, Optional, Union
+
+from fastapi import Response
+
+from core.catalog import Catalog
+from server.codec import compact, encode_json, encode_msgpack
+
+# Brotli compresses the glossary better than gzip, but is optional
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How long clients may use a glossary they fetched by its hash, which never
+# changes what it refers to
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+class Glossary:
+    """
+    The cards and collections of a catalog, encoded once and shared by every
+    room that uses it.
+
+    It is served over HTTP with its content hash as ETag, from bodies that
+    are compressed ahead of time, and over websockets from frames that are
+    encoded ahead of time, so that sending it costs no more than queueing
+    it. Clients that already have it say so by its hash, and aren't sent it
+    at all.
+    """
+    def __init__(self, catalog: Catalog):
+        self.content_hash = catalog.content_hash
+        self.etag = f'"{catalog.content_hash}"'
+        self.url = f"/glossary/{catalog.content_hash}"
+
+        cards = list(catalog.cards)
+        collections = list(catalog.collections)
+        self.body = encode_json({
+            "glossary_hash": self.content_hash,
+            "cards": cards,
+            "collections": collections,
+        }).encode()
+        self.encoded_bodies: Dict[str, bytes] = {"gzip": gzip.compress(self.body, 9, mtime=0)}
+        if brotli is not None:
+            self.encoded_bodies["br"] = brotli.compress(self.body)
+
+        self.message = {
+            "type": "game_state_update",
+            "gameStateDelta": {
+                "cards": cards,
+                "collections": collections
+            },
+            "glossary_hash": self.content_hash
+        }
+        self.text = encode_json(self.message)
+        self.packed = encode_msgpack(compact(self.message))
+
+    def frame(self, msgpack: bool) -> Union[str, bytes]:
+        """The glossary message, encoded as JSON text or as compact MessagePack."""
+        return self.packed if msgpack else self.text
+
+    def is_current(self, if_none_match: Optional[str]) -> bool:
+        """Check whether an If-None-Match header names this glossary."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = (tag.strip() for tag in if_none_match.split(","))
+        return any(tag.removeprefix("W/") == self.etag for tag in tags)
+
+    def response(self, if_none_match: Optional[str], accept_encoding: Optional[str],
+                 immutable: bool = False) -> Response:
+        """
+        Serve the glossary over HTTP, or 304 Not Modified if the client
+        already has it, in the best encoding the client accepts.
+        """
+        headers = {
+            "ETag": self.etag,
+            "Vary": "Accept-Encoding",
+            # Clients must check for changes at the plain URL, but never at
+            # the URL with the hash in it
+            "Cache-Control": f"public, max-age={IMMUTABLE_MAX_AGE}, immutable" if immutable else "no-cache",
+        }
+        if self.is_current(if_none_match):
+            return Response(status_code=304, headers=headers)
+
+        accepted = {
+            coding.split(";")[0].strip().lower()
+            for coding in (accept_encoding or "").split(",")
+            if not coding.replace(" ", "").endswith(";q=0")
+        }
+        for coding in ("br", "gzip"):
+            if coding in accepted and coding in self.encoded_bodies:
+                headers["Content-Encoding"] = coding
+                return Response(content=self.encoded_bodies[coding], media_type="application/json",
+                                headers=headers)
+
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+class Glossaries:
+    """The glossary of every catalog in use, by content hash."""
+    def __init__(self, default: Catalog):
+        self.by_hash: Dict[str, Glossary] = {}
+        self.default = self.get(default)
+
+    def get(self, catalog: Catalog) -> Glossary:
+        """Get the glossary of a catalog, encoding it the first time."""
+        glossary = self.by_hash.get(catalog.content_hash)
+        if glossary is None:
+            glossary = self.by_hash[catalog.content_hash] = Glossary(catalog)
+        return glossary
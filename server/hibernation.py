@@ -0,0 +1,239 @@
+from collections import OrderedDict
+import asyncio
+import base64
+import hashlib
+import os
+import pickle
+import time
+import zlib
+from typing import Callable, Dict, Optional, Set
+
+from core.game import Game
+
+class Hibernator:
+    """
+    Moves idle rooms out of memory and onto disk, and brings them back the
+    next time they are used.
+
+    A room is idle once nobody is connected to it and it hasn't been used
+    for idle_seconds. Rooms are also hibernated least recently used first
+    whenever there are more than max_rooms in memory, or their serialized
+    size adds up to more than max_bytes, as long as nobody is connected.
+
+    Each hibernated room is a zlib-compressed pickle of its game and bots,
+    in a file named by a hash of the room name. Rooms are pickled on the
+    event loop, so that they are consistent, but written and synced in a
+    thread, and only leave memory once they are on disk, if nothing has
+    happened to them in the meantime.
+    """
+    def __init__(self, directory: str, games: Dict[str, Game], bots: Dict[str, Dict[str, dict]],
+                 is_busy: Callable[[str], bool], log: Optional[Callable[..., None]] = None,
+                 idle_seconds: float = 300, max_rooms: int = 0, max_bytes: int = 0):
+        self.directory = directory
+        self.games = games
+        self.bots = bots
+        self.is_busy = is_busy
+        self.log = log
+        self.idle_seconds = idle_seconds
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+
+        # The last time each room in memory was used, least recent first
+        self.last_active: "OrderedDict[str, float]" = OrderedDict()
+        # The serialized size of each room in memory, as of a version
+        self.sizes: Dict[str, tuple] = {}
+        self.hibernated = 0
+        self.woken = 0
+        # The rooms being written to disk, and the ceilings being enforced
+        # after a room was touched, which the event loop only holds weakly
+        self.hibernating: Set[str] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, room_name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(room_name.encode()).hexdigest() + ".room")
+
+    def touch(self, room_name: str) -> None:
+        """Record that a room in memory was just used."""
+        new = room_name not in self.last_active
+        self.last_active[room_name] = time.monotonic()
+        self.last_active.move_to_end(room_name)
+
+        # Only the room count can be checked this often
+        if new and self.max_rooms and len(self.games) > self.max_rooms:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Outside the server, the next sweep will see to it
+                return
+            task = loop.create_task(self.enforce(keep=room_name, memory=False))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def forget(self, room_name: str) -> None:
+        """Stop tracking a room that has left memory some other way."""
+        self.last_active.pop(room_name, None)
+        self.sizes.pop(room_name, None)
+
+    def wake(self, room_name: str) -> bool:
+        """
+        Bring a room back into memory if it is hibernating. Returns whether
+        the room exists at all.
+        """
+        if room_name in self.games:
+            self.touch(room_name)
+            return True
+
+        path = self.path(room_name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        state = pickle.loads(zlib.decompress(data))
+        if state["room_name"] != room_name:
+            return False
+
+        self.games[room_name] = state["game"]
+        if state["bots"]:
+            self.bots[room_name] = state["bots"]
+
+        # Logged with the room's state, so the log can be replayed without
+        # the file, which is removed now that the room is awake
+        if self.log is not None:
+            self.log("wake", room_name, state=base64.b64encode(pickle.dumps(
+                {"game": state["game"], "bots": state["bots"]}, protocol=pickle.HIGHEST_PROTOCOL
+            )).decode())
+        os.remove(path)
+
+        self.touch(room_name)
+        self.woken += 1
+        return True
+
+    async def hibernate(self, room_name: str) -> int:
+        """
+        Move a room out of memory and onto disk. Returns the size of its
+        file, or 0 if the room was used while it was being written, and was
+        left in memory.
+        """
+        game = self.games[room_name]
+        version = game.version
+        data = zlib.compress(pickle.dumps({
+            "room_name": room_name,
+            "game": game,
+            "bots": self.bots.get(room_name),
+        }, protocol=pickle.HIGHEST_PROTOCOL))
+
+        path = self.path(room_name)
+        loop = asyncio.get_running_loop()
+        self.hibernating.add(room_name)
+        try:
+            await loop.run_in_executor(None, self._write, path, data)
+        finally:
+            self.hibernating.discard(room_name)
+
+        if self.games.get(room_name) is not game or game.version != version or self.is_busy(room_name):
+            await loop.run_in_executor(None, os.remove, path)
+            return 0
+
+        # The file is on disk before the log says the room is there
+        if self.log is not None:
+            self.log("hibernate", room_name)
+        del self.games[room_name]
+        self.bots.pop(room_name, None)
+        self.forget(room_name)
+
+        self.hibernated += 1
+        return len(data)
+
+    def _write(self, path: str, data: bytes) -> None:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def memory_bytes(self) -> int:
+        """Estimate the memory held by the rooms by their serialized size."""
+        total = 0
+        for room_name, game in self.games.items():
+            size = self.sizes.get(room_name)
+            if size is None or size[0] != game.version:
+                size = self.sizes[room_name] = (game.version, len(pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL)))
+            total += size[1]
+
+        return total
+
+    def _can_hibernate(self, room_name: str, keep: Optional[str]) -> bool:
+        return (room_name != keep and room_name in self.games and room_name not in self.hibernating
+                and not self.is_busy(room_name))
+
+    async def enforce(self, keep: Optional[str] = None, memory: bool = True) -> int:
+        """
+        Hibernate the least recently used rooms until under the ceilings,
+        except for the room to keep. The memory ceiling is only checked if
+        memory is set. Returns how many were hibernated.
+        """
+        count = 0
+        if self.max_rooms and len(self.games) > self.max_rooms:
+            for room_name in list(self.last_active):
+                if len(self.games) <= self.max_rooms:
+                    break
+                if self._can_hibernate(room_name, keep) and await self.hibernate(room_name):
+                    count += 1
+
+        if memory and self.max_bytes:
+            excess = self.memory_bytes() - self.max_bytes
+            for room_name in list(self.last_active):
+                if excess <= 0:
+                    break
+                size = self.sizes.get(room_name)
+                if size is not None and self._can_hibernate(room_name, keep) and await self.hibernate(room_name):
+                    excess -= size[1]
+                    count += 1
+
+        return count
+
+    async def sweep(self) -> int:
+        """Hibernate every idle room, then enforce the ceilings. Returns how many were hibernated."""
+        # Rooms that were never touched, such as those recovered from the
+        # log, are counted as used from the first sweep
+        for room_name in self.games:
+            if room_name not in self.last_active:
+                self.touch(room_name)
+
+        count = 0
+        cutoff = time.monotonic() - self.idle_seconds
+        for room_name, last_active in list(self.last_active.items()):
+            if last_active > cutoff:
+                break
+            # It may have been used while earlier rooms were being written
+            if self.last_active.get(room_name, 0) > cutoff:
+                continue
+            if self._can_hibernate(room_name, None) and await self.hibernate(room_name):
+                count += 1
+
+        return count + await self.enforce()
+
+    async def run(self, interval: Optional[float] = None) -> None:
+        """Sweep for idle rooms every so often."""
+        interval = interval or min(10.0, self.idle_seconds / 4)
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    def stats(self) -> dict:
+        return {
+            "rooms_in_memory": len(self.games),
+            "hibernated": self.hibernated,
+            "woken": self.woken,
+        }
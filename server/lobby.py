@@ -0,0 +1,82 @@
+from bisect import bisect_left, bisect_right
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+from core.game import Game
+
+# The most players a game can seat
+SEATS = 4
+# The most rooms that can be listed in one page
+MAX_PAGE = 200
+
+class Lobby:
+    """
+    The directory of open rooms: rooms whose game hasn't begun and has a
+    free seat, in the order they opened.
+
+    The directory is updated as each room changes, rather than found by
+    scanning the rooms, so that a page of it costs a binary search and a
+    slice however many rooms there are. Each open room has a sequence
+    number, which pages use as their cursor, so that rooms opening and
+    closing in between never make a client skip or repeat a room.
+    """
+    def __init__(self, seats: int = SEATS):
+        self.seats = seats
+        self.listings: Dict[str, Tuple[int, Tuple[str, ...]]] = {}
+        self.order: List[int] = []
+        self.rooms: Dict[int, str] = {}
+        self._sequence = itertools.count(1)
+
+    def __len__(self) -> int:
+        return len(self.listings)
+
+    def update(self, room_name: str, game: Optional[Game]) -> Optional[dict]:
+        """
+        List or delist a room after it has changed, or been removed if game
+        is None. Returns the change to tell subscribers about, if any.
+        """
+        listed = self.listings.get(room_name)
+        if game is None or game.began or len(game.players) >= self.seats:
+            if listed is None:
+                return None
+            sequence, _ = self.listings.pop(room_name)
+            del self.order[bisect_left(self.order, sequence)]
+            del self.rooms[sequence]
+            return {"room_name": room_name, "open": False}
+
+        players = tuple(game.players)
+        if listed is not None:
+            sequence, listed_players = listed
+            if listed_players == players:
+                return None
+        else:
+            # Sequence numbers only grow, so new rooms go on the end
+            sequence = next(self._sequence)
+            self.order.append(sequence)
+            self.rooms[sequence] = room_name
+
+        self.listings[room_name] = (sequence, players)
+        return {"open": True, **self.listing(room_name)}
+
+    def listing(self, room_name: str) -> dict:
+        sequence, players = self.listings[room_name]
+        return {
+            "room_name": room_name,
+            "players": list(players),
+            "free_seats": self.seats - len(players),
+            "cursor": sequence,
+        }
+
+    def page(self, after: int = 0, limit: int = 50) -> dict:
+        """
+        Get the open rooms that opened after the given cursor, oldest first.
+        The page's 'next' cursor gets the page after it, and is None on the
+        last page.
+        """
+        start = bisect_right(self.order, after)
+        sequences = self.order[start:start + limit]
+        return {
+            "rooms": [self.listing(self.rooms[sequence]) for sequence in sequences],
+            "next": sequences[-1] if start + limit < len(self.order) else None,
+            "total": len(self.order),
+        }
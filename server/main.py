@@ -1,241 +1,964 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-import json
-from typing import Dict, List
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket
+from contextlib import asynccontextmanager
+import asyncio
+import base64
+import functools
+import hmac
+import pickle
+import random
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Set
 import sys
 import os
 
 # Add the parent directory of the current file to the Python path
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
-from core.game import Game
-
-app = FastAPI()
+from core.catalog import Catalog, COLORS
+from core.game import Game, WinException
+from server.bots import BotManager
+from server.codec import decode_json, decode_msgpack, expand
+from server.connections import ConnectionManager
+from server.glossary import Glossaries
+from server.hibernation import Hibernator
+from server.lobby import Lobby, MAX_PAGE
+from server.metrics import Registry
+from server.profiling import ActionTracer, SamplingProfiler
+from server.rooms import RoomActors, RoomBusyError
+from server.sessions import Journals, SessionTokens
+from server.timers import TimerWheel
+from server.views import StateView, StateViews
+from server.wal import ActionLog, deal_record
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flusher = None
+    if wal is not None:
+        recovered_games, recovered_bots = wal.recover(catalog)
+        games.update(recovered_games)
+        bots.bots.update(recovered_bots)
+        flusher = asyncio.create_task(wal.run(games, bots.bots))
+
+        for room_name in recovered_bots:
+            bots.schedule(room_name)
+
+        for room_name, game in recovered_games.items():
+            lobby.update(room_name, game)
+            arm_turn_timer(room_name)
+
+    sweeper = asyncio.create_task(hibernator.run()) if hibernator is not None else None
+    ticker = asyncio.create_task(turn_timers.run()) if TURN_SECONDS > 0 else None
+
+    yield
+
+    if ticker is not None:
+        ticker.cancel()
+    if sweeper is not None:
+        sweeper.cancel()
+    if flusher is not None:
+        flusher.cancel()
+        wal.close()
+    bots.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# The card and collection glossary is compiled once, and shared by every room
+catalog = Catalog.default()
+
+# The glossary is encoded and compressed once per catalog. Clients fetch it
+# from /glossary, or get it over their websocket unless they say in their
+# hello, or the command itself, that they already have its hash
+glossaries = Glossaries(catalog)
 
 games: Dict[str, Game] = {}
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-        self.websocket_to_room: Dict[WebSocket, str] = {}
-
-    async def connect(self, websocket: WebSocket, room_name: str) -> None:
-        # Disconnect from any previous room
-        if websocket in self.websocket_to_room:
-            old_room = self.websocket_to_room[websocket]
-            self.active_connections[old_room].remove(websocket)
-            
-            if not self.active_connections[old_room]:
-                del self.active_connections[old_room]
-            del self.websocket_to_room[websocket]
-        
-        # Connect to the new room
-        if room_name not in self.active_connections:
-            self.active_connections[room_name] = []
-            
-        self.active_connections[room_name].append(websocket)
-        self.websocket_to_room[websocket] = room_name
-
-    def disconnect(self, websocket: WebSocket):
-        room_name = self.websocket_to_room.get(websocket)
-        if room_name and room_name in self.active_connections:
-            self.active_connections[room_name].remove(websocket)
-            if not self.active_connections[room_name]:
-                del self.active_connections[room_name]
-            del self.websocket_to_room[websocket]
-
-    async def send_json(self, websocket: WebSocket, data: dict):
-        """Send a JSON message to a single websocket."""
-        await websocket.send_text(json.dumps(data))
-
-    async def send_error(self, websocket: WebSocket, message: str):
-        """Send an error message to a single websocket."""
-        await self.send_json(websocket, {"type": "error", "message": message})
-
-    async def send_success(self, websocket: WebSocket, message: str):
-        """Send a success or informational message to a single websocket."""
-        await self.send_json(websocket, {"type": "info", "message": message})
-
-    async def broadcast_json(self, room_name: str, data: dict):
-        """Broadcast a JSON message to all websockets in a room."""
-        if room_name in self.active_connections:
-            msg = json.dumps(data)
-            for connection in self.active_connections[room_name]:
-                await connection.send_text(msg)
-
-manager = ConnectionManager()
+# The rooms that can be joined, listed a page at a time by GET /lobby and the
+# 'list_rooms' command, and followed by websockets that 'subscribe_lobby'
+lobby = Lobby()
+lobby_subscribers: Set[WebSocket] = set()
+LOBBY_COMMANDS = ('list_rooms', 'subscribe_lobby', 'unsubscribe_lobby')
+
+# Optional protocol features that clients can ask for with the 'hello' command
+#   patches: receive game_state_patch messages with the changes made by each
+#            action, instead of the full game state
+#   msgpack: receive binary MessagePack frames instead of JSON text, with
+#            colors sent as their index in the hello reply's 'color_order',
+#            and maps keyed by color as arrays in that order. Commands may
+#            be sent as MessagePack too, with colors as names or indexes
+#   batch:   receive the messages queued for the client together, such as
+#            the notification and state of an action, as one batch message
+#            {"type": "batch", "messages": [...]}
+#   deflate: receive frames of COMPRESS_MIN_BYTES or more compressed with
+#            zlib, as binary frames starting with 0x78. This is for clients
+#            that can't negotiate permessage-deflate, which uvicorn already
+#            applies to every frame for clients that do
+SUPPORTED_FEATURES = {"patches", "msgpack", "batch", "deflate"}
+
+# Each websocket has its own bounded outbound queue. When a client falls so
+# far behind that its queue fills up, its queued state updates are dropped
+# in favour of the latest one ('drop'), or it is disconnected ('disconnect')
+manager = ConnectionManager(
+    max_queue_size=int(os.environ.get('OUTBOUND_QUEUE_SIZE', 64)),
+    slow_consumer_policy=os.environ.get('SLOW_CONSUMER_POLICY', 'drop'),
+    compress_min_bytes=int(os.environ.get('COMPRESS_MIN_BYTES', 512)),
+)
+
+# Every change to the rooms is logged to WAL_DIR, if it is set, so that the
+# rooms can be rebuilt on startup. The log is fsynced every
+# WAL_FSYNC_INTERVAL seconds, and snapshotted every WAL_SNAPSHOT_EVERY changes
+wal = ActionLog(
+    os.environ['WAL_DIR'],
+    fsync_interval=float(os.environ.get('WAL_FSYNC_INTERVAL', 0.05)),
+    snapshot_every=int(os.environ.get('WAL_SNAPSHOT_EVERY', 10000)),
+) if os.environ.get('WAL_DIR') else None
+
+# Metrics served at /metrics in the Prometheus text format. Everything is
+# counted as it happens, except the gauges, which are read when scraped
+metrics = Registry()
+COMMAND_SECONDS = metrics.histogram(
+    "ws_command_seconds", "Time spent applying each websocket command.", ("command",))
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    "room_queue_wait_seconds", "Time commands waited in their room's queue.")
+ACTION_SECONDS = metrics.histogram(
+    "action_seconds", "Time spent in do_action for each action.", ("action",))
+VISIBLE_STATE_SECONDS = metrics.histogram(
+    "visible_state_seconds", "Time spent in get_visible_state.")
+BROADCAST_SECONDS = metrics.histogram(
+    "broadcast_seconds", "Time spent building and queueing state broadcasts.")
+GLOSSARY_REQUESTS = metrics.counter(
+    "glossary_requests_total", "Glossary requests, by whether the client already had it.", ("result",))
+RESUMES = metrics.counter(
+    "session_resumes_total", "Sessions resumed, by whether the missed messages were replayed.", ("result",))
+TURN_TIMEOUTS = metrics.counter(
+    "turn_timeouts_total", "Turns that ran out of time, by what was done about it.", ("policy",))
+ERRORS = metrics.counter(
+    "ws_errors_total", "Errors sent to clients, by type and command.", ("type", "command"))
+
+# The actions counted under their own name, so that clients can't add labels
+ACTION_NAMES = {"take_different", "take_same", "reserve", "purchase", "pass"}
+
+async def send_error(websocket: WebSocket, error_type: str, command, message: str, request_id=None):
+    """Send an error to a websocket, counting it by its type."""
+    known = isinstance(command, str) and (command in ROOM_COMMANDS or command in LOBBY_COMMANDS
+                                          or command == 'hello')
+    ERRORS.inc(error_type, command if known else "other")
+    await manager.send_error(websocket, message, request_id)
+
+def log_change(op: str, room_name: str, **fields):
+    """Log a change that was made to a room, if logging is enabled."""
+    if wal is not None:
+        wal.append(op, room_name, **fields)
+
+async def update_lobby(room_name: str):
+    """List or delist a room in the lobby after it changed, telling subscribers if it did."""
+    change = lobby.update(room_name, games.get(room_name))
+    if change is not None and lobby_subscribers:
+        await manager.multicast_json(list(lobby_subscribers), {"type": "lobby_update", **change})
+
+def state_message(game: Game) -> dict:
+    """Build a message containing the full visible state of a game."""
+    start = time.perf_counter()
+    state = game.get_visible_state()
+    VISIBLE_STATE_SECONDS.observe(time.perf_counter() - start)
+
+    return {
+        "type": "game_state_update",
+        "gameStateDelta": {
+            "game": state
+        }
+    }
+
+# Every message broadcast to a room is numbered, and the last
+# ROOM_JOURNAL_SIZE are kept for the JOURNAL_ROOMS rooms that broadcast most
+# recently. Players are given a token when they join a room, which they can
+# 'resume' with from a new websocket to be sent only the messages they
+# missed, or the full room if some of them are no longer kept. Tokens are
+# signed with SESSION_SECRET, or SHARD_SECRET so that every shard accepts
+# them, or else a secret that only lasts until the server restarts
+journals = Journals(size=int(os.environ.get('ROOM_JOURNAL_SIZE', 32)),
+                    max_rooms=int(os.environ.get('JOURNAL_ROOMS', 10000)))
+session_tokens = SessionTokens(os.environ.get('SESSION_SECRET') or os.environ.get('SHARD_SECRET')
+                               or secrets.token_hex(32))
+
+async def publish(room_name: str, message: dict):
+    """Broadcast a message to a room, numbered and kept for clients that resume."""
+    journals.append(room_name, message)
+    await manager.broadcast_json(room_name, message)
+
+# The full state of each room is built and encoded at most once per version,
+# and shared by every viewer, for the STATE_VIEW_ROOMS most recently viewed
+views = StateViews(state_message, max_rooms=int(os.environ.get('STATE_VIEW_ROOMS', 10000)))
+
+def state_view(room_name: str) -> StateView:
+    """Get the full visible state of a room, as of the last message broadcast to it."""
+    return views.get(room_name, games[room_name], journals.last_seq(room_name))
+
+async def send_state(websocket: WebSocket, room_name: str):
+    """Send the full visible state of a room to a single websocket."""
+    view = state_view(room_name)
+    await manager.send_frame(websocket, views.frame(view, manager.has_feature(websocket, "msgpack")))
+
+async def broadcast_state(room_name: str):
+    """
+    Broadcast the state of a room after it has changed. Websockets that have
+    negotiated patches only receive the changes made by the last action, if
+    it was one.
+    """
+    start = time.perf_counter()
+    connections = manager.active_connections.get(room_name, [])
+    delta = games[room_name].get_delta()
+    patch = {"type": "game_state_patch", **delta} if delta is not None else None
+    journals.append(room_name, patch, is_state=True)
+
+    if patch is not None:
+        patched = [c for c in connections if manager.has_feature(c, "patches")]
+        unpatched = [c for c in connections if not manager.has_feature(c, "patches")]
+
+        if patched:
+            await manager.multicast_json(patched, patch, is_state=True)
+    else:
+        unpatched = connections
+
+    if unpatched:
+        view = state_view(room_name)
+        await manager.multicast_frames(unpatched, lambda msgpack: views.frame(view, msgpack),
+                                       is_state=True, supersedes=True)
+
+    BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+async def perform_action(room_name: str, username: str, action: str,
+                         action_args: dict, timed_out: bool = False) -> Optional[str]:
+    """
+    Take an action in a room and broadcast the result. Returns an error
+    message if the action could not be taken.
+
+    Bots may also take the action 'pass' when they have no legal actions,
+    and players are made to when their turn has timed out.
+    """
+    touch_room(room_name)
+
+    forced_pass = action == 'pass' and (timed_out or bots.is_bot(room_name, username))
+    won = False
+    start = time.perf_counter()
+    try:
+        if forced_pass:
+            games[room_name].debug_action_pass(username)
+        else:
+            games[room_name] = games[room_name].do_action(action, username, **action_args)
+    except WinException:
+        # The winning action was still taken
+        won = True
+    except Exception as e:
+        return f"Error performing action: {e}"
+    finally:
+        elapsed = time.perf_counter() - start
+        ACTION_SECONDS.observe(elapsed, action if action in ACTION_NAMES else "other")
+        if tracer is not None:
+            tracer.record(elapsed, room_name, username, action, action_args)
+
+    if forced_pass:
+        log_change("pass", room_name, player=username)
+    else:
+        log_change("action", room_name, player=username, action=action, args=action_args)
+
+    await publish(room_name, {
+        "type": "notification",
+        "message": f"{username} took action {action}",
+        "username": username,
+        "action": action,
+        "action_args": action_args
+    })
+
+    await broadcast_state(room_name)
+
+    if won:
+        await publish(room_name, {
+            "type": "info",
+            "message": f"{username} has won the game",
+            "winner": username
+        })
+
+    arm_turn_timer(room_name)
+    bots.schedule(room_name)
+    return None
+
+# Every room applies its commands one at a time, in order, with at most
+# ROOM_QUEUE_SIZE commands waiting
+actors = RoomActors(max_queue_size=int(os.environ.get('ROOM_QUEUE_SIZE', 256)))
+
+async def submit_action(room_name: str, username: str, action: str,
+                        action_args: dict) -> Optional[str]:
+    """Take an action in a room once the commands queued before it are done."""
+    return await actors.submit(room_name, lambda: perform_action(room_name, username, action, action_args))
+
+# Bots think in worker processes, with a time budget per move
+bots = BotManager(
+    games, submit_action,
+    workers=int(os.environ.get('BOT_WORKERS', 1)),
+    time_limit=float(os.environ.get('BOT_TIME_LIMIT', 1.0)),
+)
+
+# Players have TURN_SECONDS to take each turn, if it is set. When they run
+# out, their turn is passed for them ('pass'), or their seat is handed to a
+# bot ('forfeit'), as TURN_TIMEOUT says. The turn clocks of every room share
+# a single timer wheel, ticking every TURN_TIMER_TICK seconds
+TURN_SECONDS = float(os.environ.get('TURN_SECONDS', 0))
+TURN_TIMEOUT = os.environ.get('TURN_TIMEOUT', 'pass')
+if TURN_TIMEOUT not in ('pass', 'forfeit'):
+    raise ValueError(f"Unknown turn timeout policy: {TURN_TIMEOUT}")
+
+def turn_timed_out(room_name: str, turn: int):
+    try:
+        actors.submit(room_name, lambda: time_out_turn(room_name, turn))
+    except RoomBusyError:
+        # Try again once the room has caught up
+        turn_timers.arm(room_name, 1.0, turn)
+
+turn_timers = TimerWheel(turn_timed_out, tick=float(os.environ.get('TURN_TIMER_TICK', 0.1)))
+
+def arm_turn_timer(room_name: str, restart: bool = True):
+    """
+    Start the clock on the turn being played in a room, or stop it if no
+    player is to move. Unless restart is set, a running clock is left alone.
+    """
+    if TURN_SECONDS <= 0 or (not restart and room_name in turn_timers):
+        return
+
+    game = games.get(room_name)
+    if (game is None or not game.began or game.winner is not None
+            or bots.is_bot(room_name, game._get_current_player())):
+        turn_timers.cancel(room_name)
+    else:
+        turn_timers.arm(room_name, TURN_SECONDS, game.turn)
+
+async def time_out_turn(room_name: str, turn: int):
+    """Pass the turn of a player who has run out of time, or hand their seat to a bot."""
+    game = games.get(room_name)
+    if game is None or game.turn != turn or game.winner is not None:
+        return
+
+    # Nobody is left to wait for the turn, so the room is left to go idle,
+    # and its clock starts again when someone comes back
+    if room_name not in manager.active_connections:
+        return
+
+    player_id = game._get_current_player()
+    TURN_TIMEOUTS.inc(TURN_TIMEOUT)
+    if TURN_TIMEOUT == 'forfeit':
+        budget = bots.take_over(room_name, player_id)
+        log_change("forfeit", room_name, player=player_id, budget=budget)
+        await publish(room_name, {
+            "type": "notification",
+            "message": f"{player_id} ran out of time, and a bot has taken their seat",
+            "username": player_id
+        })
+        turn_timers.cancel(room_name)
+        bots.schedule(room_name)
+    else:
+        await publish(room_name, {
+            "type": "notification",
+            "message": f"{player_id} ran out of time",
+            "username": player_id
+        })
+        await perform_action(room_name, player_id, 'pass', {}, timed_out=True)
+
+# When run as a shard behind server.shards, the front router migrates rooms
+# between shards with these endpoints, authenticated by SHARD_SECRET
+SHARD_SECRET = os.environ.get('SHARD_SECRET')
+
+def check_shard_secret(request: Request):
+    """Reject admin requests that aren't from the front router."""
+    secret = request.headers.get('x-shard-secret', '')
+    if not SHARD_SECRET or not hmac.compare_digest(secret, SHARD_SECRET):
+        raise HTTPException(status_code=404)
+
+# Operators can profile the server with these endpoints, authenticated by
+# ADMIN_SECRET, or SHARD_SECRET if it isn't set
+ADMIN_SECRET = os.environ.get('ADMIN_SECRET') or SHARD_SECRET
+
+def check_admin_secret(request: Request):
+    """Reject admin requests that aren't from an operator."""
+    secret = request.headers.get('x-admin-secret', '')
+    if not ADMIN_SECRET or not hmac.compare_digest(secret, ADMIN_SECRET):
+        raise HTTPException(status_code=404)
+
+# Profiles and traces are time-boxed to at most this many seconds
+MAX_PROFILE_SECONDS = 60
+
+# The running profiler and action tracer, which are only set while they run
+profiler: Optional[SamplingProfiler] = None
+tracer: Optional[ActionTracer] = None
+
+@app.post("/admin/profile")
+async def profile(request: Request, seconds: float = 10, interval: float = 0.005,
+                  room_name: Optional[str] = None, command: Optional[str] = None):
+    """
+    Sample the stacks of the event loop for a number of seconds, limited to a
+    room or command if given. Returns the stacks collapsed for flame graphs.
+    """
+    global profiler
+    check_admin_secret(request)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or interval < 0.001:
+        raise HTTPException(status_code=400, detail="Invalid 'seconds' or 'interval'.")
+    if profiler is not None:
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+
+    # This runs on the event loop's thread, which is the one to sample
+    profiler = SamplingProfiler(threading.get_ident(), PROFILE_SCOPES, interval, room_name, command)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        done, profiler = profiler, None
+        done.stop()
+
+    return Response(content=done.collapsed(), media_type="text/plain", headers={
+        "x-samples": str(done.samples),
+        "x-samples-out-of-scope": str(done.skipped),
+    })
+
+@app.post("/admin/trace")
+async def trace(request: Request, seconds: float = 10, slowest: int = 20):
+    """Trace every action for a number of seconds, and return the slowest with their arguments."""
+    global tracer
+    check_admin_secret(request)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or slowest < 1:
+        raise HTTPException(status_code=400, detail="Invalid 'seconds' or 'slowest'.")
+    if tracer is not None:
+        raise HTTPException(status_code=409, detail="A trace is already running.")
+
+    tracer = ActionTracer(slowest)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        done, tracer = tracer, None
+
+    return {"traced": done.traced, "slowest": done.results()}
+
+# Idle rooms are hibernated to HIBERNATE_DIR, if it is set, once nobody has
+# been connected to them for HIBERNATE_IDLE_SECONDS, and woken up again by
+# the next command for them. Least recently used rooms are also hibernated
+# to keep under HIBERNATE_MAX_ROOMS rooms, and HIBERNATE_MAX_MB megabytes of
+# serialized rooms, in memory
+hibernator = Hibernator(
+    os.environ['HIBERNATE_DIR'], games, bots.bots,
+    is_busy=lambda room_name: (room_name in manager.active_connections or room_name in bots.thinking
+                               or actors.is_busy(room_name)),
+    log=log_change if wal is not None else None,
+    idle_seconds=float(os.environ.get('HIBERNATE_IDLE_SECONDS', 300)),
+    max_rooms=int(os.environ.get('HIBERNATE_MAX_ROOMS', 0)),
+    max_bytes=int(float(os.environ.get('HIBERNATE_MAX_MB', 0)) * 1024 * 1024),
+) if os.environ.get('HIBERNATE_DIR') else None
+
+def room_exists(room_name: str) -> bool:
+    """Check whether a room exists, waking it up if it is hibernating."""
+    if hibernator is None:
+        return room_name in games
+
+    if room_name in games:
+        hibernator.touch(room_name)
+        return True
+
+    if not hibernator.wake(room_name):
+        return False
+
+    # A bot may have been left to move
+    bots.schedule(room_name)
+    return True
+
+def touch_room(room_name: str):
+    """Record that a room was just used."""
+    if hibernator is not None:
+        hibernator.touch(room_name)
+
+@app.get("/admin/rooms")
+async def list_rooms(request: Request):
+    check_shard_secret(request)
+    return {"rooms": sorted(games)}
+
+@app.post("/admin/rooms/{room_name:path}/export")
+async def export_room(room_name: str, request: Request):
+    """
+    Remove a room from this shard, and return its state to be imported
+    elsewhere, once the commands queued for it are done.
+    """
+    check_shard_secret(request)
+    return await actors.submit(room_name, lambda: _export_room(room_name))
+
+async def _export_room(room_name: str) -> Response:
+    if not room_exists(room_name):
+        raise HTTPException(status_code=404, detail=f"Room {room_name} does not exist.")
+
+    state = pickle.dumps({"game": games.pop(room_name), "bots": bots.bots.pop(room_name, None)},
+                         protocol=pickle.HIGHEST_PROTOCOL)
+    log_change("drop", room_name)
+    manager.close_room(room_name)
+    views.discard(room_name)
+    journals.discard(room_name)
+    turn_timers.cancel(room_name)
+    await update_lobby(room_name)
+    if hibernator is not None:
+        hibernator.forget(room_name)
+
+    return Response(content=state, media_type="application/octet-stream")
+
+@app.post("/admin/rooms/{room_name:path}/import")
+async def import_room(room_name: str, request: Request):
+    """Take over a room exported from another shard."""
+    check_shard_secret(request)
+    body = await request.body()
+    return await actors.submit(room_name, lambda: _import_room(room_name, body))
+
+async def _import_room(room_name: str, body: bytes) -> dict:
+    if room_exists(room_name):
+        raise HTTPException(status_code=409, detail=f"Room {room_name} already exists.")
+
+    state = pickle.loads(body)
+    games[room_name] = state["game"]
+    views.discard(room_name)
+    if state["bots"]:
+        bots.bots[room_name] = state["bots"]
+    log_change("import", room_name, state=base64.b64encode(body).decode())
+    touch_room(room_name)
+    await update_lobby(room_name)
+
+    arm_turn_timer(room_name)
+    bots.schedule(room_name)
+    return {"room_name": room_name}
+
+def connections_per_room() -> Dict[str, int]:
+    return {room_name: len(websockets) for room_name, websockets in manager.active_connections.items()}
+
+metrics.gauge("rooms_active", "Rooms in memory.", lambda: len(games))
+metrics.counter_callback("rooms_hibernated_total", "Rooms hibernated since startup.",
+                         lambda: hibernator.hibernated if hibernator is not None else 0)
+metrics.gauge("room_connections", "Websockets connected to each room.", connections_per_room, ("room",))
+metrics.gauge("connections", "Open websockets.", lambda: manager.stats()["connections"])
+metrics.gauge("outbound_queued_frames", "Frames waiting in outbound queues.",
+              lambda: manager.stats()["queued_frames"])
+metrics.gauge("outbound_max_queue_depth", "Frames waiting in the longest outbound queue.",
+              lambda: manager.stats()["max_queue_depth"])
+metrics.counter_callback("outbound_dropped_frames_total", "State frames dropped for slow clients.",
+                         lambda: manager.stats()["dropped_frames"])
+metrics.counter_callback("outbound_collapsed_frames_total", "State frames replaced by a newer state.",
+                         lambda: manager.stats()["collapsed_frames"])
+metrics.counter_callback("outbound_sent_frames_total", "Frames sent to clients.",
+                         lambda: manager.stats()["sent_frames"])
+metrics.counter_callback("slow_consumer_disconnects_total", "Clients disconnected for being too slow.",
+                         lambda: manager.stats()["slow_consumer_disconnects"])
+metrics.gauge("room_queued_commands", "Commands waiting in room queues.",
+              lambda: actors.stats()["queued_commands"])
+metrics.counter_callback("room_rejected_commands_total", "Commands rejected by full room queues.",
+                         lambda: actors.stats()["rejected_commands"])
+metrics.counter_callback("state_views_total", "Full state lookups, by whether they were cached.",
+                         lambda: {"hit": views.hits, "miss": views.misses}, ("result",))
+metrics.counter_callback("state_view_encodings_total", "Full states encoded for the wire.", lambda: views.encodings)
+metrics.gauge("lobby_open_rooms", "Rooms listed in the lobby.", lambda: len(lobby))
+metrics.gauge("lobby_subscribers", "Websockets following the lobby.", lambda: len(lobby_subscribers))
+metrics.gauge("turn_timers_armed", "Turns being timed.", lambda: len(turn_timers))
+metrics.gauge("bots_thinking", "Bots choosing a move.", lambda: len(bots.thinking))
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/lobby")
+async def get_lobby(after: int = 0, limit: int = 50):
+    """A page of the rooms that can be joined, oldest first."""
+    return lobby.page(after, max(1, min(limit, MAX_PAGE)))
+
+@app.get("/glossary")
+async def get_glossary(request: Request):
+    """The current glossary, to be revalidated by its ETag."""
+    return glossary_response(glossaries.default, request, immutable=False)
+
+@app.get("/glossary/{content_hash}")
+async def get_glossary_by_hash(content_hash: str, request: Request):
+    """A glossary by its content hash, which can be cached forever."""
+    glossary = glossaries.by_hash.get(content_hash)
+    if glossary is None:
+        raise HTTPException(status_code=404, detail="Unknown glossary.")
+    return glossary_response(glossary, request, immutable=True)
+
+def glossary_response(glossary, request: Request, immutable: bool) -> Response:
+    response = glossary.response(request.headers.get('if-none-match'),
+                                 request.headers.get('accept-encoding'), immutable)
+    GLOSSARY_REQUESTS.inc("not_modified" if response.status_code == 304 else "sent")
+    return response
+
+async def send_session(websocket: WebSocket, room_name: str, username: str):
+    """Give a player the token they can resume their session in a room with."""
+    await manager.send_json(websocket, {
+        "type": "session",
+        "room_name": room_name,
+        "username": username,
+        "token": session_tokens.issue(room_name, username)
+    })
+
+async def handle_create_room(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    username = message.get('username')
+    if room_exists(room_name):
+        return f"Room {room_name} already exists."
+
+    try:
+        games[room_name] = Game().add_player(username)
+    except Exception as e:
+        return f"Error creating room: {e}"
+    views.discard(room_name)
+    journals.discard(room_name)
+
+    log_change("create", room_name, player=username)
+    touch_room(room_name)
+    await update_lobby(room_name)
+
+    await manager.connect(websocket, room_name)
+    await send_session(websocket, room_name, username)
+    await publish(room_name, {
+        "type": "notification",
+        "message": f"{username} created and joined the room {room_name}"
+    })
+    await broadcast_state(room_name)
+
+async def handle_join_room(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    username = message.get('username')
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    try:
+        games[room_name] = games[room_name].add_player(username)
+    except Exception as e:
+        return f"Error joining room: {e}"
+
+    log_change("join", room_name, player=username)
+    await update_lobby(room_name)
+
+    await manager.connect(websocket, room_name)
+    await send_session(websocket, room_name, username)
+    await publish(room_name, {
+        "type": "notification",
+        "message": f"{username} joined the room {room_name}"
+    })
+    await broadcast_state(room_name)
+
+async def handle_begin_game(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    # The seed is logged with the deal, so the game can be rebuilt
+    seed = random.getrandbits(64)
+    try:
+        games[room_name] = games[room_name].begin(catalog, seed=seed)
+    except Exception as e:
+        return f"Error beginning game: {e}"
+
+    log_change("begin", room_name, seed=seed, **deal_record(games[room_name]))
+    await update_lobby(room_name)
+
+    await publish(room_name, {
+        "type": "notification",
+        "message": f"Game in room {room_name} has begun."
+    })
+    await broadcast_state(room_name)
+    arm_turn_timer(room_name)
+    bots.schedule(room_name)
+
+async def handle_add_bot(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    # Seat a bot, named by 'username' if given
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    try:
+        bot_name = bots.add_bot(room_name, message.get('username'))
+    except Exception as e:
+        return f"Error adding bot: {e}"
+
+    log_change("add_bot", room_name, player=bot_name, budget=bots.bots[room_name][bot_name])
+    await update_lobby(room_name)
+
+    await publish(room_name, {
+        "type": "notification",
+        "message": f"{bot_name} (bot) joined the room {room_name}"
+    })
+    await broadcast_state(room_name)
+
+async def handle_get_cards_and_collections(websocket: WebSocket, room_name: str,
+                                           message: dict) -> Optional[str]:
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    game = games[room_name]
+    if not game.began:
+        return "Error fetching data: Game has not begun"
+
+    # Clients that already have the glossary only get the ack
+    glossary = glossaries.get(game.catalog)
+    known = message.get('glossary_hash') or manager.glossary_hash(websocket)
+    if known == glossary.content_hash:
+        GLOSSARY_REQUESTS.inc("not_modified")
+        return
+
+    GLOSSARY_REQUESTS.inc("sent")
+    await manager.send_frame(websocket, glossary.frame(manager.has_feature(websocket, "msgpack")))
+
+async def handle_view_room(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    await manager.connect(websocket, room_name)
+    arm_turn_timer(room_name, restart=False)
+
+    try:
+        await send_state(websocket, room_name)
+    except Exception as e:
+        return f"Error viewing room: {e}"
+
+async def handle_resync(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    # Sent by clients that have noticed a gap in the versions of the patches
+    # they received
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    await send_state(websocket, room_name)
+
+async def handle_legal_actions(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    username = message.get('username')
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    await manager.send_json(websocket, {
+        "type": "legal_actions",
+        "username": username,
+        "version": games[room_name].version,
+        "actions": [
+            {"action": action, "action_args": action_args}
+            for action, action_args in games[room_name].legal_actions(username)
+        ]
+    })
+
+async def handle_action(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    username = message.get('username')
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    if bots.is_bot(room_name, username):
+        return f"Player {username} is a bot."
+
+    return await perform_action(room_name, username, message.get('action'),
+                                message.get('action_args', {}))
+
+async def handle_resume(websocket: WebSocket, room_name: str, message: dict) -> Optional[str]:
+    # Sent by players reconnecting with their session token, and the number
+    # 'seq' of the last message they were sent from the room
+    session = session_tokens.verify(message.get('token'))
+    if session is None or session[0] != room_name:
+        return "Invalid session token."
+    if not room_exists(room_name):
+        return f"Room {room_name} does not exist."
+
+    await manager.connect(websocket, room_name)
+    arm_turn_timer(room_name, restart=False)
+
+    seq = message.get('seq')
+    missed = journals.since(room_name, seq) if type(seq) is int else None
+    RESUMES.inc("snapshot" if missed is None else "replayed")
+    await manager.send_json(websocket, {
+        "type": "resumed",
+        "room_name": room_name,
+        "username": session[1],
+        "replayed": len(missed) if missed is not None else 0,
+        "snapshot": missed is None
+    })
+    if missed is None:
+        await send_state(websocket, room_name)
+        return
+
+    # Clients with patches are sent the patches they missed, unless one of
+    # the updates was only ever a full state. Otherwise, the updates they
+    # missed are all replaced by the current state
+    states = [entry for entry in missed if entry[2]]
+    patches = manager.has_feature(websocket, "patches") and all(entry[1] is not None for entry in states)
+    last_state = states[-1][0] if states else None
+
+    for missed_seq, missed_message, is_state in missed:
+        if not is_state or patches:
+            await manager.send_json(websocket, missed_message, is_state=is_state)
+        elif missed_seq == last_state:
+            await send_state(websocket, room_name)
+
+# The commands that are applied by the actor of the room they name, with the
+# fields they require and the error sent when those are missing
+ROOM_COMMANDS = {
+    'create_room': (handle_create_room, ('room_name', 'username'),
+                    "Missing 'room_name' or 'username'."),
+    'join_room': (handle_join_room, ('room_name', 'username'),
+                  "Missing 'room_name' or 'username'."),
+    'begin_game': (handle_begin_game, ('room_name',), "Missing 'room_name'."),
+    'add_bot': (handle_add_bot, ('room_name',), "Missing 'room_name'."),
+    'get_cards_and_collections': (handle_get_cards_and_collections, ('room_name',),
+                                  "Missing 'room_name'."),
+    'view_room': (handle_view_room, ('room_name',), "Missing 'room_name'."),
+    'resync': (handle_resync, ('room_name',), "Missing 'room_name'."),
+    'resume': (handle_resume, ('room_name', 'token'), "Missing 'room_name' or 'token'."),
+    'legal_actions': (handle_legal_actions, ('room_name', 'username'),
+                      "Missing 'room_name' or 'username'."),
+    'action': (handle_action, ('room_name', 'username', 'action'),
+               "Missing 'room_name', 'username', or 'action'."),
+}
+
+async def run_command(websocket: WebSocket, room_name: str, message: dict, received: float):
+    """
+    Apply a command on its room's actor, then acknowledge it if the client
+    gave it a request ID, or report why it failed.
+    """
+    command = message['command']
+    handler = ROOM_COMMANDS[command][0]
+    request_id = message.get('request_id')
+
+    # Commands that were still queued when their client disconnected are dropped
+    if websocket not in manager.outboxes:
+        return
+
+    start = time.perf_counter()
+    QUEUE_WAIT_SECONDS.observe(start - received)
+    error_type = "failed"
+    try:
+        error = await handler(websocket, room_name, message)
+    except Exception as e:
+        error = f"Error handling command: {e}"
+        error_type = "exception"
+    COMMAND_SECONDS.observe(time.perf_counter() - start, command)
+
+    if error is not None:
+        await send_error(websocket, error_type, command, error, request_id)
+    elif request_id is not None:
+        await manager.send_json(websocket, {
+            "type": "ack",
+            "request_id": request_id,
+            "command": message['command'],
+            "version": games[room_name].version if room_name in games else None
+        })
+
+async def handle_lobby_command(websocket: WebSocket, message: dict):
+    """
+    List a page of the rooms that can be joined, after the cursor 'after',
+    and subscribe to or unsubscribe from changes to the list. Subscribing
+    also lists the first page, or the page asked for.
+    """
+    command = message['command']
+    request_id = message.get('request_id')
+
+    if command == 'unsubscribe_lobby':
+        lobby_subscribers.discard(websocket)
+        if request_id is not None:
+            await manager.send_json(websocket, {"type": "ack", "request_id": request_id, "command": command})
+        return
+
+    after = message.get('after', 0)
+    limit = message.get('limit', 50)
+    if type(after) is not int or type(limit) is not int:
+        await send_error(websocket, "invalid", command, "'after' and 'limit' must be integers.", request_id)
+        return
+
+    if command == 'subscribe_lobby':
+        lobby_subscribers.add(websocket)
+
+    reply = {"type": "lobby", **lobby.page(after, max(1, min(limit, MAX_PAGE)))}
+    if request_id is not None:
+        reply["request_id"] = request_id
+    await manager.send_json(websocket, reply)
+
+# The frames a profile can be limited by, with how to tell which room and
+# command each is working on
+PROFILE_SCOPES = {
+    run_command.__code__: lambda f_locals: (f_locals['room_name'], f_locals['message']['command']),
+    perform_action.__code__: lambda f_locals: (f_locals['room_name'], 'action'),
+}
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-
-    while True:
-        try:
-            data = await websocket.receive_text()
-        except WebSocketDisconnect:
-            manager.disconnect(websocket)
-            break
-
-        # Parse the incoming message
-        try:
-            message = json.loads(data)
-        except json.JSONDecodeError:
-            await manager.send_error(websocket, "Invalid JSON format.")
-            continue
-
-        # Extract common parameters
-        command = message.get('command')
-        room_name = message.get('room_name')
-        username = message.get('username')
-        action = message.get('action', None)
-        action_args = message.get('action_args', {})
-
-        if command == 'create_room':
-            if not room_name or not username:
-                await manager.send_error(websocket, "Missing 'room_name' or 'username'.")
-                continue
-
-            if room_name in games:
-                await manager.send_error(websocket, f"Room {room_name} already exists.")
-                continue
-
-            try:
-                games[room_name] = Game().add_player(username)
-            except Exception as e:
-                await manager.send_error(websocket, f"Error creating room: {e}")
-                continue
-
-            await manager.connect(websocket, room_name)
-            await manager.broadcast_json(room_name, {
-                "type": "notification",
-                "message": f"{username} created and joined the room {room_name}"
-            })
-
-        elif command == 'join_room':
-            if not room_name or not username:
-                await manager.send_error(websocket, "Missing 'room_name' or 'username'.")
-                continue
-
-            if room_name not in games:
-                await manager.send_error(websocket, f"Room {room_name} does not exist.")
-                continue
-
-            try:
-                games[room_name] = games[room_name].add_player(username)
-            except Exception as e:
-                await manager.send_error(websocket, f"Error joining room: {e}")
-                continue
-
-            await manager.connect(websocket, room_name)
-            await manager.broadcast_json(room_name, {
-                "type": "notification",
-                "message": f"{username} joined the room {room_name}"
-            })
-
-        elif command == 'begin_game':
-            if not room_name:
-                await manager.send_error(websocket, "Missing 'room_name'.")
-                continue
-
-            if room_name not in games:
-                await manager.send_error(websocket, f"Room {room_name} does not exist.")
-                continue
-
-            try:
-                if not os.path.exists('./core/cards.json'):
-                    await manager.send_error(websocket, f"Server Error: ./core/cards.json does not exist.")
+    manager.register(websocket)
+
+    # However the connection ends, even by an error handling a message, it
+    # leaves its room and the lobby, and its outbox is stopped
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+
+            # Parse the incoming message, from MessagePack if it's binary
+            if frame.get("bytes") is not None:
+                try:
+                    message = decode_msgpack(frame["bytes"])
+                except ValueError:
+                    message = None
+                if not isinstance(message, dict):
+                    await send_error(websocket, "invalid_msgpack", None, "Invalid MessagePack format.")
                     continue
-                
-                if not os.path.exists('./core/collections.json'):
-                    await manager.send_error(websocket, f"Server Error: ./core/collections.json does not exist.")
+                message = expand(message)
+            else:
+                try:
+                    message = decode_json(frame.get("text") or "")
+                except ValueError:
+                    message = None
+                if not isinstance(message, dict):
+                    await send_error(websocket, "invalid_json", None, "Invalid JSON format.")
                     continue
-                
-                games[room_name] = games[room_name].begin('./core/cards.json', './core/collections.json')
-            except Exception as e:
-                await manager.send_error(websocket, f"Error beginning game: {e}")
-                continue
-
-            await manager.broadcast_json(room_name, {
-                "type": "notification",
-                "message": f"Game in room {room_name} has begun."
-            })
-
-        elif command == 'get_cards_and_collections':
-            if not room_name:
-                await manager.send_error(websocket, "Missing 'room_name'.")
-                continue
-
-            if room_name not in games:
-                await manager.send_error(websocket, f"Room {room_name} does not exist.")
-                continue
-
-            try:
-                cards = games[room_name].get_cards()
-                collections = games[room_name].get_collections()
-            except Exception as e:
-                await manager.send_error(websocket, f"Error fetching data: {e}")
-                continue
-
-            await manager.send_json(websocket, {
-                "type": "game_state_update",
-                "gameStateDelta": {
-                    "cards": cards,
-                    "collections": collections
-                }
-            })
-
-        elif command == 'view_room':
-            if not room_name:
-                await manager.send_error(websocket, "Missing 'room_name'.")
-                continue
 
-            if room_name not in games:
-                await manager.send_error(websocket, f"Room {room_name} does not exist.")
-                continue
+            command = message.get('command')
+            request_id = message.get('request_id')
 
-            await manager.connect(websocket, room_name)
+            if command == 'hello':
+                features = message.get('features', [])
+                if not isinstance(features, list):
+                    await send_error(websocket, "invalid", command, "'features' must be a list.", request_id)
+                    continue
 
-            try:
-                state = games[room_name].get_visible_state()
-            except Exception as e:
-                await manager.send_error(websocket, f"Error viewing room: {e}")
-                continue
+                accepted = SUPPORTED_FEATURES.intersection(f for f in features if isinstance(f, str))
+                manager.set_features(websocket, accepted)
+                if isinstance(message.get('glossary_hash'), str):
+                    manager.set_glossary_hash(websocket, message['glossary_hash'])
 
-            await manager.send_json(websocket, {
-                "type": "game_state_update",
-                "gameStateDelta": {
-                    "game": state
+                reply = {
+                    "type": "hello",
+                    "features": sorted(accepted),
+                    "glossary_hash": glossaries.default.content_hash,
+                    "glossary_url": glossaries.default.url
                 }
-            })
-
-        elif command == 'action':
-            if not all([room_name, username, action]):
-                await manager.send_error(websocket, "Missing 'room_name', 'username', or 'action'.")
-                continue
-
-            if room_name not in games:
-                await manager.send_error(websocket, f"Room {room_name} does not exist.")
-                continue
-
-            try:
-                games[room_name] = games[room_name].do_action(action, username, **action_args)
-            except Exception as e:
-                await manager.send_error(websocket, f"Error performing action: {e}")
-                continue
-
-            await manager.broadcast_json(room_name, {
-                "type": "notification",
-                "message": f"{username} took action {action}",
-                "username": username,
-                "action": action,
-                "action_args": action_args
-            })
-            
-            await manager.broadcast_json(room_name, {
-                "type": "game_state_update",
-                "gameStateDelta": {
-                    "game": games[room_name].get_visible_state()
-                }
-            })
-            
-        else:
-            # Unknown command
-            await manager.send_error(websocket, "Unknown command.")
+                if "msgpack" in accepted:
+                    reply["color_order"] = list(COLORS)
+                if TURN_SECONDS > 0:
+                    reply["turn_seconds"] = TURN_SECONDS
+                await manager.send_json(websocket, reply)
+
+            elif isinstance(command, str) and command in LOBBY_COMMANDS:
+                await handle_lobby_command(websocket, message)
+
+            elif isinstance(command, str) and command in ROOM_COMMANDS:
+                _, required, missing = ROOM_COMMANDS[command]
+                if not all(message.get(field) for field in required):
+                    await send_error(websocket, "missing_fields", command, missing, request_id)
+                    continue
+
+                # Queue the command on its room, without waiting for it to be
+                # applied, so that the client can pipeline its commands
+                room_name = message['room_name']
+                if not isinstance(room_name, str):
+                    await send_error(websocket, "invalid", command, "'room_name' must be a string.", request_id)
+                    continue
+
+                # Bound now, as the loop may read more commands before it runs
+                job = functools.partial(run_command, websocket, room_name, message, time.perf_counter())
+                try:
+                    actors.submit(room_name, job)
+                except RoomBusyError as e:
+                    await send_error(websocket, "room_busy", command, str(e), request_id)
+
+            else:
+                # Unknown command
+                await send_error(websocket, "unknown_command", command, "Unknown command.", request_id)
+    finally:
+        manager.disconnect(websocket)
+        lobby_subscribers.discard(websocket)
@@ -0,0 +1,114 @@
+from collections import Counter
+import heapq
+import itertools
+import sys
+import threading
+from types import CodeType, FrameType
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Extracts the room and command a scope frame is working on, from its locals
+ScopeReader = Callable[[dict], Tuple[str, str]]
+
+def frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    filename = code.co_filename.rsplit("/", 1)[-1]
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread from a background thread every interval
+    seconds, counting each distinct stack for collapsed-stack flame graphs.
+
+    Samples can be limited to a room or a command. Each sample is attributed
+    to the innermost frame on the stack whose code is one of the scopes,
+    whose locals say which room and command it is working on; samples with
+    no such frame are only counted when nothing is being filtered on.
+
+    Nothing is hooked into the sampled thread, so there is no cost outside
+    of the samples themselves, and none at all when not running.
+    """
+    def __init__(self, thread_id: int, scopes: Dict[CodeType, ScopeReader], interval: float = 0.005,
+                 room_name: Optional[str] = None, command: Optional[str] = None):
+        self.thread_id = thread_id
+        self.scopes = scopes
+        self.interval = interval
+        self.room_name = room_name
+        self.command = command
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.skipped = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _in_scope(self, frame: FrameType) -> bool:
+        if self.room_name is None and self.command is None:
+            return True
+
+        while frame is not None:
+            reader = self.scopes.get(frame.f_code)
+            if reader is not None:
+                try:
+                    room_name, command = reader(frame.f_locals)
+                except (KeyError, TypeError):
+                    return False
+                return ((self.room_name is None or room_name == self.room_name)
+                        and (self.command is None or command == self.command))
+            frame = frame.f_back
+
+        return False
+
+    def sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        self.samples += 1
+        if not self._in_scope(frame):
+            self.skipped += 1
+            return
+
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def collapsed(self) -> str:
+        """The sampled stacks, one per line with their count, for flamegraph.pl and the like."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+class ActionTracer:
+    """Keeps the slowest actions taken while tracing, with their arguments."""
+    def __init__(self, slowest: int = 20):
+        self.slowest = slowest
+        self.heap: List[tuple] = []
+        self.traced = 0
+        self._order = itertools.count()
+
+    def record(self, seconds: float, room_name: str, username: str, action: str, action_args: dict) -> None:
+        self.traced += 1
+        # The order breaks ties, so that the arguments are never compared
+        entry = (seconds, next(self._order), room_name, username, action, action_args)
+        if len(self.heap) < self.slowest:
+            heapq.heappush(self.heap, entry)
+        elif seconds > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def results(self) -> List[dict]:
+        """The slowest actions, slowest first."""
+        return [
+            {"seconds": seconds, "room_name": room_name, "username": username,
+             "action": action, "action_args": action_args}
+            for seconds, _, room_name, username, action, action_args in sorted(self.heap, reverse=True)
+        ]
@@ -0,0 +1,79 @@
+from collections import deque
+import asyncio
+from typing import Awaitable, Callable, Deque, Dict, Tuple
+
+class RoomBusyError(Exception):
+    """Raised when a room has too many commands queued to take another."""
+    pass
+
+class RoomActor:
+    """The queue of commands waiting to be applied to one room."""
+    __slots__ = ("queue", "task")
+
+    def __init__(self):
+        self.queue: Deque[Tuple[Callable[[], Awaitable], asyncio.Future]] = deque()
+        self.task = None
+
+class RoomActors:
+    """
+    Runs every room as an actor, which applies the commands for the room one
+    at a time, in the order they were submitted.
+
+    Connections only parse commands and submit them, so commands for the same
+    room never interleave, and a connection can go on to its next command
+    while the last one waits its turn. A room only has a task while it has
+    commands queued.
+    """
+    def __init__(self, max_queue_size: int = 256):
+        self.max_queue_size = max_queue_size
+        self.actors: Dict[str, RoomActor] = {}
+        self.processed = 0
+        self.rejected = 0
+
+    def submit(self, room_name: str, job: Callable[[], Awaitable]) -> asyncio.Future:
+        """
+        Queue a job to be run on a room after every job submitted before it.
+        Returns a future for the job's result.
+        """
+        actor = self.actors.get(room_name)
+        if actor is None:
+            actor = self.actors[room_name] = RoomActor()
+
+        if len(actor.queue) >= self.max_queue_size:
+            self.rejected += 1
+            raise RoomBusyError(f"Room {room_name} has too many commands queued.")
+
+        future = asyncio.get_running_loop().create_future()
+        actor.queue.append((job, future))
+        if actor.task is None:
+            actor.task = asyncio.create_task(self._drain(room_name, actor))
+
+        return future
+
+    async def _drain(self, room_name: str, actor: RoomActor) -> None:
+        try:
+            while actor.queue:
+                job, future = actor.queue.popleft()
+                try:
+                    result = await job()
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+                self.processed += 1
+        finally:
+            # The room goes back to having no task until its next command
+            del self.actors[room_name]
+
+    def is_busy(self, room_name: str) -> bool:
+        return room_name in self.actors
+
+    def stats(self) -> dict:
+        return {
+            "busy_rooms": len(self.actors),
+            "queued_commands": sum(len(actor.queue) for actor in self.actors.values()),
+            "processed_commands": self.processed,
+            "rejected_commands": self.rejected,
+        }
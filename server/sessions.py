@@ -0,0 +1,115 @@
+from collections import OrderedDict, deque
+import base64
+import hashlib
+import hmac
+import json
+import time
+from typing import Deque, List, Optional, Tuple
+
+class SessionTokens:
+    """
+    Tokens that identify a player in a room, issued when they join so that
+    they can resume their session from another websocket.
+
+    A token is the room and username signed with a secret, so nothing is
+    stored: any worker with the same secret can check it, and it outlives
+    restarts, hibernation and migration between shards.
+    """
+    def __init__(self, secret: str):
+        self.secret = secret.encode()
+
+    def _sign(self, payload: bytes) -> str:
+        digest = hmac.new(self.secret, payload, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:18]).decode()
+
+    def issue(self, room_name: str, username: str) -> str:
+        payload = base64.urlsafe_b64encode(json.dumps([room_name, username]).encode())
+        return f"{payload.decode()}.{self._sign(payload)}"
+
+    def verify(self, token) -> Optional[Tuple[str, str]]:
+        """Get the room and username of a token, or None if it isn't one of ours."""
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, self._sign(payload.encode())):
+            return None
+
+        room_name, username = json.loads(base64.urlsafe_b64decode(payload))
+        return room_name, username
+
+class RoomJournal:
+    """
+    The most recent messages broadcast to a room, numbered in order.
+
+    Each entry is the message, or None for a state update that only exists
+    as the full state, and whether it updated the state.
+    """
+    __slots__ = ("entries", "next_seq")
+
+    def __init__(self, size: int):
+        self.entries: Deque[Tuple[int, Optional[dict], bool]] = deque(maxlen=size)
+        # Start from the time, in microseconds, so that the numbers of a
+        # room's journal are always past those of any journal it had before,
+        # say before it was hibernated, and a client resuming from one of
+        # those is told it has missed too much
+        self.next_seq = time.time_ns() // 1000
+
+    @property
+    def last_seq(self) -> int:
+        return self.next_seq - 1
+
+class Journals:
+    """
+    The journal of each room, so that clients that reconnect can be sent the
+    messages they missed instead of the whole room. Only the rooms that
+    broadcast most recently are kept, up to max_rooms.
+    """
+    def __init__(self, size: int = 32, max_rooms: int = 10000):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.journals: "OrderedDict[str, RoomJournal]" = OrderedDict()
+
+    def journal(self, room_name: str) -> RoomJournal:
+        journal = self.journals.get(room_name)
+        if journal is None:
+            journal = self.journals[room_name] = RoomJournal(self.size)
+            if len(self.journals) > self.max_rooms:
+                self.journals.popitem(last=False)
+        return journal
+
+    def append(self, room_name: str, message: Optional[dict], is_state: bool = False) -> int:
+        """
+        Number the next message broadcast to a room, adding its number to it
+        as 'seq', and keep it. Returns its number.
+        """
+        journal = self.journal(room_name)
+        self.journals.move_to_end(room_name)
+
+        seq = journal.next_seq
+        journal.next_seq += 1
+        if message is not None:
+            message["seq"] = seq
+        journal.entries.append((seq, message, is_state))
+        return seq
+
+    def last_seq(self, room_name: str) -> int:
+        """The number of the last message broadcast to a room."""
+        return self.journal(room_name).last_seq
+
+    def since(self, room_name: str, seq: int) -> Optional[List[Tuple[int, Optional[dict], bool]]]:
+        """
+        Get the entries broadcast to a room after the given number, or None
+        if some of them are no longer kept.
+        """
+        journal = self.journals.get(room_name)
+        if journal is None or seq > journal.last_seq:
+            return None
+
+        first = journal.entries[0][0] if journal.entries else journal.next_seq
+        if seq < first - 1:
+            return None
+        return [entry for entry in journal.entries if entry[0] > seq]
+
+    def discard(self, room_name: str) -> None:
+        self.journals.pop(room_name, None)
@@ -0,0 +1,638 @@
+"""
+A sharded deployment of the game server, to use more than one core.
+
+Each of N worker processes runs server.main and owns the rooms whose names
+hash to it. A front router accepts the websockets, and forwards each command
+to the worker that owns its room, over a connection of its own to each
+worker that the client has used. Rooms can be migrated between workers, and
+the router can rebalance the rooms every so often. The rooms that have been
+migrated are kept in a file in WAL_DIR, if it is set, and are found again
+from the workers when the router starts.
+
+The router answers for the lobby and metrics of every worker: lobby pages
+are merged from the workers' pages, with their cursors interleaved into
+one, changes to the lobby of every worker are passed on to the clients
+that subscribed, and the metrics of every worker are served together, each
+labelled with its shard.
+
+    python -m server.shards --workers 4 --port 8000
+"""
+from contextlib import asynccontextmanager
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+from urllib.parse import quote
+import zlib
+from typing import Dict, List, Optional, Set, Union
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import ConnectionClosed
+
+from core.catalog import Catalog
+from server.codec import decode_json, decode_msgpack, encode_json, encode_msgpack
+from server.glossary import Glossaries
+from server.lobby import MAX_PAGE
+
+# Commands that put the client in a room, which is followed when it migrates
+ROOM_COMMANDS = ("create_room", "join_room", "view_room", "resume")
+# Commands for the lobby of every shard, which the router answers itself
+LOBBY_COMMANDS = ("list_rooms", "subscribe_lobby", "unsubscribe_lobby")
+
+def shard_for(room_name: str, num_shards: int) -> int:
+    """Get the shard a room belongs on, by a hash of its name that is stable across processes."""
+    return zlib.crc32(room_name.encode()) % num_shards
+
+class ShardMap:
+    """
+    The shard that owns each room: by hash, unless the room has been
+    migrated. The rooms that have been migrated are kept in the file at
+    path, if it is given, so that they can still be found after a restart.
+    """
+    def __init__(self, num_shards: int, path: Optional[str] = None):
+        self.num_shards = num_shards
+        self.path = path
+        self.moved: Dict[str, int] = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.moved = {room_name: shard for room_name, shard in json.load(f).items()
+                              if 0 <= shard < num_shards}
+
+    def owner(self, room_name: str) -> int:
+        return self.moved.get(room_name, shard_for(room_name, self.num_shards))
+
+    def move(self, room_name: str, shard: int) -> None:
+        if shard == shard_for(room_name, self.num_shards):
+            self.moved.pop(room_name, None)
+        else:
+            self.moved[room_name] = shard
+
+    def write(self, moved: Dict[str, int]) -> None:
+        """Write a copy of the rooms that have moved to the file, if there is one."""
+        if self.path is None:
+            return
+
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(moved, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+def decode(frame: Union[str, bytes]):
+    """Decode a frame from JSON text, or MessagePack if it's binary."""
+    if isinstance(frame, bytes):
+        return decode_msgpack(frame)
+    return decode_json(frame)
+
+def as_hello(frame: Union[str, bytes]) -> Optional[dict]:
+    """Get a frame from a shard if it is its reply to a hello, or None."""
+    try:
+        message = decode(frame)
+    except ValueError:
+        # Such as a compressed frame
+        return None
+    return message if isinstance(message, dict) and message.get("type") == "hello" else None
+
+def merge_metrics(texts: List[str]) -> str:
+    """
+    Merge the metrics of every shard into one exposition, with a 'shard'
+    label on each sample, keeping the samples of each metric together.
+    """
+    families: Dict[str, tuple] = {}
+    for shard, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+
+            if line.startswith("#"):
+                # '# HELP name ...' or '# TYPE name type'
+                family = line.split(" ", 3)[2]
+                headers, _ = families.setdefault(family, ([], []))
+                if line not in headers:
+                    headers.append(line)
+                continue
+
+            end = min(index for index in (line.find("{"), line.find(" ")) if index >= 0)
+            if line[end] == "{":
+                labelled = f'{line[:end]}{{shard="{shard}",{line[end + 1:]}'
+            else:
+                labelled = f'{line[:end]}{{shard="{shard}"}}{line[end:]}'
+            families.setdefault(family or line[:end], ([], []))[1].append(labelled)
+
+    return "".join(line + "\n" for headers, samples in families.values() for line in headers + samples)
+
+class Session:
+    """A client websocket on the router, and its connections to the shards."""
+    def __init__(self, router: "Router", websocket: WebSocket):
+        self.router = router
+        self.websocket = websocket
+        self.upstreams: Dict[int, ClientConnection] = {}
+        self.pumps: Dict[int, asyncio.Task] = {}
+        self.hello: Optional[Union[str, bytes]] = None
+        self.swallow: Dict[int, int] = {}
+        self.answering = False
+        self.msgpack = False
+        self.room_name: Optional[str] = None
+        self.closed = False
+        self.lock = asyncio.Lock()
+
+    async def upstream(self, shard: int) -> ClientConnection:
+        """Get the connection to a shard, opening it if needed."""
+        async with self.lock:
+            if shard not in self.upstreams:
+                connection = await connect(self.router.ws_urls[shard], max_size=None)
+                self.upstreams[shard] = connection
+                self.pumps[shard] = asyncio.create_task(self._pump(shard, connection))
+
+                # Every shard must know the features the client negotiated
+                if self.hello is not None:
+                    await self.send_hello(shard)
+
+            return self.upstreams[shard]
+
+    async def detach(self, shard: int) -> None:
+        """
+        Close the connection to a shard the client no longer has a room on,
+        so that it leaves the room there, without closing the client.
+        """
+        async with self.lock:
+            connection = self.upstreams.pop(shard, None)
+            self.pumps.pop(shard, None)
+            self.swallow.pop(shard, None)
+
+        if connection is not None:
+            await connection.close()
+
+    async def send(self, message: dict) -> None:
+        """Send a message from the router itself, in the encoding the client negotiated."""
+        if self.msgpack:
+            await self.websocket.send_bytes(encode_msgpack(message))
+        else:
+            await self.websocket.send_text(encode_json(message))
+
+    async def send_hello(self, shard: int) -> None:
+        """Repeat the client's hello to a shard, without passing on the reply."""
+        self.swallow[shard] = self.swallow.get(shard, 0) + 1
+        await self.upstreams[shard].send(self.hello)
+
+    async def _pump(self, shard: int, connection: ClientConnection) -> None:
+        """Pass everything a shard sends on to the client."""
+        try:
+            async for message in connection:
+                # Frames are only decoded while a reply to a hello is due
+                hello = as_hello(message) if self.swallow.get(shard) or (shard == 0 and self.answering) else None
+                if hello is not None:
+                    if self.swallow.get(shard):
+                        self.swallow[shard] -= 1
+                        continue
+                    self.answering = False
+                    self.msgpack = "msgpack" in hello.get("features", [])
+
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+        except (ConnectionClosed, RuntimeError):
+            pass
+
+        if self.upstreams.get(shard) is not connection:
+            # Detached from the shard on purpose
+            return
+
+        # A shard only closes a connection on purpose, e.g. to a slow
+        # consumer, so the client is told the same
+        if not self.closed:
+            code = connection.close_code or 1011
+            self.closed = True
+            try:
+                await self.websocket.close(code=code if code != 1006 else 1011)
+            except RuntimeError:
+                pass
+
+    async def close(self) -> None:
+        self.closed = True
+        for pump in self.pumps.values():
+            pump.cancel()
+        await asyncio.gather(*(connection.close() for connection in self.upstreams.values()),
+                             return_exceptions=True)
+
+class Router:
+    """Routes the commands of every client to the shard that owns their room."""
+    def __init__(self, worker_urls: List[str], secret: str, moved_path: Optional[str] = None):
+        self.worker_urls = worker_urls
+        self.ws_urls = [url.replace("http", "ws", 1) + "/ws" for url in worker_urls]
+        self.shards = ShardMap(len(worker_urls), moved_path)
+        self.sessions: Set[Session] = set()
+        self.paused: Dict[str, asyncio.Event] = {}
+        self.migrations = 0
+        self.writing = asyncio.Lock()
+        self.lobby_subscribers: Set[Session] = set()
+        self.lobby_feeds: List[asyncio.Task] = []
+        self.http = httpx.AsyncClient(headers={"x-shard-secret": secret}, timeout=30)
+
+    async def recover(self) -> int:
+        """
+        Find the rooms in memory on each shard that have been moved off the
+        shard they hash to, such as by a router that has since restarted.
+        Hibernated rooms are only known from the file. Returns how many
+        rooms have moved.
+        """
+        responses = await asyncio.gather(*(self.http.get(f"{url}/admin/rooms") for url in self.worker_urls))
+        for shard, response in enumerate(responses):
+            response.raise_for_status()
+            for room_name in response.json()["rooms"]:
+                self.shards.move(room_name, shard)
+
+        await self.save()
+        return len(self.shards.moved)
+
+    async def save(self) -> None:
+        """Keep the rooms that have moved, without waiting on the disk in the event loop."""
+        async with self.writing:
+            await asyncio.get_running_loop().run_in_executor(None, self.shards.write, dict(self.shards.moved))
+
+    async def lobby_page(self, after: int = 0, limit: int = 50) -> dict:
+        """
+        Get a page of the open rooms of every shard. A room's cursor is its
+        cursor on its shard times the number of shards, plus its shard, so
+        the page is the first rooms after the cursor on each shard, merged.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        count = len(self.worker_urls)
+        responses = await asyncio.gather(*(
+            self.http.get(f"{url}/lobby", params={"after": max(0, (after - shard) // count), "limit": limit})
+            for shard, url in enumerate(self.worker_urls)
+        ))
+
+        rooms = []
+        total = 0
+        more = False
+        for shard, response in enumerate(responses):
+            response.raise_for_status()
+            page = response.json()
+            rooms.extend({**room, "cursor": room["cursor"] * count + shard} for room in page["rooms"])
+            total += page["total"]
+            more = more or page["next"] is not None
+
+        rooms.sort(key=lambda room: room["cursor"])
+        more = more or len(rooms) > limit
+        rooms = rooms[:limit]
+        return {"rooms": rooms, "next": rooms[-1]["cursor"] if more else None, "total": total}
+
+    async def lobby_command(self, session: Session, message: dict) -> None:
+        """List a page of the lobby of every shard, or subscribe to or unsubscribe from its changes."""
+        command = message["command"]
+        request_id = message.get("request_id")
+        tag = {"request_id": request_id} if request_id is not None else {}
+
+        if command == "unsubscribe_lobby":
+            self.lobby_subscribers.discard(session)
+            if request_id is not None:
+                await session.send({"type": "ack", "command": command, **tag})
+            return
+
+        after = message.get("after", 0)
+        limit = message.get("limit", 50)
+        if type(after) is not int or type(limit) is not int:
+            await session.send({"type": "error", "message": "'after' and 'limit' must be integers.", **tag})
+            return
+
+        try:
+            page = await self.lobby_page(after, limit)
+        except httpx.HTTPError as e:
+            await session.send({"type": "error", "message": f"Shard unavailable: {e}", **tag})
+            return
+
+        if command == "subscribe_lobby":
+            self.lobby_subscribers.add(session)
+            if not self.lobby_feeds:
+                self.lobby_feeds = [asyncio.create_task(self._follow_lobby(shard))
+                                    for shard in range(len(self.ws_urls))]
+        await session.send({"type": "lobby", **page, **tag})
+
+    async def _follow_lobby(self, shard: int) -> None:
+        """Pass the changes to the lobby of a shard on to the clients that subscribed."""
+        count = len(self.ws_urls)
+        while True:
+            try:
+                async with connect(self.ws_urls[shard], max_size=None) as connection:
+                    await connection.send(json.dumps({"command": "subscribe_lobby", "limit": 1}))
+                    async for frame in connection:
+                        change = decode_json(frame)
+                        if change.get("type") != "lobby_update":
+                            continue
+
+                        if "cursor" in change:
+                            change["cursor"] = change["cursor"] * count + shard
+                        await asyncio.gather(*(session.send(change) for session in list(self.lobby_subscribers)),
+                                             return_exceptions=True)
+            except (OSError, ConnectionClosed):
+                pass
+
+            # Follow the shard again once it is back
+            await asyncio.sleep(1)
+
+    async def route(self, session: Session, text: Union[str, bytes]) -> None:
+        """
+        Forward a command from a client to the shard that owns its room, as
+        JSON text or MessagePack bytes.
+        """
+        try:
+            message = decode(text)
+        except ValueError:
+            message = None
+
+        command = message.get("command") if isinstance(message, dict) else None
+        room_name = message.get("room_name") if isinstance(message, dict) else None
+        left = None
+
+        if command == "hello":
+            # Answered by one shard, and repeated to the rest
+            session.hello = text
+            for shard in list(session.upstreams):
+                await session.send_hello(shard)
+            session.answering = True
+            await (await session.upstream(0)).send(text)
+            return
+
+        if command in LOBBY_COMMANDS:
+            await self.lobby_command(session, message)
+            return
+
+        if isinstance(room_name, str) and room_name:
+            # Hold commands for a room while it migrates
+            paused = self.paused.get(room_name)
+            if paused is not None:
+                await paused.wait()
+
+            shard = self.shards.owner(room_name)
+            if command in ROOM_COMMANDS:
+                if session.room_name is not None:
+                    left = self.shards.owner(session.room_name)
+                session.room_name = room_name
+        elif session.room_name is not None:
+            shard = self.shards.owner(session.room_name)
+        else:
+            shard = 0
+
+        await (await session.upstream(shard)).send(text)
+
+        # Leave the shard of the room the client was in, which would
+        # otherwise keep sending it the broadcasts of that room
+        if left is not None and left != shard:
+            await session.detach(left)
+
+    async def migrate(self, room_name: str, shard: int) -> bool:
+        """
+        Move a room to another shard. Commands for the room are held until
+        it has moved, and clients in the room are moved with it. Returns
+        False if the room was already there.
+        """
+        source = self.shards.owner(room_name)
+        if source == shard or room_name in self.paused:
+            return False
+
+        paused = self.paused[room_name] = asyncio.Event()
+        path = f"/admin/rooms/{quote(room_name, safe='')}"
+        try:
+            exported = await self.http.post(f"{self.worker_urls[source]}{path}/export")
+            exported.raise_for_status()
+
+            imported = await self.http.post(f"{self.worker_urls[shard]}{path}/import",
+                                            content=exported.content)
+            if imported.status_code != 200:
+                # Put the room back where it was
+                await self.http.post(f"{self.worker_urls[source]}{path}/import",
+                                     content=exported.content)
+                imported.raise_for_status()
+
+            self.shards.move(room_name, shard)
+            self.migrations += 1
+            await self.save()
+
+            view = json.dumps({"command": "view_room", "room_name": room_name})
+            for session in list(self.sessions):
+                if session.room_name == room_name and not session.closed:
+                    await (await session.upstream(shard)).send(view)
+                    await session.detach(source)
+        finally:
+            del self.paused[room_name]
+            paused.set()
+
+        return True
+
+    async def rebalance(self) -> List[dict]:
+        """Migrate rooms from the fullest shards to the emptiest, until they are even."""
+        responses = await asyncio.gather(*(self.http.get(f"{url}/admin/rooms") for url in self.worker_urls))
+        rooms = [response.json()["rooms"] for response in responses]
+
+        moves = []
+        while True:
+            fullest = max(range(len(rooms)), key=lambda shard: len(rooms[shard]))
+            emptiest = min(range(len(rooms)), key=lambda shard: len(rooms[shard]))
+            if len(rooms[fullest]) - len(rooms[emptiest]) <= 1:
+                break
+
+            room_name = rooms[fullest].pop()
+            if await self.migrate(room_name, emptiest):
+                moves.append({"room_name": room_name, "from": fullest, "to": emptiest})
+            rooms[emptiest].append(room_name)
+
+        return moves
+
+def create_router(worker_urls: List[str], secret: str, rebalance_interval: float = 0,
+                  moved_path: Optional[str] = None) -> FastAPI:
+    """Create the front router app for shards running at the given URLs."""
+    router = Router(worker_urls, secret, moved_path)
+
+    async def rebalance_periodically():
+        while True:
+            await asyncio.sleep(rebalance_interval)
+            try:
+                await router.rebalance()
+            except httpx.HTTPError:
+                continue
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        try:
+            await router.recover()
+        except httpx.HTTPError as e:
+            print(f"Could not find the rooms that moved from the shards: {e}", file=sys.stderr)
+        task = asyncio.create_task(rebalance_periodically()) if rebalance_interval > 0 else None
+        yield
+        if task is not None:
+            task.cancel()
+        for feed in router.lobby_feeds:
+            feed.cancel()
+        await router.http.aclose()
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.router = router
+
+    # Every worker serves the same glossary, so the router serves it itself
+    glossaries = Glossaries(Catalog.default())
+
+    def check_secret(request: Request):
+        if not secrets.compare_digest(request.headers.get("x-shard-secret", ""), secret):
+            raise HTTPException(status_code=404)
+
+    @app.get("/admin/shards")
+    async def list_shards(request: Request):
+        check_secret(request)
+        return {"shards": worker_urls, "moved": router.shards.moved, "migrations": router.migrations}
+
+    @app.post("/admin/rooms/{room_name:path}/migrate/{shard}")
+    async def migrate_room(room_name: str, shard: int, request: Request):
+        check_secret(request)
+        if not 0 <= shard < len(worker_urls):
+            raise HTTPException(status_code=400, detail=f"Shard {shard} does not exist.")
+
+        try:
+            moved = await router.migrate(room_name, shard)
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+
+        return {"room_name": room_name, "shard": router.shards.owner(room_name), "moved": moved}
+
+    @app.get("/lobby")
+    async def get_lobby(after: int = 0, limit: int = 50):
+        """A page of the rooms that can be joined on every shard."""
+        try:
+            return await router.lobby_page(after, limit)
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Shard unavailable: {e}")
+
+    @app.get("/metrics")
+    async def get_metrics():
+        try:
+            responses = await asyncio.gather(*(router.http.get(f"{url}/metrics") for url in worker_urls))
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Shard unavailable: {e}")
+        return Response(content=merge_metrics([response.text for response in responses]),
+                        media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.get("/glossary")
+    async def get_glossary(request: Request):
+        return glossaries.default.response(request.headers.get("if-none-match"),
+                                           request.headers.get("accept-encoding"))
+
+    @app.get("/glossary/{content_hash}")
+    async def get_glossary_by_hash(content_hash: str, request: Request):
+        glossary = glossaries.by_hash.get(content_hash)
+        if glossary is None:
+            raise HTTPException(status_code=404, detail="Unknown glossary.")
+        return glossary.response(request.headers.get("if-none-match"),
+                                 request.headers.get("accept-encoding"), immutable=True)
+
+    @app.post("/admin/rebalance")
+    async def rebalance(request: Request):
+        check_secret(request)
+        return {"moves": await router.rebalance()}
+
+    @app.websocket("/ws")
+    async def websocket_endpoint(websocket: WebSocket):
+        await websocket.accept()
+        session = Session(router, websocket)
+        router.sessions.add(session)
+
+        try:
+            while not session.closed:
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    break
+                text = frame["bytes"] if frame.get("bytes") is not None else frame.get("text", "")
+                try:
+                    await router.route(session, text)
+                except (OSError, ConnectionClosed) as e:
+                    await websocket.send_text(json.dumps({
+                        "type": "error", "message": f"Shard unavailable: {e}"
+                    }))
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            router.sessions.discard(session)
+            router.lobby_subscribers.discard(session)
+            await session.close()
+
+    return app
+
+def _run_worker(index: int, host: str, port: int, secret: str) -> None:
+    os.environ["SHARD_SECRET"] = secret
+    os.environ["SHARD_INDEX"] = str(index)
+    if os.environ.get("WAL_DIR"):
+        # Every shard logs to a directory of its own
+        os.environ["WAL_DIR"] = os.path.join(os.environ["WAL_DIR"], f"shard{index}")
+
+    uvicorn.run("server.main:app", host=host, port=port, log_level="warning")
+
+def wait_for_port(host: str, port: int, timeout: float = 30) -> None:
+    """Wait until something is listening on a port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run the game server as shards behind a router.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of shards")
+    parser.add_argument("--host", default="0.0.0.0", help="host for the router to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port for the router to listen on")
+    parser.add_argument("--base-port", type=int, default=8100, help="port of the first shard")
+    parser.add_argument("--rebalance-interval", type=float, default=0,
+                        help="seconds between rebalancing the rooms, or 0 to never")
+    args = parser.parse_args(argv)
+
+    # The admin endpoints of the shards and router are guarded by a secret
+    secret = os.environ.get("SHARD_SECRET") or secrets.token_hex(16)
+
+    # Uvicorn re-raises SIGTERM once the router has shut down, which must
+    # still stop the workers on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_run_worker, args=(index, "127.0.0.1", args.base_port + index, secret),
+                        daemon=True)
+        for index in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        for index in range(args.workers):
+            wait_for_port("127.0.0.1", args.base_port + index)
+
+        worker_urls = [f"http://127.0.0.1:{args.base_port + index}" for index in range(args.workers)]
+        print(f"Routing to {args.workers} shards on ports {args.base_port}-"
+              f"{args.base_port + args.workers - 1}", file=sys.stderr)
+        moved_path = None
+        if os.environ.get("WAL_DIR"):
+            os.makedirs(os.environ["WAL_DIR"], exist_ok=True)
+            moved_path = os.path.join(os.environ["WAL_DIR"], "moved.json")
+        uvicorn.run(create_router(worker_urls, secret, args.rebalance_interval, moved_path),
+                    host=args.host, port=args.port, log_level="warning")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import math
+import time
+from typing import Callable, Dict, Hashable, List, Tuple
+
+class TimerWheel:
+    """
+    Timers for any number of keys on a single hashed timing wheel, ticked
+    by a single task, rather than a task or call_later per timer.
+
+    Time is divided into ticks, and each timer is an entry in the slot of
+    the tick it is due in, so arming and cancelling a timer are a dict
+    insertion and deletion, and each tick only looks at its own slot.
+    Timers due more than a revolution of the wheel away wait in their slot
+    for a later revolution.
+
+    Each key has at most one timer; arming it again replaces it. When a
+    timer is due, the callback is called with its key and the payload it
+    was armed with.
+    """
+    def __init__(self, callback: Callable[[Hashable, object], None], tick: float = 0.1,
+                 slots: int = 1024, clock: Callable[[], float] = time.monotonic):
+        self.callback = callback
+        self.tick = tick
+        self.slots: List[Dict[Hashable, Tuple[int, object]]] = [{} for _ in range(slots)]
+        self.timers: Dict[Hashable, int] = {}
+        self.clock = clock
+        self.start = clock()
+        self.current = 0
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.timers
+
+    def arm(self, key: Hashable, delay: float, payload: object = None) -> None:
+        """Call the callback with the key and payload in delay seconds, instead of when it was due."""
+        slots = self.slots
+        armed = self.timers.get(key)
+        if armed is not None:
+            del slots[armed][key]
+
+        # Due on the first tick at or after the delay, but never on one that
+        # has already been processed
+        due = max(self.current + 1, math.ceil((self.clock() - self.start + delay) / self.tick))
+        slot = due % len(slots)
+        slots[slot][key] = (due, payload)
+        self.timers[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancel the timer of a key. Returns False if it had none."""
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def advance(self) -> int:
+        """Fire every timer that is due by now. Returns how many were."""
+        target = int((self.clock() - self.start) / self.tick)
+        if target <= self.current:
+            return 0
+
+        # After a stall of more than a revolution, every slot is looked at
+        # once, rather than once per tick missed
+        fired = 0
+        for tick in range(self.current + 1, self.current + 1 + min(target - self.current, len(self.slots))):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+
+            for key in [key for key, (due, _) in slot.items() if due <= target]:
+                _, payload = slot.pop(key)
+                del self.timers[key]
+                fired += 1
+                self.callback(key, payload)
+
+        self.current = target
+        self.fired += fired
+        return fired
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from typing import Callable, Optional, Union
+
+from core.game import Game
+from server.codec import compact, encode_json, encode_msgpack
+
+class StateView:
+    """
+    The full state message of a room at one version, numbered as of one
+    message broadcast to the room, with its encodings, each made the first
+    time a viewer needs it.
+    """
+    __slots__ = ("version", "seq", "message", "text", "packed")
+
+    def __init__(self, version: int, seq: int, message: dict):
+        self.version = version
+        self.seq = seq
+        self.message = message
+        self.text: Optional[str] = None
+        self.packed: Optional[bytes] = None
+
+class StateViews:
+    """
+    The latest state view of each room, built at most once per version of
+    its game and shared by every viewer until the game next changes.
+
+    Every change to a game bumps its version, so a view is current as long
+    as its version is the game's, and nothing else has been broadcast to the
+    room since. Only the rooms viewed most recently are kept, up to
+    max_rooms.
+    """
+    def __init__(self, build: Callable[[Game], dict], max_rooms: int = 10000):
+        self.build = build
+        self.max_rooms = max_rooms
+        self.views: "OrderedDict[str, StateView]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.encodings = 0
+
+    def get(self, room_name: str, game: Game, seq: int) -> StateView:
+        """
+        Get the view of a room's current state as of the last message
+        broadcast to it, building it if either has changed.
+        """
+        view = self.views.get(room_name)
+        if view is not None and view.version == game.version and view.seq == seq:
+            self.hits += 1
+            self.views.move_to_end(room_name)
+            return view
+
+        self.misses += 1
+        message = self.build(game)
+        message["seq"] = seq
+        view = self.views[room_name] = StateView(game.version, seq, message)
+        self.views.move_to_end(room_name)
+        if len(self.views) > self.max_rooms:
+            self.views.popitem(last=False)
+        return view
+
+    def frame(self, view: StateView, msgpack: bool) -> Union[str, bytes]:
+        """Get a view's message as JSON text or compact MessagePack, encoding it the first time."""
+        if msgpack:
+            if view.packed is None:
+                self.encodings += 1
+                view.packed = encode_msgpack(compact(view.message))
+            return view.packed
+
+        if view.text is None:
+            self.encodings += 1
+            view.text = encode_json(view.message)
+        return view.text
+
+    def discard(self, room_name: str) -> None:
+        """Forget the view of a room that has been removed, or replaced by a new game."""
+        self.views.pop(room_name, None)
@@ -0,0 +1,246 @@
+import asyncio
+import base64
+import glob
+import json
+import os
+import pickle
+from typing import Dict, Tuple
+
+from core.catalog import Catalog
+from core.game import Game, WinException
+
+SNAPSHOT_PATTERN = "snapshot-{:012d}.pickle"
+SEGMENT_PATTERN = "log-{:012d}.jsonl"
+
+class LogError(Exception):
+    """Raised when the log can't be replayed."""
+    pass
+
+def apply_record(games: Dict[str, Game], bots: Dict[str, Dict[str, dict]],
+                 record: dict, catalog: Catalog) -> None:
+    """Replay a logged change onto the rooms it was made to."""
+    op = record["op"]
+    room_name = record["room"]
+
+    if op == "create":
+        games[room_name] = Game().add_player(record["player"])
+
+    elif op == "join":
+        games[room_name].add_player(record["player"])
+
+    elif op == "add_bot":
+        games[room_name].add_player(record["player"])
+        bots.setdefault(room_name, {})[record["player"]] = record["budget"]
+
+    elif op == "forfeit":
+        bots.setdefault(room_name, {})[record["player"]] = record["budget"]
+
+    elif op == "begin":
+        if record["catalog"] != catalog.content_hash:
+            raise LogError(f"Room {room_name} was begun with a different catalog")
+
+        game = games[room_name].begin(catalog, seed=record["seed"])
+
+        # The logged deal is authoritative, whatever the seed gives now
+        for tier, order in record["decks"].items():
+            deck = game.decks[tier]
+            deck.visible[:], deck.hidden[:] = order[:len(deck.visible)], order[len(deck.visible):]
+        game.collections_in_play = bytes(record["collections"])
+
+    elif op == "action":
+        try:
+            games[room_name].do_action(record["action"], record["player"], **record["args"])
+        except WinException:
+            pass
+
+    elif op == "pass":
+        games[room_name].debug_action_pass(record["player"])
+
+    elif op in ("import", "wake"):
+        # A room migrated in from another shard, or woken from hibernation
+        state = pickle.loads(base64.b64decode(record["state"]))
+        games[room_name] = state["game"]
+        if state["bots"]:
+            bots[room_name] = state["bots"]
+
+    elif op in ("drop", "hibernate"):
+        # A room migrated out to another shard, or hibernated to disk
+        games.pop(room_name, None)
+        bots.pop(room_name, None)
+
+    else:
+        raise LogError(f"Unknown op in log: {op}")
+
+def deal_record(game: Game) -> dict:
+    """Get the fields that a 'begin' record keeps of a game's deal."""
+    return {
+        "catalog": game.catalog.content_hash,
+        "decks": {
+            tier: list(deck.visible + deck.hidden)
+            for tier, deck in game.decks.items()
+        },
+        "collections": list(game.collections_in_play),
+    }
+
+class ActionLog:
+    """
+    A write-ahead log of every change made to the rooms, with periodic
+    snapshots, so that they can be rebuilt after a crash or deploy.
+
+    Changes are appended to the current log segment as JSON lines, and
+    handed to the OS straight away, but only fsynced in batches by run().
+    Every snapshot_every changes, run() pickles every room into a snapshot
+    and starts a new segment, and segments older than the latest snapshot
+    are deleted. Recovery loads the latest snapshot and replays the
+    segments after it.
+    """
+    def __init__(self, directory: str, fsync_interval: float = 0.05,
+                 snapshot_every: int = 10000):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.since_snapshot = 0
+        self.dirty = False
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, pattern: str) -> list:
+        """List the files matching a pattern, with their sequence numbers, in order."""
+        prefix, suffix = pattern.split("{")[0], pattern.split("}")[1]
+        paths = []
+        for path in glob.glob(os.path.join(self.directory, prefix + "*" + suffix)):
+            name = os.path.basename(path)
+            try:
+                paths.append((int(name[len(prefix):-len(suffix)]), path))
+            except ValueError:
+                continue
+
+        return sorted(paths)
+
+    def _open_segment(self) -> None:
+        path = os.path.join(self.directory, SEGMENT_PATTERN.format(self.seq + 1))
+        self._file = open(path, "a", encoding="utf-8")
+
+    def recover(self, catalog: Catalog) -> Tuple[Dict[str, Game], Dict[str, Dict[str, dict]]]:
+        """
+        Rebuild the rooms from the latest snapshot and the log after it, and
+        open a new segment to append to. Returns the rooms and their bots.
+        """
+        games, bots = {}, {}
+
+        snapshots = self._paths(SNAPSHOT_PATTERN)
+        if snapshots:
+            with open(snapshots[-1][1], "rb") as f:
+                snapshot = pickle.load(f)
+            games, bots, self.seq = snapshot["games"], snapshot["bots"], snapshot["seq"]
+
+        for _, path in self._paths(SEGMENT_PATTERN):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The tail of the last segment was torn by the crash
+                        break
+
+                    # Segments may overlap a snapshot written just before a crash
+                    if record["seq"] <= self.seq:
+                        continue
+
+                    apply_record(games, bots, record, catalog)
+                    self.seq = record["seq"]
+                    self.since_snapshot += 1
+
+        self._open_segment()
+        return games, bots
+
+    def append(self, op: str, room_name: str, **fields) -> None:
+        """Log a change that was made to a room."""
+        self.seq += 1
+        self._file.write(json.dumps({"seq": self.seq, "op": op, "room": room_name, **fields},
+                                    separators=(",", ":")) + "\n")
+        self._file.flush()
+        self.since_snapshot += 1
+        self.dirty = True
+
+    def sync(self) -> None:
+        """Make every change logged so far durable."""
+        if self.dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.dirty = False
+
+    def snapshot(self, games: Dict[str, Game], bots: Dict[str, Dict[str, dict]]) -> int:
+        """Snapshot every room and start a new segment. Returns the size of the snapshot."""
+        data, old, seq = self._begin_snapshot(games, bots)
+        self._finish_snapshot(data, old, seq)
+        return len(data)
+
+    def _begin_snapshot(self, games: Dict[str, Game], bots: Dict[str, Dict[str, dict]]) -> tuple:
+        """Pickle every room and start a new segment for the changes after them."""
+        data = pickle.dumps({"seq": self.seq, "games": games, "bots": bots},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        old = self._file
+        self._open_segment()
+        self.since_snapshot = 0
+        self.dirty = False
+
+        return data, old, self.seq
+
+    def _finish_snapshot(self, data: bytes, old, seq: int) -> None:
+        """Close the old segment and write the snapshot to disk."""
+        old.flush()
+        os.fsync(old.fileno())
+        old.close()
+
+        self._write_snapshot(data, seq)
+
+    def _write_snapshot(self, data: bytes, seq: int) -> None:
+        path = os.path.join(self.directory, SNAPSHOT_PATTERN.format(seq))
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        # Everything before the snapshot is now redundant
+        for old_seq, old_path in self._paths(SNAPSHOT_PATTERN):
+            if old_seq < seq:
+                os.remove(old_path)
+        for first_seq, old_path in self._paths(SEGMENT_PATTERN):
+            if first_seq <= seq:
+                os.remove(old_path)
+
+    async def run(self, games: Dict[str, Game], bots: Dict[str, Dict[str, dict]]) -> None:
+        """
+        Fsync the log in batches, and take snapshots when they are due. The
+        room state is pickled on the event loop, so that it is consistent,
+        but the disk is only waited on in a thread.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+
+            if self.dirty:
+                self._file.flush()
+                self.dirty = False
+                await loop.run_in_executor(None, os.fsync, self._file.fileno())
+
+            if self.since_snapshot >= self.snapshot_every:
+                await loop.run_in_executor(None, self._finish_snapshot,
+                                           *self._begin_snapshot(games, bots))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None